@@ -4,50 +4,112 @@ import json
 import re
 import numpy as np
 from pokemon import Pokemon, Move, GameData
+from protocol import decode
 from dex import *
 
+#Actions are the 4 moves of the active pokemon followed by switching to each
+#of the 6 team slots
+NUM_ACTIONS = 10
+
+ACTIVE_RE = re.compile('p(1|2)a: (.*)')
+POKEMON_RE = re.compile('p(1|2): (.*)')
+SIDE_RE = re.compile('p(1|2): ')
+ZMOVE_RE = re.compile('z(.*)')
+EFFECT_RE = re.compile('(move: )?(.*)')
+ACTIVATE_RE = re.compile('(?:(move|ability|item): )?(.*)')
+FROM_RE = re.compile('(item|ability): (.*)')
+
+def handles(*message_types):
+    """Marks an Agent method as the handler for the given message types"""
+    def decorator(f):
+        f.handled_types = message_types
+        return f
+    return decorator
+
 def parse_pokemon(s):
     """Get player num and pokemon nickname"""
-    m = re.match('p(1|2)a: (.*)', s)
+    m = ACTIVE_RE.match(s)
     return m.group(1), m.group(2)
 
 class Agent:
+    #Maps message types to handler functions, built for every subclass
+    dispatch = {}
+    handler_names = {}
+    #Class of the tracked battle state, ArrayGameData keeps boosts and
+    #effects in one array
+    game_data_class = GameData
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.build_dispatch()
+
+    @classmethod
+    def build_dispatch(cls):
+        """Builds the dispatch table from the tables of the base classes and
+        the methods of this class marked with @handles. Subclasses can
+        replace a handler by overriding its method, or by marking a new
+        method as the handler for the same message type."""
+        dispatch = {}
+        names = {}
+        for base in reversed(cls.__bases__):
+            dispatch.update(getattr(base, 'dispatch', {}))
+            names.update(getattr(base, 'handler_names', {}))
+        #Handlers found by method name follow methods overridden here
+        for message_type, name in names.items():
+            dispatch[message_type] = getattr(cls, name)
+        for name, attr in vars(cls).items():
+            for message_type in getattr(attr, 'handled_types', ()):
+                dispatch[message_type] = attr
+                names[message_type] = name
+        cls.dispatch = dispatch
+        #Maps message types to the names of their handler methods
+        cls.handler_names = names
+
+    @classmethod
+    def register_handler(cls, message_type, handler):
+        """Makes handler(agent, args, kwargs) handle a message type for this
+        class and the subclasses created after the call"""
+        cls.dispatch = dict(cls.dispatch)
+        cls.dispatch[message_type] = handler
+        cls.handler_names = dict(cls.handler_names)
+        cls.handler_names.pop(message_type, None)
+
     def __init__(self, player_name):
         self.player_name = player_name
-        self.game_data = GameData()
+        self.game_data = self.game_data_class()
         self.init_battle()
         self.logger = logging.getLogger(__name__)
         if len(self.logger.handlers) == 0:
             self.logger.addHandler(logging.StreamHandler())
-        self.poke_to_ix = {poke:i for i, poke in enumerate(pokedex)}
-        self.move_to_ix = {move:i for i, move in enumerate(movedex)}
-        #Assign index 0 to having no item
-        self.item_to_ix = {item:i+1 for i, item in enumerate(itemdex)}
-        self.item_to_ix[''] = 0
-        abilities = set()
-        for p in pokedex:
-            for a in pokedex[p]['abilities']:
-                abilities.add(clean_name(a))
-        #Assign index 0 to having no ability
-        self.ability_to_ix = {a:i+1 for i, a in enumerate(abilities)}
-        self.ability_to_ix[''] = 0
-        self.types = {'bug': 0, 'dark': 1, 'dragon': 2, 'electric': 3,
-            'fairy': 4, 'fighting': 5, 'fire': 6, 'flying': 7, 'ghost': 8,
-            'grass': 9, 'ground': 10, 'ice': 11, 'normal': 12, 'poison': 13,
-            'psychic': 14, 'rock': 15, 'steel': 16, 'water': 17}
-        self.move_categories = {'physical': 0, 'special': 1, 'status': 2}
-        self.move_targets = {'normal': 0, 'self': 1, 'all': 2, 'foeSide': 3,
-            'adjacentAlly': 4, 'allySide': 5, 'allyTeam': 6}
-        self.poke_statuses = {'brn': 0, 'frz': 1, 'par': 2, 'psn': 3, 'tox': 4,
-            'slp': 5, 'fnt': 6}
+        #Index maps are shared from dex instead of built for every agent
+        self.poke_to_ix = poke_to_ix
+        self.move_to_ix = move_to_ix
+        self.item_to_ix = item_to_ix
+        self.ability_to_ix = ability_to_ix
+        self.types = type_to_ix
+        self.move_categories = category_to_ix
+        self.move_targets = target_to_ix
+        self.poke_statuses = status_to_ix
 
     def init_battle(self):
         self.player_num = None
         self.wait_game = True
         self.force_switch = False
         self.choose_start = False
+        self.trapped = False
         self.game_data.reset()
 
+    def snapshot(self):
+        """Returns the tracked battle state, for lookahead search to go back
+        to with restore"""
+        return (self.player_num, self.wait_game, self.force_switch,
+            self.choose_start, self.trapped, self.game_data.snapshot())
+
+    def restore(self, snapshot):
+        (self.player_num, self.wait_game, self.force_switch, self.choose_start,
+            self.trapped, game_snapshot) = snapshot
+        self.game_data.restore(game_snapshot)
+
     def choose_action(self):
         if self.wait_game:
             return None
@@ -69,17 +131,32 @@ class Agent:
         self.choose_start = False
         return choice
 
+    def legal_actions(self):
+        """Returns a boolean mask over actions that can be chosen now"""
+        mask = np.zeros(NUM_ACTIONS, dtype=bool)
+        if self.wait_game or self.choose_start:
+            return mask
+        if not self.force_switch:
+            for i, m in enumerate(self.game_data.active.moves[:4]):
+                mask[i] = not m.disabled
+        if self.force_switch or not self.trapped:
+            for i, p in enumerate(self.game_data.team[:6]):
+                mask[4 + i] = p != self.game_data.active and p.status != 'fnt'
+        return mask
+
+    def action_to_choice(self, action):
+        """Turns an action index into a choice for the simulator"""
+        if action < 4:
+            return 'move ' + str(action + 1)
+        return 'switch ' + str(action - 3)
+
     def process_message(self, message):
-        if message != '':
-            args = message.split('|')
-            if args[0] == '':
-                kwargs = {}
-                for i in range(len(args)-1, -1, -1):
-                    m = re.match('\[([a-z]*)\] (.*)', args[i])
-                    if m:
-                        kwargs[m.group(1)] = m.group(2)
-                        args.pop(i)
-                self.process_args(args, kwargs)
+        event = decode(message)
+        if event:
+            self.process_event(event)
+
+    def process_event(self, event):
+        self.process_args(event.args, event.kwargs)
 
     def other_player(self):
         if self.player_num == '1':
@@ -97,11 +174,7 @@ class Agent:
         return self.game_data.opp_boosts
 
     def clear_boosts(self, player):
-        b = self.game_data.boosts
-        if player != self.player_num:
-            b = self.game_data.opp_boosts
-        for stat in b:
-            b[stat] = 0
+        self.game_data.clear_boosts(player != self.player_num)
 
     def get_poke_effects(self, player):
         if player == self.player_num:
@@ -109,11 +182,7 @@ class Agent:
         return self.game_data.opp_poke_effects
 
     def clear_poke_effects(self, player):
-        effects = self.game_data.poke_effects
-        if player != self.player_num:
-            effects = self.game_data.opp_poke_effects
-        for eff in effects:
-            effects[eff] = False
+        self.game_data.clear_poke_effects(player != self.player_num)
 
     def get_side_effects(self, player):
         if player == self.player_num:
@@ -121,10 +190,20 @@ class Agent:
         return self.game_data.opp_side_effects
 
     def process_args(self, args, kwargs):
-        if args[1] == 'player' and args[3] == self.player_name:
+        #Messages without a handler are ignored
+        handler = self.dispatch.get(args[1])
+        if handler:
+            handler(self, args, kwargs)
+
+    @handles('player')
+    def handle_player(self, args, kwargs):
+        if args[3] == self.player_name:
             #args[2] will be 'p1' or 'p2'
             self.player_num = args[2][1]
-        if args[1] == 'request' and args[2] != '':
+
+    @handles('request')
+    def handle_request(self, args, kwargs):
+        if args[2] != '':
             #Read team data
             data = json.loads(args[2])
             if self.game_data.team == None:
@@ -158,383 +237,466 @@ class Agent:
                 else:
                     self.wait_game = False
                     self.force_switch = False
+                    self.trapped = data['active'][0].get('trapped', False)
                     #Read active pokemon moves
-                    moves = list(map(Move.from_data, data['active'][0]['moves']))
+                    moves = data['active'][0]['moves']
                     active = data['side']['pokemon'][0]
                     name,_,_ = Pokemon.get_details(active['details'])
                     for p in self.game_data.team:
                         if p.name == name:
-                            p.moves = moves
-        if args[1] == 'turn':
-            #Do stuff with turn number?
-            pass
-        if args[1] == 'teamsize' and args[2] != 'p' + self.player_num:
+                            p.update_moves(moves)
+
+    @handles('teamsize')
+    def handle_teamsize(self, args, kwargs):
+        if args[2] != 'p' + self.player_num:
             #Initialize opponent team with None for unknown pokemon
             num = int(args[3])
             self.game_data.opp_team = [None for i in range(num)]
-        if args[1] == 'move':
-            player,_ = parse_pokemon(args[2])
-            if player != self.player_num:
-                name = clean_name(args[3])
-                #Check if zmove
-                if name not in movedex:
-                    #z status move
-                    m = re.match('z(.*)', name)
-                    name = m.group(1)
-                    move_type = movedex[name]['type']
-                    #Find corresponding zcrystal
-                    for item in itemdex.values():
-                        if 'zMoveType' in item and item['zMoveType'] == move_type:
-                            self.game_data.opp_active.item = item['id']
-                elif 'isZ' in movedex[name]:
-                    zcrystal = movedex[name]['isZ']
-                    if 'zMoveFrom' in itemdex[zcrystal]:
-                        #Signature zmove
-                        name = clean_name(itemdex[zcrystal]['zMoveFrom'])
-                    else:
-                        #Don't know original move
-                        name = None
-                    self.game_data.opp_active.item = zcrystal
-                if name:
-                    #Update opponent moves
-                    opp_moves = self.game_data.opp_active.moves
-                    for i in range(len(opp_moves)):
-                        if opp_moves[i] == None:
-                            opp_moves[i] = Move(name)
-                            opp_moves[i].pp -= 1
-                            break
-                        if opp_moves[i].name == name:
-                            opp_moves[i].pp -= 1
-                            break
-        if args[1] == 'switch' or args[1] == 'drag':
-            player, nickname = parse_pokemon(args[2])
-            if player == self.player_num:
-                self.clear_boosts(self.player_num)
-                self.clear_poke_effects(self.player_num)
-                self.game_data.active.transformed = False
-                #Update active pokemon and team positions
-                name,_,_ = Pokemon.get_details(args[3])
-                team = self.game_data.team
-                if team:
-                    for i in range(len(team)):
-                        if team[i].name == name:
-                            self.game_data.active = team[i]
-                            team[0], team[i] = team[i], team[0]
-                            break
-            else:
-                if self.game_data.opp_active:
-                    self.game_data.opp_active.switch_out()
-                self.clear_boosts(self.other_player())
-                self.clear_poke_effects(self.other_player())
-                #Update opponent active pokemon and team
-                name,_,_ = Pokemon.get_details(args[3])
-                for i in range(len(self.game_data.opp_team)):
-                    opp = self.game_data.opp_team[i]
-                    if opp == None:
-                        #New pokemon
-                        p = Pokemon.from_details(args[3], nickname, args[4])
-                        self.game_data.opp_active = p
-                        self.game_data.opp_team[i] = p
+
+    @handles('move')
+    def handle_move(self, args, kwargs):
+        player,_ = parse_pokemon(args[2])
+        if player != self.player_num:
+            name = clean_name(args[3])
+            #Check if zmove
+            if name not in movedex:
+                #z status move
+                m = ZMOVE_RE.match(name)
+                name = m.group(1)
+                move_type = movedex[name]['type']
+                #Find corresponding zcrystal
+                for item in itemdex.values():
+                    if 'zMoveType' in item and item['zMoveType'] == move_type:
+                        self.game_data.opp_active.item = item['id']
+            elif 'isZ' in movedex[name]:
+                zcrystal = movedex[name]['isZ']
+                if 'zMoveFrom' in itemdex[zcrystal]:
+                    #Signature zmove
+                    name = clean_name(itemdex[zcrystal]['zMoveFrom'])
+                else:
+                    #Don't know original move
+                    name = None
+                self.game_data.opp_active.item = zcrystal
+            if name:
+                #Update opponent moves. The list and moves are replaced, since
+                #snapshots share them.
+                opp = self.game_data.opp_active
+                opp_moves = list(opp.moves)
+                for i in range(len(opp_moves)):
+                    if opp_moves[i] == None:
+                        opp_moves[i] = Move(name)
+                        opp_moves[i].pp -= 1
                         break
-                    if name == opp.name:
-                        #Existing pokemon
-                        self.game_data.opp_active = opp
+                    if opp_moves[i].name == name:
+                        m = opp_moves[i]
+                        opp_moves[i] = m.with_state(m.pp - 1, m.disabled)
                         break
-        if args[1] == 'detailschange' or args[1] == '-formechange':
-            player,_ = parse_pokemon(args[2])
-            if player != self.player_num:
-                name,_,_ = Pokemon.get_details(args[3])
-                self.game_data.opp_active.change_form(name)
-        if args[1] == 'replace':
-            #TODO: implement this
-            pass
-        if args[1] == 'faint':
-            player,_ = parse_pokemon(args[2])
-            if player != self.player_num:
-                self.game_data.opp_active.status = 'fnt'
-        if args[1] == '-damage' or args[1] == '-heal':
-            player,_ = parse_pokemon(args[2])
-            if player != self.player_num:
-                health, max_health, status = Pokemon.get_condition(args[3])
-                p = self.game_data.opp_active
-                p.health = health
-                p.max_health = max_health
-                p.status = status
-                self.check_item_ability(player, kwargs)
-        if args[1] == '-sethp':
-            player,_ = parse_pokemon(args[2])
-            health1,_,_ = Pokemon.get_condition(args[3])
-            health2,_,_= Pokemon.get_condition(args[5])
-            if player == self.player_num:
-                self.game_data.opp_active.health = health2
-            else:
-                self.game_data.opp_active.health = health1
-        if args[1] == '-status':
-            player,_ = parse_pokemon(args[2])
-            if player != self.player_num:
-                self.game_data.opp_active.status = args[3]
-                self.check_item_ability(player, kwargs)
-        if args[1] == '-curestatus':
-            m = re.match('p(1|2): (.*)', args[2])
-            if m:
-                #Cured pokemon is not active
-                if m.group(1) != self.player_num:
-                    team = self.game_data.opp_team
-                    for p in team:
-                        if p.nickname == m.group(2):
-                            p.status = None
-                            break
-            else:
-                #Cured pokemon is active
-                player,_ = parse_pokemon(args[2])
-                if player != self.player_num:
-                    self.game_data.opp_active.status = None
-                    self.check_item_ability(player, kwargs)
-        if args[1] == '-boost':
-            player,_ = parse_pokemon(args[2])
-            b = self.get_boosts(player)
-            b[args[3]] += int(args[4])
-            self.check_item_ability(player, kwargs)
-        if args[1] == '-unboost':
-            player,_ = parse_pokemon(args[2])
-            b = self.get_boosts(player)
-            b[args[3]] -= int(args[4])
-            if player != self.player_num:
-                self.check_item_ability(player, kwargs)
-        if args[1] == '-setboost':
-            player,_ = parse_pokemon(args[2])
-            amount = int(args[4])
-            #For some reason, anger point sends -setboost 12 instead of 6
-            if amount > 6:
-                amount = 6
-            b = self.get_boosts(player)
-            b[args[3]] = amount
-            if player != self.player_num:
-                self.check_item_ability(player, kwargs)
-        if args[1] == '-swapboost':
-            b = self.game_data.boosts
-            opp_b = self.game_data.opp_boosts
-            swap = list(b)
-            if len(args) > 4:
-                swap = args[4].split(', ')
-            for stat in swap:
-                b[stat], opp_b[stat] = opp_b[stat], b[stat]
-        if args[1] == '-clearpositiveboost' or args[1] == '-clearnegativeboost':
-            player,_ = parse_pokemon(args[2])
-            b = self.get_boosts(player)
-            for stat in b:
-                if args[1] == '-clearpositiveboost' and b[stat] > 0:
-                    b[stat] = 0
-                elif args[1] == '-clearnegativeboost' and b[stat] < 0:
-                    b[stat] = 0
-            if player != self.player_num:
-                self.check_item_ability(player, kwargs)
-        if args[1] == '-copyboost':
-            b_to = self.game_data.boosts
-            b_from = self.game_data.opp_boosts
-            player,_ = parse_pokemon(args[2])
-            if player != self.player_num:
-                b_to, b_from = b_from, b_to
-            swap = list(b_to)
-            if len(args) > 4:
-                swap = args[4].split(', ')
-            for stat in b_to:
-                b_to[stat] = b_from[stat]
-        if args[1] == '-clearboost':
-            player,_ = parse_pokemon(args[2])
-            self.clear_boosts(player)
-            if player != self.player_num:
-                self.check_item_ability(player, kwargs)
-        if args[1] == '-invertboost':
-            player,_ = parse_pokemon(args[2])
-            b = self.get_boosts(player)
-            for stat in b:
-                b[stat] = -b[stat]
-            if player != self.player_num:
-                self.check_item_ability(player, kwargs)
-        if args[1] == '-clearallboost':
+                opp.moves = opp_moves
+
+    @handles('switch', 'drag')
+    def handle_switch(self, args, kwargs):
+        player, nickname = parse_pokemon(args[2])
+        if player == self.player_num:
             self.clear_boosts(self.player_num)
+            self.clear_poke_effects(self.player_num)
+            self.game_data.active.transformed = False
+            self.set_active(args[3])
+        else:
+            if self.game_data.opp_active:
+                self.game_data.opp_active.switch_out()
             self.clear_boosts(self.other_player())
-        if args[1] == '-item':
-            player,_ = parse_pokemon(args[2])
-            if player != self.player_num:
-                self.game_data.opp_active.item = clean_name(args[3])
-        if args[1] == '-enditem':
-            player,_ = parse_pokemon(args[2])
-            if player != self.player_num:
-                self.game_data.opp_active.item = ''
-        if args[1] == '-ability':
-            player,_ = parse_pokemon(args[2])
-            if player != self.player_num:
-                ability = clean_name(args[3])
-                self.game_data.opp_active.set_ability(ability)
-        if args[1] == '-endability':
+            self.clear_poke_effects(self.other_player())
+            self.set_opp_active(args[3], nickname, args[4])
+
+    @handles('replace')
+    def handle_replace(self, args, kwargs):
+        #Illusion ended, the active pokemon was really the one in args[3].
+        #It didn't switch, so boosts and effects stay.
+        player, nickname = parse_pokemon(args[2])
+        if player == self.player_num:
+            self.set_active(args[3])
+        else:
+            self.set_opp_active(args[3], nickname, args[4])
+
+    def set_active(self, details):
+        """Moves the pokemon with these details to the front of the team"""
+        name,_,_ = Pokemon.get_details(details)
+        team = self.game_data.team
+        if team:
+            for i in range(len(team)):
+                if team[i].name == name:
+                    self.game_data.active = team[i]
+                    team[0], team[i] = team[i], team[0]
+                    break
+
+    def set_opp_active(self, details, nickname, condition):
+        """Makes the opponent pokemon with these details active, adding it
+        to the opponent team if it is new"""
+        name,_,_ = Pokemon.get_details(details)
+        for i in range(len(self.game_data.opp_team)):
+            opp = self.game_data.opp_team[i]
+            if opp == None:
+                #New pokemon
+                p = Pokemon.from_details(details, nickname, condition)
+                self.game_data.opp_active = p
+                self.game_data.opp_team[i] = p
+                break
+            if name == opp.name:
+                #Existing pokemon
+                self.game_data.opp_active = opp
+                break
+
+    @handles('detailschange', '-formechange')
+    def handle_detailschange(self, args, kwargs):
+        player,_ = parse_pokemon(args[2])
+        if player != self.player_num:
+            name,_,_ = Pokemon.get_details(args[3])
+            self.game_data.opp_active.change_form(name)
+
+    @handles('faint')
+    def handle_faint(self, args, kwargs):
+        player,_ = parse_pokemon(args[2])
+        if player != self.player_num:
+            self.game_data.opp_active.status = 'fnt'
+
+    @handles('-damage', '-heal')
+    def handle_damage(self, args, kwargs):
+        player,_ = parse_pokemon(args[2])
+        if player != self.player_num:
+            health, max_health, status = Pokemon.get_condition(args[3])
+            p = self.game_data.opp_active
+            p.health = health
+            p.max_health = max_health
+            p.status = status
+            self.check_item_ability(player, kwargs)
+
+    @handles('-sethp')
+    def handle_sethp(self, args, kwargs):
+        player,_ = parse_pokemon(args[2])
+        health1,_,_ = Pokemon.get_condition(args[3])
+        health2,_,_= Pokemon.get_condition(args[5])
+        if player == self.player_num:
+            self.game_data.opp_active.health = health2
+        else:
+            self.game_data.opp_active.health = health1
+
+    @handles('-status')
+    def handle_status(self, args, kwargs):
+        player,_ = parse_pokemon(args[2])
+        if player != self.player_num:
+            self.game_data.opp_active.status = args[3]
+            self.check_item_ability(player, kwargs)
+
+    @handles('-curestatus')
+    def handle_curestatus(self, args, kwargs):
+        m = POKEMON_RE.match(args[2])
+        if m:
+            #Cured pokemon is not active
+            if m.group(1) != self.player_num:
+                team = self.game_data.opp_team
+                for p in team:
+                    if p.nickname == m.group(2):
+                        p.status = None
+                        break
+        else:
+            #Cured pokemon is active
             player,_ = parse_pokemon(args[2])
             if player != self.player_num:
-                opp = self.game_data.opp_active
-                if len(args) <= 3:
-                    opp.update_ability('')
-                #Only remove ability if currently has ability
-                #Needed because -endability is sent after using transform
-                if len(args) > 3 and opp.ability == clean_name(args[3]):
-                    opp.update_ability('')
-        if args[1] == '-transform':
-            player,_ = parse_pokemon(args[2])
-            p = self.game_data.active
-            opp = self.game_data.opp_active
-            if player == self.player_num:
-                self.game_data.boosts = self.game_data.opp_boosts.copy()
-                #Update opponent data before transforming because
-                #p.transform copies opponent data
-                opp.set_ability(p.ability)
-                opp.moves = []
-                for move in p.moves:
-                    opp.moves.append(Move(move.name))
-                p.transform(opp)
-            else:
+                self.game_data.opp_active.status = None
                 self.check_item_ability(player, kwargs)
-                opp.transform(p)
-                self.game_data.opp_boosts = self.game_data.boosts.copy()
-        if args[1] == '-zpower':
-            player,_ = parse_pokemon(args[2])
-            if player == self.player_num:
-                self.game_data.zmove = True
-            else:
-                self.game_data.opp_zmove = True
-        if args[1] == '-mega':
-            player,_ = parse_pokemon(args[2])
-            if player == self.player_num:
-                self.game_data.mega = True
-            else:
-                self.game_data.opp_mega = True
-                self.game_data.opp_active.item = clean_name(args[4])
-        if args[1] == '-start':
-            player,_ = parse_pokemon(args[2])
-            p = self.get_active(player)
-            effects = self.get_poke_effects(player)
-            m = re.match('(move: )?(.*)', args[3])
-            eff = clean_name(m.group(2))
-            if eff == 'typechange':
-                if 'from' in kwargs:
-                    arg = kwargs['from']
-                    if arg == 'move: Reflect Type':
-                        player2,_ = parse_pokemon(kwargs['of'])
-                        p2 = self.get_active(player2)
-                        p.types = p2.types.copy()
-                    else:
-                        if arg == 'Protean' or arg == 'Color Change':
-                            p.set_ability(clean_name(arg))
-                        new_type = clean_name(args[4])
-                        p.types = [new_type]
+
+    @handles('-boost')
+    def handle_boost(self, args, kwargs):
+        player,_ = parse_pokemon(args[2])
+        b = self.get_boosts(player)
+        b[args[3]] += int(args[4])
+        self.check_item_ability(player, kwargs)
+
+    @handles('-unboost')
+    def handle_unboost(self, args, kwargs):
+        player,_ = parse_pokemon(args[2])
+        b = self.get_boosts(player)
+        b[args[3]] -= int(args[4])
+        if player != self.player_num:
+            self.check_item_ability(player, kwargs)
+
+    @handles('-setboost')
+    def handle_setboost(self, args, kwargs):
+        player,_ = parse_pokemon(args[2])
+        amount = int(args[4])
+        #For some reason, anger point sends -setboost 12 instead of 6
+        if amount > 6:
+            amount = 6
+        b = self.get_boosts(player)
+        b[args[3]] = amount
+        if player != self.player_num:
+            self.check_item_ability(player, kwargs)
+
+    @handles('-swapboost')
+    def handle_swapboost(self, args, kwargs):
+        b = self.game_data.boosts
+        opp_b = self.game_data.opp_boosts
+        swap = list(b)
+        if len(args) > 4:
+            swap = args[4].split(', ')
+        for stat in swap:
+            b[stat], opp_b[stat] = opp_b[stat], b[stat]
+
+    @handles('-clearpositiveboost', '-clearnegativeboost')
+    def handle_clearsignedboost(self, args, kwargs):
+        player,_ = parse_pokemon(args[2])
+        b = self.get_boosts(player)
+        for stat in b:
+            if args[1] == '-clearpositiveboost' and b[stat] > 0:
+                b[stat] = 0
+            elif args[1] == '-clearnegativeboost' and b[stat] < 0:
+                b[stat] = 0
+        if player != self.player_num:
+            self.check_item_ability(player, kwargs)
+
+    @handles('-copyboost')
+    def handle_copyboost(self, args, kwargs):
+        b_to = self.game_data.boosts
+        b_from = self.game_data.opp_boosts
+        player,_ = parse_pokemon(args[2])
+        if player != self.player_num:
+            b_to, b_from = b_from, b_to
+        swap = list(b_to)
+        if len(args) > 4:
+            swap = args[4].split(', ')
+        for stat in b_to:
+            b_to[stat] = b_from[stat]
+
+    @handles('-clearboost')
+    def handle_clearboost(self, args, kwargs):
+        player,_ = parse_pokemon(args[2])
+        self.clear_boosts(player)
+        if player != self.player_num:
+            self.check_item_ability(player, kwargs)
+
+    @handles('-invertboost')
+    def handle_invertboost(self, args, kwargs):
+        player,_ = parse_pokemon(args[2])
+        b = self.get_boosts(player)
+        for stat in b:
+            b[stat] = -b[stat]
+        if player != self.player_num:
+            self.check_item_ability(player, kwargs)
+
+    @handles('-clearallboost')
+    def handle_clearallboost(self, args, kwargs):
+        self.clear_boosts(self.player_num)
+        self.clear_boosts(self.other_player())
+
+    @handles('-item')
+    def handle_item(self, args, kwargs):
+        player,_ = parse_pokemon(args[2])
+        if player != self.player_num:
+            self.game_data.opp_active.item = clean_name(args[3])
+
+    @handles('-enditem')
+    def handle_enditem(self, args, kwargs):
+        player,_ = parse_pokemon(args[2])
+        if player != self.player_num:
+            self.game_data.opp_active.item = ''
+
+    @handles('-ability')
+    def handle_ability(self, args, kwargs):
+        player,_ = parse_pokemon(args[2])
+        if player != self.player_num:
+            ability = clean_name(args[3])
+            self.game_data.opp_active.set_ability(ability)
+
+    @handles('-endability')
+    def handle_endability(self, args, kwargs):
+        player,_ = parse_pokemon(args[2])
+        if player != self.player_num:
+            opp = self.game_data.opp_active
+            if len(args) <= 3:
+                opp.update_ability('')
+            #Only remove ability if currently has ability
+            #Needed because -endability is sent after using transform
+            if len(args) > 3 and opp.ability == clean_name(args[3]):
+                opp.update_ability('')
+
+    @handles('-transform')
+    def handle_transform(self, args, kwargs):
+        player,_ = parse_pokemon(args[2])
+        p = self.game_data.active
+        opp = self.game_data.opp_active
+        if player == self.player_num:
+            self.game_data.boosts = self.game_data.opp_boosts.copy()
+            #Update opponent data before transforming because
+            #p.transform copies opponent data
+            opp.set_ability(p.ability)
+            opp.moves = [Move(move.name) for move in p.moves]
+            p.transform(opp)
+        else:
+            self.check_item_ability(player, kwargs)
+            opp.transform(p)
+            self.game_data.opp_boosts = self.game_data.boosts.copy()
+
+    @handles('-zpower')
+    def handle_zpower(self, args, kwargs):
+        player,_ = parse_pokemon(args[2])
+        if player == self.player_num:
+            self.game_data.zmove = True
+        else:
+            self.game_data.opp_zmove = True
+
+    @handles('-mega')
+    def handle_mega(self, args, kwargs):
+        player,_ = parse_pokemon(args[2])
+        if player == self.player_num:
+            self.game_data.mega = True
+        else:
+            self.game_data.opp_mega = True
+            self.game_data.opp_active.item = clean_name(args[4])
+
+    @handles('-start')
+    def handle_start(self, args, kwargs):
+        player,_ = parse_pokemon(args[2])
+        p = self.get_active(player)
+        effects = self.get_poke_effects(player)
+        m = EFFECT_RE.match(args[3])
+        eff = clean_name(m.group(2))
+        if eff == 'typechange':
+            if 'from' in kwargs:
+                arg = kwargs['from']
+                if arg == 'move: Reflect Type':
+                    player2,_ = parse_pokemon(kwargs['of'])
+                    p2 = self.get_active(player2)
+                    p.types = list(p2.types)
                 else:
+                    if arg == 'Protean' or arg == 'Color Change':
+                        p.set_ability(clean_name(arg))
                     new_type = clean_name(args[4])
                     p.types = [new_type]
-            elif eff == 'typeadd':
+            else:
                 new_type = clean_name(args[4])
-                p.types.append(new_type)
-            elif eff in effects:
+                p.types = [new_type]
+        elif eff == 'typeadd':
+            new_type = clean_name(args[4])
+            p.types = list(p.types) + [new_type]
+        elif eff in effects:
+            effects[eff] = True
+        else:
+            self.logger.info('Unknown effect: %s', eff)
+
+    @handles('-end')
+    def handle_end(self, args, kwargs):
+        player,_ = parse_pokemon(args[2])
+        effects = self.get_poke_effects(player)
+        m = EFFECT_RE.match(args[3])
+        eff = clean_name(m.group(2))
+        if eff in effects:
+            effects[eff] = False
+        else:
+            self.logger.info('Unknown effect: %s', eff)
+
+    @handles('-activate')
+    def handle_activate(self, args, kwargs):
+        player,_ = parse_pokemon(args[2])
+        p = self.get_active(player)
+        m = ACTIVATE_RE.match(args[3])
+        eff = clean_name(m.group(2))
+        if m.group(1) == 'ability':
+            p.set_ability(eff)
+        elif m.group(1) == 'item':
+            p.item = eff
+        #Handle some special activations
+        if eff == 'mummy':
+            ofpoke = kwargs['of']
+            ofplayer,_ = parse_pokemon(ofpoke)
+            p2 = self.get_active(ofplayer)
+            old_ability = clean_name(args[4])
+            p2.set_ability(old_ability)
+            p2.update_ability('mummy')
+        elif eff == 'forewarn':
+            name = clean_name(args[4])
+            ofpoke = kwargs['of']
+            ofplayer,_ = parse_pokemon(ofpoke)
+            if ofplayer != self.player_num:
+                #Update opponent moves, replacing the list
+                opp = self.game_data.opp_active
+                opp_moves = list(opp.moves)
+                for i in range(len(opp_moves)):
+                    if opp_moves[i] == None:
+                        opp_moves[i] = Move(name)
+                        break
+                    if opp_moves[i].name == name:
+                        break
+                opp.moves = opp_moves
+        elif eff == 'skillswap':
+            ability1 = clean_name(args[4])
+            ability2 = clean_name(args[5])
+            ofpoke = kwargs['of']
+            ofplayer,_ = parse_pokemon(ofpoke)
+            p2 = self.get_active(ofplayer)
+            p.set_ability(ability2)
+            p.update_ability(ability1)
+            p2.set_ability(ability1)
+            p2.update_ability(ability2)
+
+    @handles('-sidestart')
+    def handle_sidestart(self, args, kwargs):
+        m = SIDE_RE.match(args[2])
+        player = m.group(1)
+        effects = self.get_side_effects(player)
+        m = EFFECT_RE.match(args[3])
+        eff = clean_name(m.group(2))
+        if eff == 'spikes' or eff == 'toxicspikes':
+            effects[eff] += 1
+        else:
+            if eff in effects:
                 effects[eff] = True
-            else:
-                self.logger.info('Unknown effect: %s', eff)
-        if args[1] == '-end':
-            player,_ = parse_pokemon(args[2])
-            effects = self.get_poke_effects(player)
-            m = re.match('(move: )?(.*)', args[3])
-            eff = clean_name(m.group(2))
+
+    @handles('-sideend')
+    def handle_sideend(self, args, kwargs):
+        m = SIDE_RE.match(args[2])
+        player = m.group(1)
+        effects = self.get_side_effects(player)
+        m = EFFECT_RE.match(args[3])
+        eff = clean_name(m.group(2))
+        if eff == 'spikes' or eff == 'toxicspikes':
+            effects[eff] = 0
+        else:
             if eff in effects:
                 effects[eff] = False
-            else:
-                self.logger.info('Unknown effect: %s', eff)
-        if args[1] == '-activate':
-            player,_ = parse_pokemon(args[2])
-            p = self.get_active(player)
-            m = re.match('(?:(move|ability|item): )?(.*)', args[3])
-            eff = clean_name(m.group(2))
-            if m.group(1) == 'ability':
-                p.set_ability(eff)
-            elif m.group(1) == 'item':
-                p.item = eff
-            #Handle some special activations
-            if eff == 'mummy':
-                ofpoke = kwargs['of']
-                ofplayer,_ = parse_pokemon(ofpoke)
-                p2 = self.get_active(ofplayer)
-                old_ability = clean_name(args[4])
-                p2.set_ability(old_ability)
-                p2.update_ability('mummy')
-            elif eff == 'forewarn':
-                name = clean_name(args[4])
-                ofpoke = kwargs['of']
-                ofplayer,_ = parse_pokemon(ofpoke)
-                if ofplayer != self.player_num:
-                    #Update opponent moves
-                    opp_moves = self.game_data.opp_active.moves
-                    for i in range(len(opp_moves)):
-                        if opp_moves[i] == None:
-                            opp_moves[i] = Move(name)
-                            break
-                        if opp_moves[i].name == name:
-                            break
-            elif eff == 'skillswap':
-                ability1 = clean_name(args[4])
-                ability2 = clean_name(args[5])
-                ofpoke = kwargs['of']
-                ofplayer,_ = parse_pokemon(ofpoke)
-                p2 = self.get_active(ofplayer)
-                p.set_ability(ability2)
-                p.update_ability(ability1)
-                p2.set_ability(ability1)
-                p2.update_ability(ability2)
-        if args[1] == '-sidestart':
-            m = re.match('p(1|2): ', args[2])
-            player = m.group(1)
-            effects = self.get_side_effects(player)
-            m = re.match('(move: )?(.*)', args[3])
-            eff = clean_name(m.group(2))
-            if eff == 'spikes' or eff == 'toxicspikes':
-                effects[eff] += 1
-            else:
-                if eff in effects:
-                    effects[eff] = True
-        if args[1] == '-sideend':
-            m = re.match('p(1|2): ', args[2])
-            player = m.group(1)
-            effects = self.get_side_effects(player)
-            m = re.match('(move: )?(.*)', args[3])
-            eff = clean_name(m.group(2))
-            if eff == 'spikes' or eff == 'toxicspikes':
-                effects[eff] = 0
-            else:
-                if eff in effects:
-                    effects[eff] = False
-        if args[1] == '-weather':
-            weather = clean_name(args[2])
-            if weather == 'none':
-                self.game_data.weather = None
-            else:
-                self.game_data.weather = weather
-                self.check_item_ability(self.player_num, kwargs)
-        if args[1] == '-fieldstart':
-            m = re.match('(move: )?(.*)', args[2])
-            eff = clean_name(m.group(2))
-            if eff.endswith('terrain'):
-                self.game_data.terrain = eff
-            else:
-                if eff in self.game_data.field_effects:
-                    self.game_data.field_effects[eff] = True
+
+    @handles('-weather')
+    def handle_weather(self, args, kwargs):
+        weather = clean_name(args[2])
+        if weather == 'none':
+            self.game_data.weather = None
+        else:
+            self.game_data.weather = weather
             self.check_item_ability(self.player_num, kwargs)
-        if args[1] == '-fieldend':
-            m = re.match('(move: )?(.*)', args[2])
-            eff = clean_name(m.group(2))
-            if eff.endswith('terrain'):
-                self.game_data.terrain = None
-            else:
-                if eff in self.game_data.field_effects:
-                    self.game_data.field_effects[eff] = False
+
+    @handles('-fieldstart')
+    def handle_fieldstart(self, args, kwargs):
+        m = EFFECT_RE.match(args[2])
+        eff = clean_name(m.group(2))
+        if eff.endswith('terrain'):
+            self.game_data.terrain = eff
+        else:
+            if eff in self.game_data.field_effects:
+                self.game_data.field_effects[eff] = True
+        self.check_item_ability(self.player_num, kwargs)
+
+    @handles('-fieldend')
+    def handle_fieldend(self, args, kwargs):
+        m = EFFECT_RE.match(args[2])
+        eff = clean_name(m.group(2))
+        if eff.endswith('terrain'):
+            self.game_data.terrain = None
+        else:
+            if eff in self.game_data.field_effects:
+                self.game_data.field_effects[eff] = False
 
     def check_item_ability(self, player, kwargs):
         if 'from' in kwargs:
-            m = re.match('(item|ability): (.*)', kwargs['from'])
+            m = FROM_RE.match(kwargs['from'])
             if m:
                 target = player
                 if 'of' in kwargs:
@@ -552,15 +714,9 @@ class Agent:
     def move_to_features(self, move):
         #features: move index, type (18), category (3), power, accuracy,
         #priority, pp, target (7), disabled
-        features = np.zeros(34)
-        features[0] = self.move_to_ix[move.name]
-        features[1 + self.types[move.move_type]] = 1
-        features[19 + self.move_categories[move.category]] = 1
-        features[22] = move.power
-        features[23] = move.accuracy
-        features[24] = move.priority
+        #Everything except pp and disabled comes from the movedex
+        features = move_static[self.move_to_ix[move.name]].copy()
         features[25] = move.pp
-        features[26 + self.move_targets[move.target]] = 1
         features[33] = move.disabled
         return features
 
@@ -568,20 +724,23 @@ class Agent:
         #features: poke index, ability index, ability known,
         #base stats (6), types (18), level, health, max health, 
         #status (7), item index, item known, stats (5), stats known
-        features = np.zeros(45)
-        features[0] = self.poke_to_ix[poke.name]
+        features = species_static[self.poke_to_ix[poke.name]].copy()
         if poke.ability != None:
             features[1] = self.ability_to_ix[poke.ability]
             features[2] = 1
-        features[3] = poke.base_stats['hp']
-        features[4] = poke.base_stats['atk']
-        features[5] = poke.base_stats['def']
-        features[6] = poke.base_stats['spa']
-        features[7] = poke.base_stats['spd']
-        features[8] = poke.base_stats['spe']
-        for t in poke.types:
-            if t: #poke can be typeless
-                features[9 + self.types[t]] = 1
+        #Base stats and types from the pokedex can be changed in battle
+        if poke.base_stats is not poke.species.base_stats:
+            features[3] = poke.base_stats['hp']
+            features[4] = poke.base_stats['atk']
+            features[5] = poke.base_stats['def']
+            features[6] = poke.base_stats['spa']
+            features[7] = poke.base_stats['spd']
+            features[8] = poke.base_stats['spe']
+        if poke.types is not poke.species.types:
+            features[9:27] = 0
+            for t in poke.types:
+                if t: #poke can be typeless
+                    features[9 + self.types[t]] = 1
         features[27] = poke.level
         features[28] = poke.health
         features[29] = poke.max_health
@@ -612,30 +771,35 @@ class Agent:
         features = np.zeros(931)
         fi = 0
         poke_len = 45
+        #Teams and movesets can be smaller outside of random battles
+        team = self.game_data.team
         for i in range(6):
-            f = self.poke_to_features(self.game_data.team[i])
-            features[fi:fi + poke_len] = f
-            features[fi + poke_len] = 1
+            if i < len(team):
+                f = self.poke_to_features(team[i])
+                features[fi:fi + poke_len] = f
+                features[fi + poke_len] = 1
             fi += poke_len + 1
+        opp_team = self.game_data.opp_team
         for i in range(6):
-            opp = self.game_data.opp_team[i]
-            if opp != None:
-                opp_f = self.poke_to_features(opp, True)
+            if i < len(opp_team) and opp_team[i] != None:
+                opp_f = self.poke_to_features(opp_team[i])
                 features[fi:fi + poke_len] = opp_f
                 features[fi + poke_len] = 1
             fi += poke_len + 1
         move_len = 34
+        moves = self.game_data.active.moves
         for i in range(4):
-            f = self.move_to_features(self.game_data.active.moves[i])
-            features[fi:fi + move_len] = f
-            features[fi + move_len] = 1
+            if i < len(moves):
+                f = self.move_to_features(moves[i])
+                features[fi:fi + move_len] = f
+                features[fi + move_len] = 1
             fi += move_len + 1
+        opp_moves = self.game_data.opp_active.moves
         for i in range(4):
-            opp_move = self.game_data.opp_active.moves[i]
-            if opp_move != None:
-                opp_f = self.move_to_features(opp_move)
-                features[fi:fi + move_len] = f
-                features[fi + move_len ] = 1
+            if i < len(opp_moves) and opp_moves[i] != None:
+                opp_f = self.move_to_features(opp_moves[i])
+                features[fi:fi + move_len] = opp_f
+                features[fi + move_len] = 1
             fi += move_len + 1
         features[fi:fi + 7] = self.game_data.boost_list()
         fi += 7
@@ -669,3 +833,5 @@ class Agent:
         features[fi + 2] = self.game_data.zmove
         features[fi + 3] = self.game_data.opp_zmove
         return features
+
+Agent.build_dispatch()
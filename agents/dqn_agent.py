@@ -1,59 +1,481 @@
+import os
 import random
+import time
+from itertools import chain
+from multiprocessing import shared_memory
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from agents.base_agent import Agent
+from agents.base_agent import Agent, NUM_ACTIONS
+from features import (NUM_FEATURES, POKE_LEN, MOVE_LEN, TEAM, MOVES,
+    BOOSTS)
 from dex import *
 
 class ReplayMemory:
-    def __init__(self, capacity):
-        self.capaciy = capacity
-        self.memory = []
+    """Ring buffer of transitions stored in preallocated NumPy arrays.
+
+    Once full, new transitions overwrite the oldest ones. Samples are drawn
+    uniformly with replacement and returned as new contiguous arrays, which
+    can be passed to torch.from_numpy.
+    """
+    def __init__(self, capacity, obs_size=NUM_FEATURES, seed=None):
+        self.capacity = capacity
+        self.obs_size = obs_size
+        self.obs = self._allocate('obs', (capacity, obs_size), np.float32)
+        self.actions = self._allocate('actions', (capacity,), np.int64)
+        self.rewards = self._allocate('rewards', (capacity,), np.float32)
+        self.next_obs = self._allocate('next_obs', (capacity, obs_size),
+            np.float32)
+        self.dones = self._allocate('dones', (capacity,), np.bool_)
+        #Legal actions in next_obs, none for the end of a battle
+        self.next_masks = self._allocate('next_masks', (capacity, NUM_ACTIONS),
+            np.bool_)
         self.position = 0
+        self.size = 0
+        self.rng = np.random.default_rng(seed)
+
+    def _allocate(self, name, shape, dtype):
+        """Returns the array to store a field in, subclasses can store them
+        elsewhere"""
+        return np.zeros(shape, dtype=dtype)
+
+    def __len__(self):
+        return self.size
 
-    def push(self, replay):
-        if len(self.memory) < self.capacity:
-            self.memory.append(None)
-        self.memory[self.position] = replay
-        self.position = (self.position + 1) % self.capacity
+    def push(self, obs, action, reward, next_obs, done, next_mask):
+        i = self.position
+        self.obs[i] = obs
+        self.actions[i] = action
+        self.rewards[i] = reward
+        self.next_obs[i] = next_obs
+        self.dones[i] = done
+        self.next_masks[i] = next_mask
+        self.position = (i + 1) % self.capacity
+        if self.size < self.capacity:
+            self.size += 1
+
+    def sample_indices(self, batch_size):
+        return self.rng.integers(0, self.size, batch_size)
+
+    def get(self, indices):
+        """Returns obs, actions, rewards, next_obs, dones and next_masks at
+        indices"""
+        return (self.obs[indices], self.actions[indices],
+            self.rewards[indices], self.next_obs[indices], self.dones[indices],
+            self.next_masks[indices])
 
     def sample(self, batch_size):
-        return random.sample(self.memory, batch_size)
+        """Returns obs, actions, rewards, next_obs, dones and next_masks of
+        batch_size random transitions"""
+        return self.get(self.sample_indices(batch_size))
+
+class MmapReplayMemory(ReplayMemory):
+    """ReplayMemory whose arrays are memory-mapped .npy files in a folder,
+    so capacity isn't limited by RAM and the memory survives restarts.
+
+    header.npy holds capacity, observation size, position and size. Opening
+    a folder that already holds a memory of the same capacity and
+    observation size resumes it, without reading the arrays. The header is
+    written after each transition, so a learner that is killed loses at
+    most the transition being pushed. flush() writes everything to disk.
+    """
+    HEADER_LEN = 4
+
+    def __init__(self, path, capacity, obs_size=NUM_FEATURES, seed=None):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        header_file = os.path.join(path, 'header.npy')
+        self.resumed = os.path.exists(header_file)
+        if self.resumed:
+            self.header = np.lib.format.open_memmap(header_file, mode='r+')
+            if (self.header[0], self.header[1]) != (capacity, obs_size):
+                raise ValueError('{} holds a memory of capacity {} and '
+                    'observation size {}'.format(path, self.header[0],
+                    self.header[1]))
+        else:
+            self.header = np.lib.format.open_memmap(header_file, mode='w+',
+                dtype=np.int64, shape=(self.HEADER_LEN,))
+            self.header[:2] = (capacity, obs_size)
+        super().__init__(capacity, obs_size, seed)
+        self.position = int(self.header[2])
+        self.size = int(self.header[3])
+
+    def _allocate(self, name, shape, dtype):
+        filename = os.path.join(self.path, name + '.npy')
+        if self.resumed:
+            array = np.lib.format.open_memmap(filename, mode='r+')
+            if array.shape != shape or array.dtype != dtype:
+                raise ValueError('{} has shape {} and dtype {}'.format(
+                    filename, array.shape, array.dtype))
+            return array
+        #New files are sparse, so disk space is only used as they fill
+        return np.lib.format.open_memmap(filename, mode='w+', dtype=dtype,
+            shape=shape)
+
+    def push(self, obs, action, reward, next_obs, done, next_mask):
+        super().push(obs, action, reward, next_obs, done, next_mask)
+        self.header[2] = self.position
+        self.header[3] = self.size
+
+    def flush(self):
+        for array in (self.obs, self.actions, self.rewards, self.next_obs,
+                self.dones, self.next_masks, self.header):
+            array.flush()
+
+class SumTree:
+    """Binary tree in an array where each node is the sum of its children.
+
+    Leaf i holds the priority of item i. Node 1 is the root, node n has
+    children 2n and 2n + 1, and the leaves start at node size, the capacity
+    rounded up to a power of 2. Updates and lookups take O(log N), and the
+    batched versions do each level for the whole batch at once.
+    """
+    def __init__(self, capacity):
+        self.size = 1
+        while self.size < capacity:
+            self.size *= 2
+        self.depth = self.size.bit_length() - 1
+        self.tree = np.zeros(2 * self.size, dtype=np.float64)
+
+    def total(self):
+        return self.tree[1]
+
+    def get(self, indices):
+        return self.tree[self.size + indices]
+
+    def set(self, index, priority):
+        node = self.size + index
+        self.tree[node] = priority
+        node //= 2
+        tree = self.tree
+        while node:
+            tree[node] = tree[2 * node] + tree[2 * node + 1]
+            node //= 2
+
+    def update(self, indices, priorities):
+        """Sets the priorities of a batch of items"""
+        nodes = self.size + np.asarray(indices)
+        self.tree[nodes] = priorities
+        #Repeated parents get the same sum, so they don't need removing
+        for _ in range(self.depth):
+            nodes //= 2
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values):
+        """Returns the items whose cumulative priority ranges contain values,
+        which should be in [0, total)"""
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        for _ in range(self.depth):
+            left = self.tree[2 * nodes]
+            right = values >= left
+            values -= left * right
+            nodes = 2 * nodes + right
+        return nodes - self.size
+
+class PrioritizedReplayMemory(ReplayMemory):
+    """ReplayMemory that samples transitions in proportion to their priority,
+    |TD error| + eps raised to alpha, using a SumTree.
+
+    New transitions get the highest priority seen so far, so they are
+    sampled at least once. Samples also return importance-sampling weights,
+    normalized so the largest is 1, and the indices to pass to
+    update_priorities with the TD errors of the batch.
+    """
+    def __init__(self, capacity, obs_size=NUM_FEATURES, seed=None, alpha=0.6,
+            beta=0.4, eps=1e-6):
+        super().__init__(capacity, obs_size, seed)
+        self.alpha = alpha
+        self.beta = beta
+        self.eps = eps
+        self.tree = SumTree(capacity)
+        self.max_priority = 1.0
+
+    def push(self, obs, action, reward, next_obs, done, next_mask):
+        self.tree.set(self.position, self.max_priority)
+        super().push(obs, action, reward, next_obs, done, next_mask)
+
+    def sample_indices(self, batch_size):
+        #Stratified: one sample from each of batch_size equal ranges
+        total = self.tree.total()
+        segment = total / batch_size
+        values = (np.arange(batch_size) + self.rng.random(batch_size)) * segment
+        indices = self.tree.find(np.minimum(values, np.nextafter(total, 0)))
+        #Rounding can reach the empty leaves after the last transition
+        return np.minimum(indices, self.size - 1)
+
+    def sample(self, batch_size, beta=None):
+        """Returns obs, actions, rewards, next_obs, dones, next_masks,
+        importance-sampling weights and indices of batch_size transitions"""
+        if beta == None:
+            beta = self.beta
+        indices = self.sample_indices(batch_size)
+        probs = self.tree.get(indices) / self.tree.total()
+        weights = (self.size * probs) ** -beta
+        weights = (weights / weights.max()).astype(np.float32)
+        return self.get(indices) + (weights, indices)
+
+    def update_priorities(self, indices, td_errors):
+        """Sets the priorities of sampled transitions from their TD errors"""
+        priorities = (np.abs(td_errors) + self.eps) ** self.alpha
+        self.tree.update(indices, priorities)
+        self.max_priority = max(self.max_priority, float(priorities.max()))
 
 
 class Network(nn.Module):
-    def __init__(self, poke_len, move_len, item_len, ability_len):
+    """Q network over batches of features from Agent.game_to_features.
+
+    Each of the 12 pokemon and 8 moves is encoded by a small network shared
+    by all slots, and all of them are encoded in one pass over the batch.
+    The encodings and the rest of the features go through a shared layer,
+    then the Q value of using each own move or switching to each own pokemon
+    is computed from that and the move or pokemon's encoding.
+    forward takes (B, 931) inputs and returns (B, 10) Q values.
+    """
+    def __init__(self, poke_len=len(poke_to_ix), move_len=len(move_to_ix),
+            item_len=len(item_to_ix), ability_len=len(ability_to_ix)):
         super().__init__()
         embed_dim = 10
         self.poke_embed = nn.Embedding(poke_len, embed_dim)
         self.ability_embed = nn.Embedding(ability_len, embed_dim)
         self.move_embed = nn.Embedding(move_len, embed_dim)
         self.item_embed = nn.Embedding(item_len, embed_dim)
+        #Scale stats, level and health down to around 1
+        poke_scale = torch.ones(POKE_LEN - 11)
+        poke_scale[0:6] = 0.01
+        poke_scale[24:27] = 0.01
+        self.register_buffer('poke_scale', poke_scale)
+        self.register_buffer('move_scale', torch.tensor(
+            [1] * 21 + [0.01, 0.01, 1, 0.1] + [1] * 8))
         #num poke features, adjusted for embeddings and multiplications
-        p = 45 + embed_dim * 3 - 6
+        p = POKE_LEN + embed_dim * 3 - 6
         h1 = 100
         h2 = 60
         self.poke_fc1 = nn.Linear(p, h1)
         self.poke_fc2 = nn.Linear(h1, h2)
+        #num move features, adjusted for the embedding
+        m = MOVE_LEN + embed_dim - 1
+        m1 = 40
+        self.move_fc1 = nn.Linear(m, m1)
+        field_len = NUM_FEATURES - BOOSTS
+        h = 256
+        self.fc1 = nn.Linear(12 * h2 + 8 * m1 + field_len, h)
+        self.fc2 = nn.Linear(h, h)
+        self.move_q = nn.Linear(h + m1, 1)
+        self.switch_q = nn.Linear(h + h2, 1)
 
     def forward(self, inputs):
-        #inputs has the structure specified in base_agent.to_features
-        pokes = inputs[0:552].reshape([12, 45]).t()
-        self.poke_forward(pokes)
+        #inputs has the structure specified in base_agent.game_to_features
+        B = inputs.shape[0]
+        pokes = inputs[:, TEAM:MOVES].reshape(B, 12, POKE_LEN + 1)
+        moves = inputs[:, MOVES:BOOSTS].reshape(B, 8, MOVE_LEN + 1)
+        p = self.poke_forward(pokes)
+        m = self.move_forward(moves)
+        x = torch.cat((p.reshape(B, -1), m.reshape(B, -1),
+            inputs[:, BOOSTS:]), dim=-1)
+        x = F.relu(self.fc1(x))
+        x = F.relu(self.fc2(x))
+        #Q values of using each own move and switching to each own pokemon
+        move_q = self.move_q(torch.cat((x.unsqueeze(1).expand(-1, 4, -1),
+            m[:, :4]), dim=-1))
+        switch_q = self.switch_q(torch.cat((x.unsqueeze(1).expand(-1, 6, -1),
+            p[:, :6]), dim=-1))
+        return torch.cat((move_q, switch_q), dim=1).squeeze(-1)
 
     def poke_forward(self, inputs):
+        #inputs is (B, 12, 46), with the poke known feature last
         #Deal with missing data by multiplying features with a "known" feature
+        index = inputs[..., [0, 1, 37]].long()
         x = torch.cat((
-            self.poke_embed(inputs[0]),
-            torch.mul(self.ability_embed(inputs[1]), inputs[2]),
-            inputs[3:37],
-            torch.mul(self.item_embed(inputs[37]), inputs[38]),
-            torch.mul(inputs[39:44], inputs[44]))
+            self.poke_embed(index[..., 0]),
+            self.ability_embed(index[..., 1]) * inputs[..., 2:3],
+            inputs[..., 3:37] * self.poke_scale,
+            self.item_embed(index[..., 2]) * inputs[..., 38:39],
+            inputs[..., 39:44] * 0.01 * inputs[..., 44:45])
         , dim=-1)
         x = F.relu(self.poke_fc1(x))
         x = F.relu(self.poke_fc2(x))
-        x = torch.mul(x, inputs[45])
-        return x
+        return x * inputs[..., 45:46]
+
+    def move_forward(self, inputs):
+        #inputs is (B, 8, 35), with the move known feature last
+        x = torch.cat((
+            self.move_embed(inputs[..., 0].long()),
+            inputs[..., 1:34] * self.move_scale)
+        , dim=-1)
+        x = F.relu(self.move_fc1(x))
+        return x * inputs[..., 34:35]
+
+class SharedWeights:
+    """Network weights in shared memory, published by a learner and read by
+    actors in other processes without serializing them.
+
+    The memory holds a counter followed by every tensor of the state dict.
+    publish makes the counter odd, copies the weights in and makes it even
+    again, so the version is counter // 2, and a reader that sees the same
+    even counter before and after copying got one version (a seqlock).
+    load makes such a copy. bind instead makes a network's tensors views of
+    the shared memory, so it always has the newest weights without copying,
+    but it can run on a mix of two versions while they are written.
+
+    Pickling a SharedWeights attaches to the same memory, so it can be
+    passed to other processes. The process that created it should unlink
+    it when done.
+    """
+    def __init__(self, network):
+        self.layout = []
+        offset = 8
+        for key, tensor in network.state_dict().items():
+            self.layout.append((key, offset, tuple(tensor.shape),
+                str(tensor.numpy().dtype)))
+            #Keep every tensor 8 byte aligned
+            offset += -(-tensor.numel() * tensor.element_size() // 8) * 8
+        self.shm = shared_memory.SharedMemory(create=True, size=offset)
+        self.attach()
+        self.counter[0] = 0
+        self.write(network)
+
+    def attach(self):
+        buf = self.shm.buf
+        self.counter = np.ndarray((1,), dtype=np.int64, buffer=buf)
+        self.arrays = {key:np.ndarray(shape, dtype=dtype, buffer=buf,
+            offset=offset) for key, offset, shape, dtype in self.layout}
+
+    def __getstate__(self):
+        return (self.shm.name, self.layout)
+
+    def __setstate__(self, state):
+        name, self.layout = state
+        self.shm = shared_memory.SharedMemory(name=name)
+        self.attach()
+
+    def version(self):
+        """Returns the number of times weights were published"""
+        return int(self.counter[0]) // 2
+
+    def write(self, network):
+        for key, tensor in network.state_dict().items():
+            np.copyto(self.arrays[key], tensor.detach().numpy())
+
+    def publish(self, network):
+        """Copies the weights of network in, returns the new version"""
+        count = int(self.counter[0])
+        self.counter[0] = count + 1
+        self.write(network)
+        self.counter[0] = count + 2
+        return count // 2 + 1
+
+    def load(self, network):
+        """Copies the newest weights into network, returns their version"""
+        state_dict = network.state_dict()
+        with torch.no_grad():
+            while True:
+                count = int(self.counter[0])
+                if count % 2:
+                    time.sleep(0)
+                    continue
+                for key, tensor in state_dict.items():
+                    tensor.copy_(torch.from_numpy(self.arrays[key]))
+                if int(self.counter[0]) == count:
+                    return count // 2
+
+    def bind(self, network):
+        """Makes the parameters and buffers of network views of the shared
+        weights"""
+        for key, tensor in chain(network.named_parameters(),
+                network.named_buffers()):
+            tensor.data = torch.from_numpy(self.arrays[key])
+
+    def close(self):
+        """Detaches from the memory, after any bound networks are gone"""
+        self.counter = None
+        self.arrays = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+class QPolicy:
+    """Policy for InferenceServer that picks the legal action with the
+    highest Q value, from a network mapping (B, 931) to (B, 10) Q values"""
+    def __init__(self, network):
+        self.network = network
+
+    def __call__(self, obs, masks):
+        with torch.no_grad():
+            q = self.network(torch.from_numpy(obs)).numpy()
+        q[~masks] = -np.inf
+        return q.argmax(axis=1)
 
 class DQNAgent(Agent):
-    pass
+    """Agent that chooses the legal action with the highest Q value, or a
+    random legal action with probability epsilon.
+
+    Each decision completes the transition from the previous one with
+    reward 0, and end_battle completes the last one with the result of the
+    battle. take_transitions returns and clears the completed transitions.
+    """
+    def __init__(self, player_name, network=None, epsilon=0.1):
+        self.network = network or Network()
+        self.epsilon = epsilon
+        self.transitions = []
+        self.last = None
+        super().__init__(player_name)
+
+    def init_battle(self):
+        super().init_battle()
+        self.last = None
+
+    def select_action(self, obs, mask):
+        legal = np.flatnonzero(mask)
+        if len(legal) == 0:
+            #Only struggle is left, which is chosen as the first move
+            return 0
+        if random.random() < self.epsilon:
+            return int(random.choice(legal))
+        with torch.no_grad():
+            q = self.network(torch.from_numpy(obs).unsqueeze(0))[0].numpy()
+        q[~mask] = -np.inf
+        return int(q.argmax())
+
+    def choose_action(self):
+        if self.wait_game:
+            return None
+        if self.choose_start:
+            choice = 'team 1'
+        else:
+            obs = self.game_to_features().astype(np.float32)
+            mask = self.legal_actions()
+            action = self.select_action(obs, mask)
+            if self.last != None:
+                self.transitions.append(self.last + (0, obs, False, mask))
+            self.last = (obs, action)
+            choice = self.action_to_choice(action)
+        self.wait_game = True
+        self.force_switch = False
+        self.choose_start = False
+        return choice
+
+    def end_battle(self, reward):
+        """Completes the last transition of the battle"""
+        if self.last != None:
+            obs = self.last[0]
+            self.transitions.append(self.last + (reward, np.zeros_like(obs),
+                True, np.zeros(NUM_ACTIONS, dtype=bool)))
+            self.last = None
+
+    def take_transitions(self):
+        """Returns obs, actions, rewards, next_obs, dones and next_masks
+        arrays of the completed transitions, and clears them"""
+        transitions = self.transitions
+        self.transitions = []
+        if not transitions:
+            obs = np.zeros((0, NUM_FEATURES), dtype=np.float32)
+            return (obs, np.zeros(0, dtype=np.int64),
+                np.zeros(0, dtype=np.float32), obs, np.zeros(0, dtype=bool),
+                np.zeros((0, NUM_ACTIONS), dtype=bool))
+        obs, actions, rewards, next_obs, dones, next_masks = zip(*transitions)
+        return (np.stack(obs), np.array(actions, dtype=np.int64),
+            np.array(rewards, dtype=np.float32), np.stack(next_obs),
+            np.array(dones, dtype=bool), np.stack(next_masks))
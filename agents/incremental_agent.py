@@ -0,0 +1,39 @@
+import numpy as np
+from agents.base_agent import Agent
+from features import FeatureBuffer
+
+class IncrementalAgent(Agent):
+    """Agent that keeps its features up to date as it handles messages,
+    instead of rebuilding them in game_to_features.
+
+    With check set, every call to game_to_features is compared with a full
+    rebuild and a mismatch raises RuntimeError.
+    """
+    def __init__(self, player_name, check=False):
+        #Agent.__init__ calls init_battle, which uses the buffer
+        self.check = check
+        self.feature_buffer = FeatureBuffer()
+        super().__init__(player_name)
+
+    def init_battle(self):
+        super().init_battle()
+        self.feature_buffer.mark_all()
+
+    def restore(self, snapshot):
+        super().restore(snapshot)
+        self.feature_buffer.mark_all()
+
+    def process_args(self, args, kwargs):
+        super().process_args(args, kwargs)
+        if args[1] in self.dispatch:
+            self.feature_buffer.mark_event(args[1])
+
+    def game_to_features(self):
+        features = self.feature_buffer.read(self.game_data).copy()
+        if self.check:
+            expected = super().game_to_features()
+            diff = np.flatnonzero(features != expected)
+            if len(diff):
+                raise RuntimeError(
+                    'Incremental features differ at {}'.format(diff.tolist()))
+        return features
@@ -0,0 +1,142 @@
+import logging
+import argparse
+import asyncio
+import time
+from agents.base_agent import Agent
+from sim import SimRunner
+from sim_io import SIM_COMMAND
+
+class AsyncSimProcess:
+    """asyncio version of sim_io.SimProcess"""
+    def __init__(self, proc):
+        self.proc = proc
+
+    @classmethod
+    async def spawn(cls, command=SIM_COMMAND):
+        #Requests for a full team are a few kB, leave plenty of room
+        proc = await asyncio.create_subprocess_exec(*command,
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+            limit=2 ** 20)
+        return cls(proc)
+
+    def write(self, message):
+        self.proc.stdin.write(message.encode() + b'\n')
+
+    async def drain(self):
+        await self.proc.stdin.drain()
+
+    async def read_chunk(self, timeout=None):
+        """Returns the next chunk as a list of lines. Raises TimeoutError if
+        none arrives within timeout seconds and EOFError if the simulator
+        exits."""
+        try:
+            return await asyncio.wait_for(self._read_chunk(), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError('No output from simulator')
+
+    async def _read_chunk(self):
+        chunk = b''
+        while not chunk:
+            try:
+                chunk = await self.proc.stdout.readuntil(b'\n\n')
+            except asyncio.IncompleteReadError:
+                raise EOFError('Simulator exited')
+            chunk = chunk.strip(b'\n')
+        return chunk.decode().split('\n')
+
+    async def close(self):
+        self.proc.stdin.close()
+        try:
+            self.proc.terminate()
+        except ProcessLookupError:
+            pass
+        await self.proc.wait()
+
+class AsyncSimRunner(SimRunner):
+    """SimRunner whose simulator is driven from an asyncio event loop, so
+    one process can keep many simulators busy"""
+    def spawn_sim(self):
+        #Spawned by start, since a subprocess can't be awaited here
+        return None
+
+    async def read_sim(self):
+        return await self.sim.read_chunk()
+
+    async def start(self, game_format='random', p1team=None, p2team=None,
+            seed=None):
+        if self.sim is None:
+            self.sim = await AsyncSimProcess.spawn()
+        messages = self.start_messages(game_format, p1team, p2team, seed)
+        for message in messages or []:
+            self.write_sim(message)
+        await self.sim.drain()
+
+    async def run_until_request(self, silent=True):
+        requested = False
+        while True:
+            chunk = await self.read_sim()
+            self.process_chunk(chunk, silent=silent)
+            if self.waiting_for_input(chunk, requested):
+                break
+            requested = requested or chunk[0] == 'sideupdate'
+
+    async def run_actions(self, silent=True):
+        for message in self.choose_actions(silent=silent):
+            self.write_sim(message)
+        await self.sim.drain()
+
+    async def run_game(self, game_format='random', silent=True, seed=None):
+        self.reset_game()
+        await self.start(game_format=game_format, seed=seed)
+        while not self.game_end:
+            await self.run_until_request(silent=silent)
+            await self.run_actions(silent=silent)
+
+    async def clean_up(self):
+        if self.sim is not None:
+            await self.sim.close()
+
+async def run_games(num_battles, num_games, agent_class=Agent, p1name='p1',
+        p2name='p2', game_format='random'):
+    """Plays num_games games over num_battles concurrent simulators and
+    returns the results of every game"""
+    results = []
+    games = iter(range(num_games))
+
+    async def battle(battle_id):
+        agent1 = agent_class(p1name)
+        agent2 = agent_class(p2name)
+        sim_runner = AsyncSimRunner(agent1, agent2)
+        try:
+            #Each battle takes the next game until there are none left
+            for game in games:
+                agent1.init_battle()
+                agent2.init_battle()
+                start = time.time()
+                await sim_runner.run_game(game_format=game_format)
+                results.append({
+                    'battle': battle_id,
+                    'game': game,
+                    'winner': sim_runner.winner,
+                    'turns': sim_runner.turns,
+                    'time': time.time() - start
+                })
+        finally:
+            await sim_runner.clean_up()
+
+    await asyncio.gather(*(battle(i) for i in range(num_battles)))
+    return results
+
+if __name__ == '__main__':
+    logging.basicConfig(filename='showdown.log', level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-b', '--battles', type=int, default=32,
+        help='Number of simulators to run at once')
+    parser.add_argument('-n', '--games', type=int, default=100,
+        help='Total number of games to play')
+    args = parser.parse_args()
+    start = time.time()
+    results = asyncio.run(run_games(args.battles, args.games))
+    elapsed = time.time() - start
+    print('Played {} games in {:.2f}s ({:.2f} battles/sec)'.format(
+        len(results), elapsed, len(results) / elapsed))
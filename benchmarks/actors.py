@@ -0,0 +1,65 @@
+import sys
+import argparse
+import json
+import queue
+import time
+import multiprocessing
+from agents.dqn_agent import Network, SharedWeights
+from train import run_actor
+
+def run(num_actors, seconds, game_format='random'):
+    """Returns games/sec and transitions/sec of num_actors actors whose
+    transitions are read and thrown away, as if the learner kept up"""
+    transitions = multiprocessing.Queue(4 * num_actors)
+    weights = SharedWeights(Network())
+    stop = multiprocessing.Event()
+    actors = [multiprocessing.Process(target=run_actor, args=(i, num_actors,
+        transitions, weights, stop, game_format))
+        for i in range(num_actors)]
+    for actor in actors:
+        actor.start()
+    #Start timing at the first game, after the actors have started up
+    _, _, batch = transitions.get()
+    start = time.perf_counter()
+    games = 0
+    pushed = 0
+    while time.perf_counter() - start < seconds:
+        try:
+            _, _, batch = transitions.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        games += 1
+        pushed += len(batch[0])
+    elapsed = time.perf_counter() - start
+    stop.set()
+    while any(actor.is_alive() for actor in actors):
+        try:
+            transitions.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    for actor in actors:
+        actor.join()
+    weights.close()
+    weights.unlink()
+    return {
+        'games_per_sec': games / elapsed,
+        'transitions_per_sec': pushed / elapsed
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Measure how actor throughput scales with actor count')
+    parser.add_argument('-a', '--actors', type=int, nargs='+',
+        default=[1, 2, 4, multiprocessing.cpu_count()])
+    parser.add_argument('-t', '--time', type=float, default=10,
+        help='Seconds to measure each actor count for')
+    args = parser.parse_args()
+    report = {}
+    for n in args.actors:
+        report[n] = run(n, args.time)
+    #Efficiency is throughput per actor relative to a single actor
+    base = report[args.actors[0]]['games_per_sec'] / args.actors[0]
+    for n in args.actors:
+        report[n]['efficiency'] = report[n]['games_per_sec'] / (n * base)
+    json.dump(report, sys.stdout, indent=2)
+    print()
@@ -0,0 +1,79 @@
+import sys
+import argparse
+import copy
+import json
+import random
+import time
+from agents.base_agent import Agent
+from pokemon import GameData, ArrayGameData
+from benchmarks.dispatch import load
+from benchmarks.featurize import random_game
+
+def state(agent):
+    return (agent.wait_game, agent.force_switch, str(agent.game_data.team),
+        str(agent.game_data.opp_team), agent.game_to_features().tolist())
+
+def check(game_data_class, game):
+    """Replays a recorded game, taking a snapshot halfway. Checks that
+    restoring it at the end gives the state at the snapshot."""
+    agent = Agent(game['player_name'])
+    agent.game_data = game_data_class()
+    messages = game['messages']
+    half = len(messages) // 2
+    for message in messages[:half]:
+        agent.process_message(message)
+    snapshot = agent.snapshot()
+    before = state(agent)
+    for message in messages[half:]:
+        agent.process_message(message)
+    agent.restore(snapshot)
+    if state(agent) != before:
+        raise RuntimeError('Restored state differs from the snapshot')
+
+def per_sec(f, number, rounds=5):
+    """Returns calls/sec of f in the fastest of a few rounds"""
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(number // rounds):
+            f()
+        t = time.perf_counter() - start
+        if best == None or t < best:
+            best = t
+    return (number // rounds) / best
+
+def run(number, seed, games=()):
+    """Times snapshots and restores of agents in random mid-battle states,
+    with full teams. Recorded games are used to check restoring first."""
+    report = {}
+    for name, game_data_class in (('dicts', GameData),
+            ('arrays', ArrayGameData)):
+        for game in games:
+            check(game_data_class, game)
+        agent = Agent('p1')
+        agent.game_data = random_game(random.Random(seed), game_data_class)
+        snapshot = agent.snapshot()
+        report[name] = {
+            'snapshots_per_sec': per_sec(agent.snapshot, number),
+            'restores_per_sec': per_sec(lambda: agent.restore(snapshot),
+                number)
+        }
+    game_data = random_game(random.Random(seed))
+    report['deepcopy_per_sec'] = per_sec(lambda: copy.deepcopy(game_data),
+        max(number // 100, 1))
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Measure snapshot and restore speed of the tracked '
+            'battle state')
+    parser.add_argument('-n', '--number', type=int, default=100000,
+        help='Number of snapshots and restores to time')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+        help='Seed for the random battle state')
+    parser.add_argument('-c', '--corpus',
+        help='Games recorded by benchmarks.dispatch to check restoring with')
+    args = parser.parse_args()
+    games = load(args.corpus) if args.corpus else ()
+    json.dump(run(args.number, args.seed, games), sys.stdout, indent=2)
+    print()
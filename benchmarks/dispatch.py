@@ -0,0 +1,89 @@
+import sys
+import argparse
+import json
+import random
+import time
+from agents.base_agent import Agent
+from sim import SimRunner
+
+class LinearAgent(Agent):
+    """Agent that finds handlers like the old if-chain in process_args did,
+    comparing the message type against every handled type in turn"""
+    def process_args(self, args, kwargs):
+        for message_type, handler in self.chain:
+            if args[1] == message_type:
+                handler(self, args, kwargs)
+
+LinearAgent.chain = list(LinearAgent.dispatch.items())
+
+def record(path, num_games, seed):
+    """Plays num_games games and writes the messages each agent received,
+    one game per line"""
+    agent1 = Agent('p1')
+    agent2 = Agent('p2')
+    sim_runner = SimRunner(agent1, agent2)
+    messages = {'1':[], '2':[]}
+
+    def listener(player, event):
+        for p in ('1', '2'):
+            if player == None or player == p:
+                messages[p].append(event.line)
+
+    sim_runner.add_listener(listener)
+    with open(path, 'w') as f:
+        for game in range(num_games):
+            random.seed(seed + game)
+            agent1.init_battle()
+            agent2.init_battle()
+            sim_runner.run_game(seed=[seed + game, seed, game, 1])
+            for p, agent in (('1', agent1), ('2', agent2)):
+                line = {'player_name':agent.player_name, 'messages':messages[p]}
+                f.write(json.dumps(line) + '\n')
+                messages[p] = []
+    sim_runner.clean_up()
+
+def load(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+def replay(agent_class, games, repeat):
+    """Feeds the recorded messages to agents, returns messages/sec"""
+    agents = {}
+    total = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for game in games:
+            name = game['player_name']
+            if name not in agents:
+                agents[name] = agent_class(name)
+            agent = agents[name]
+            agent.init_battle()
+            for message in game['messages']:
+                agent.process_message(message)
+            total += len(game['messages'])
+    return total / (time.perf_counter() - start)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Measure message handling speed on a recorded corpus')
+    parser.add_argument('corpus', help='File of recorded games')
+    parser.add_argument('--record', type=int, metavar='GAMES',
+        help='Record this many games to the corpus file first')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+        help='Seed for recording games')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+        help='Number of times to replay the corpus')
+    args = parser.parse_args()
+    if args.record:
+        record(args.corpus, args.record, args.seed)
+    games = load(args.corpus)
+    before = replay(LinearAgent, games, args.repeat)
+    after = replay(Agent, games, args.repeat)
+    report = {
+        'messages': sum(len(g['messages']) for g in games),
+        'linear_messages_per_sec': before,
+        'dispatch_messages_per_sec': after,
+        'speedup': after / before
+    }
+    json.dump(report, sys.stdout, indent=2)
+    print()
@@ -0,0 +1,78 @@
+import sys
+import argparse
+import json
+import random
+import time
+from agents.base_agent import Agent
+from features import BatchFeaturizer
+from pokemon import Pokemon, Move, GameData
+from dex import *
+
+def random_pokemon(rng, names, moves):
+    name = rng.choice(names)
+    p = Pokemon.from_details(name, name, '{}/100'.format(rng.randint(0, 100)))
+    p.moves = [Move(rng.choice(moves)) for i in range(4)]
+    p.status = rng.choice([None, 'brn', 'par', 'tox'])
+    p.item = rng.choice([None, ''] + list(itemdex))
+    if rng.random() < 0.5:
+        p.stats = {stat:rng.randint(50, 300)
+            for stat in ['atk', 'def', 'spa', 'spd', 'spe']}
+    return p
+
+def random_game(rng, game_data_class=GameData):
+    """Returns a GameData in a random mid-battle state"""
+    names = list(pokedex)
+    moves = list(movedex)
+    g = game_data_class()
+    g.team = [random_pokemon(rng, names, moves) for i in range(6)]
+    g.active = g.team[0]
+    g.opp_team = [random_pokemon(rng, names, moves) if i < rng.randint(1, 6)
+        else None for i in range(6)]
+    g.opp_active = g.opp_team[0]
+    g.opp_active.moves[rng.randint(0, 3):] = [None] * 2
+    for stat in g.boosts_:
+        g.boosts[stat] = rng.randint(-6, 6)
+        g.opp_boosts[stat] = rng.randint(-6, 6)
+    for eff in g.poke_effects_:
+        g.poke_effects[eff] = rng.random() < 0.1
+    g.side_effects['spikes'] = rng.randint(0, 3)
+    g.weather = rng.choice([None] + g.weathers_)
+    g.terrain = rng.choice([None] + g.terrains_)
+    g.mega = rng.random() < 0.5
+    return g
+
+def run(batch_sizes, repeat, seed):
+    rng = random.Random(seed)
+    featurizer = BatchFeaturizer()
+    agent = Agent('p1')
+    report = {}
+    for B in batch_sizes:
+        games = [random_game(rng) for i in range(B)]
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for g in games:
+                agent.game_data = g
+                agent.game_to_features()
+        loop = (time.perf_counter() - start) / repeat
+        start = time.perf_counter()
+        for _ in range(repeat):
+            featurizer.featurize(games)
+        batched = (time.perf_counter() - start) / repeat
+        report[B] = {
+            'game_to_features_ms': loop * 1000,
+            'batch_featurizer_ms': batched * 1000,
+            'speedup': loop / batched
+        }
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare batched featurizing with game_to_features')
+    parser.add_argument('-b', '--batch-sizes', type=int, nargs='+',
+        default=[1, 64, 1024])
+    parser.add_argument('-r', '--repeat', type=int, default=10)
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    args = parser.parse_args()
+    json.dump(run(args.batch_sizes, args.repeat, args.seed), sys.stdout,
+        indent=2)
+    print()
@@ -0,0 +1,55 @@
+import sys
+import argparse
+import json
+import time
+from agents.base_agent import Agent
+from agents.incremental_agent import IncrementalAgent
+from benchmarks.dispatch import load
+
+def replay(agent_class, games, repeat, **kwargs):
+    """Feeds the recorded messages to agents and builds features at the start
+    of every turn, returns the time spent in game_to_features per call in ms
+    and the total time"""
+    agents = {}
+    calls = 0
+    feature_time = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for game in games:
+            name = game['player_name']
+            if name not in agents:
+                agents[name] = agent_class(name, **kwargs)
+            agent = agents[name]
+            agent.init_battle()
+            for message in game['messages']:
+                agent.process_message(message)
+                if message.startswith('|turn|'):
+                    t = time.perf_counter()
+                    agent.game_to_features()
+                    feature_time += time.perf_counter() - t
+                    calls += 1
+    return feature_time / calls * 1000, time.perf_counter() - start
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare incremental and full feature building on a '
+            'corpus recorded by benchmarks.dispatch')
+    parser.add_argument('corpus', help='File of recorded games')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+        help='Number of times to replay the corpus')
+    args = parser.parse_args()
+    games = load(args.corpus)
+    #Raises if the incremental features ever differ from a full rebuild
+    replay(IncrementalAgent, games, 1, check=True)
+    full_ms, full_total = replay(Agent, games, args.repeat)
+    incremental_ms, incremental_total = replay(IncrementalAgent, games,
+        args.repeat)
+    report = {
+        'full_features_ms': full_ms,
+        'incremental_features_ms': incremental_ms,
+        'features_speedup': full_ms / incremental_ms,
+        'full_total_sec': full_total,
+        'incremental_total_sec': incremental_total
+    }
+    json.dump(report, sys.stdout, indent=2)
+    print()
@@ -0,0 +1,76 @@
+import sys
+import argparse
+import json
+import multiprocessing
+import random
+import time
+import numpy as np
+import torch
+from agents.base_agent import NUM_ACTIONS
+from agents.dqn_agent import Network, QPolicy
+from features import BatchFeaturizer
+from inference import InferenceServer, InferenceClient
+from benchmarks.featurize import random_game
+
+SOCKET_PATH = '/tmp/pokemon-rl-inference-bench.sock'
+
+def make_network():
+    torch.manual_seed(0)
+    return Network()
+
+def client(num_requests, seed):
+    obs = BatchFeaturizer().featurize([random_game(random.Random(seed))])[0]
+    mask = np.ones(NUM_ACTIONS, dtype=bool)
+    c = InferenceClient(SOCKET_PATH)
+    for _ in range(num_requests):
+        c.act(obs, mask)
+    c.close()
+
+def serve(num_clients, num_requests, max_batch, max_wait):
+    """Returns requests/sec and server stats for clients in separate
+    processes, each waiting for its action before sending the next
+    request like an agent in a battle"""
+    torch.set_num_threads(1)
+    server = InferenceServer(QPolicy(make_network()), SOCKET_PATH, max_batch,
+        max_wait)
+    server.start()
+    start = time.perf_counter()
+    with multiprocessing.Pool(num_clients) as pool:
+        pool.starmap(client, [(num_requests, i) for i in range(num_clients)])
+    elapsed = time.perf_counter() - start
+    server.close()
+    report = server.stats()
+    report['requests_per_sec'] = num_clients * num_requests / elapsed
+    return report
+
+def single(num_requests):
+    """Returns forward passes/sec of the policy on one observation at a time,
+    in process"""
+    torch.set_num_threads(1)
+    policy = QPolicy(make_network())
+    obs = BatchFeaturizer().featurize([random_game(random.Random(0))])
+    mask = np.ones((1, NUM_ACTIONS), dtype=bool)
+    start = time.perf_counter()
+    for _ in range(num_requests):
+        policy(obs, mask)
+    return num_requests / (time.perf_counter() - start)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Measure the dynamic-batching inference server')
+    parser.add_argument('-c', '--clients', type=int, default=16,
+        help='Number of client processes')
+    parser.add_argument('-n', '--requests', type=int, default=500,
+        help='Requests sent by each client')
+    parser.add_argument('-b', '--max-batch', type=int, default=64)
+    parser.add_argument('-w', '--max-wait', type=float, default=2,
+        help='Longest wait for a batch to fill, in ms')
+    args = parser.parse_args()
+    report = {
+        'single_forward_per_sec': single(args.requests),
+        'unbatched': serve(args.clients, args.requests, 1, 0),
+        'batched': serve(args.clients, args.requests, args.max_batch,
+            args.max_wait / 1000)
+    }
+    json.dump(report, sys.stdout, indent=2)
+    print()
@@ -0,0 +1,67 @@
+import sys
+import argparse
+import json
+import random
+import time
+import torch
+import torch.nn.functional as F
+from agents.base_agent import NUM_ACTIONS
+from agents.dqn_agent import Network
+from features import BatchFeaturizer
+from benchmarks.featurize import random_game
+
+def run(batch_sizes, repeat, threads, seed):
+    torch.set_num_threads(threads)
+    torch.manual_seed(seed)
+    rng = random.Random(seed)
+    network = Network()
+    optimizer = torch.optim.Adam(network.parameters())
+    featurizer = BatchFeaturizer()
+    report = {}
+    for B in batch_sizes:
+        inputs = torch.from_numpy(featurizer.featurize(
+            [random_game(rng) for i in range(B)]))
+        actions = torch.randint(0, NUM_ACTIONS, (B,))
+        targets = torch.randn(B)
+        #One observation at a time, as the network had to be called before
+        with torch.no_grad():
+            start = time.perf_counter()
+            for _ in range(repeat):
+                for i in range(B):
+                    network(inputs[i:i + 1])
+            loop = (time.perf_counter() - start) / repeat
+            start = time.perf_counter()
+            for _ in range(repeat):
+                network(inputs)
+            forward = (time.perf_counter() - start) / repeat
+        start = time.perf_counter()
+        for _ in range(repeat):
+            q = network(inputs).gather(1, actions.unsqueeze(1)).squeeze(1)
+            loss = F.smooth_l1_loss(q, targets)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+        train = (time.perf_counter() - start) / repeat
+        report[B] = {
+            'per_observation_ms': loop * 1000,
+            'forward_ms': forward * 1000,
+            'forward_per_sec': B / forward,
+            'speedup': loop / forward,
+            'train_step_ms': train * 1000,
+            'train_per_sec': B / train
+        }
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Measure Network throughput at training batch sizes')
+    parser.add_argument('-b', '--batch-sizes', type=int, nargs='+',
+        default=[1, 32, 128, 512])
+    parser.add_argument('-r', '--repeat', type=int, default=10)
+    parser.add_argument('-t', '--threads', type=int, default=1,
+        help='Number of torch threads')
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    args = parser.parse_args()
+    json.dump(run(args.batch_sizes, args.repeat, args.threads, args.seed),
+        sys.stdout, indent=2)
+    print()
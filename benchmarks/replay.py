@@ -0,0 +1,71 @@
+import sys
+import argparse
+import json
+import time
+import numpy as np
+from agents.base_agent import NUM_ACTIONS
+from agents.dqn_agent import (ReplayMemory, PrioritizedReplayMemory,
+    MmapReplayMemory)
+
+def per_call_ms(f, number):
+    start = time.perf_counter()
+    for _ in range(number):
+        f()
+    return (time.perf_counter() - start) / number * 1000
+
+def run(capacity, obs_size, batch_size, number, seed, mmap_path=None):
+    """Fills replay memories to capacity, then times pushes, samples and
+    priority updates. With mmap_path, a memory-mapped memory in that
+    folder is also timed, including how long reopening it takes."""
+    rng = np.random.default_rng(seed)
+    obs = rng.random(obs_size, dtype=np.float32)
+    mask = np.ones(NUM_ACTIONS, dtype=bool)
+    report = {}
+    memories = [('uniform', ReplayMemory, ()),
+        ('prioritized', PrioritizedReplayMemory, ())]
+    if mmap_path:
+        memories.append(('mmap', MmapReplayMemory, (mmap_path,)))
+    for name, memory_class, args in memories:
+        memory = memory_class(*args, capacity, obs_size, seed=seed)
+        start = time.perf_counter()
+        for i in range(capacity):
+            memory.push(obs, i % 10, 0.0, obs, False, mask)
+        fill = time.perf_counter() - start
+        result = {
+            'pushes_per_sec': capacity / fill,
+            'sample_ms': per_call_ms(lambda: memory.sample(batch_size), number)
+        }
+        if memory_class == PrioritizedReplayMemory:
+            def update():
+                indices = memory.sample_indices(batch_size)
+                memory.update_priorities(indices, rng.random(batch_size))
+            result['sample_and_update_ms'] = per_call_ms(update, number)
+        if memory_class == MmapReplayMemory:
+            memory.flush()
+            del memory
+            start = time.perf_counter()
+            memory = MmapReplayMemory(mmap_path, capacity, obs_size)
+            result['reopen_sec'] = time.perf_counter() - start
+            result['resumed_size'] = memory.size
+        report[name] = result
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Measure uniform and prioritized replay memory speed')
+    parser.add_argument('-c', '--capacity', type=int, default=2**20,
+        help='Number of transitions stored')
+    parser.add_argument('-f', '--obs-size', type=int, default=32,
+        help='Observation size, the full 931 needs about 7.5GB at 1M')
+    parser.add_argument('-b', '--batch-size', type=int, default=256)
+    parser.add_argument('-n', '--number', type=int, default=200,
+        help='Number of samples and updates to time')
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    parser.add_argument('-m', '--mmap',
+        help='Folder for a memory-mapped memory, which must not hold one of '
+            'a different size')
+    args = parser.parse_args()
+    report = run(args.capacity, args.obs_size, args.batch_size, args.number,
+        args.seed, args.mmap)
+    json.dump(report, sys.stdout, indent=2)
+    print()
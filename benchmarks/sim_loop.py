@@ -0,0 +1,126 @@
+import sys
+import argparse
+import json
+import random
+import time
+import numpy as np
+from agents.base_agent import Agent
+from sim import SimRunner
+
+STAGES = ['sim_wait', 'process_message', 'choose_action', 'write_sim']
+
+class StageTimer:
+    """Adds up the time spent in each stage of the current turn"""
+    def __init__(self):
+        self.totals = {stage:0 for stage in STAGES}
+        self.turn = {stage:0 for stage in STAGES}
+        self.turns = {stage:[] for stage in STAGES}
+        self.messages = 0
+
+    def add(self, stage, t):
+        self.turn[stage] += t
+
+    def end_turn(self):
+        for stage in STAGES:
+            self.totals[stage] += self.turn[stage]
+            self.turns[stage].append(self.turn[stage])
+            self.turn[stage] = 0
+
+class TimedAgent(Agent):
+    timer = None
+
+    def process_event(self, event):
+        start = time.perf_counter()
+        super().process_event(event)
+        self.timer.add('process_message', time.perf_counter() - start)
+        self.timer.messages += 1
+
+    def choose_action(self):
+        start = time.perf_counter()
+        choice = super().choose_action()
+        self.timer.add('choose_action', time.perf_counter() - start)
+        return choice
+
+class TimedSimRunner(SimRunner):
+    def __init__(self, agent1, agent2, timer, **kwargs):
+        self.timer = timer
+        super().__init__(agent1, agent2, **kwargs)
+
+    def read_sim(self, timeout=None):
+        start = time.perf_counter()
+        chunk = super().read_sim(timeout)
+        self.timer.add('sim_wait', time.perf_counter() - start)
+        return chunk
+
+    def decode(self, message):
+        start = time.perf_counter()
+        event = super().decode(message)
+        self.timer.add('process_message', time.perf_counter() - start)
+        return event
+
+    def write_sim(self, message):
+        start = time.perf_counter()
+        super().write_sim(message)
+        self.timer.add('write_sim', time.perf_counter() - start)
+
+def percentiles_ms(times):
+    p50, p95, p99 = np.percentile(times, [50, 95, 99]) * 1000
+    return {'mean': float(np.mean(times) * 1000), 'p50': float(p50),
+        'p95': float(p95), 'p99': float(p99)}
+
+def run(num_games, seed, game_format='random'):
+    """Plays num_games seeded games and returns the benchmark report"""
+    timer = StageTimer()
+    TimedAgent.timer = timer
+    agent1 = TimedAgent('p1')
+    agent2 = TimedAgent('p2')
+    sim_runner = TimedSimRunner(agent1, agent2, timer)
+    turn_times = []
+    start = time.perf_counter()
+    for game in range(num_games):
+        random.seed(seed + game)
+        agent1.init_battle()
+        agent2.init_battle()
+        sim_runner.reset_game()
+        sim_runner.start(game_format=game_format,
+            seed=[seed + game, seed, game, 1])
+        while not sim_runner.game_end:
+            turn_start = time.perf_counter()
+            sim_runner.run_until_request()
+            sim_runner.run_actions()
+            turn_times.append(time.perf_counter() - turn_start)
+            timer.end_turn()
+    elapsed = time.perf_counter() - start
+    sim_runner.clean_up()
+    stages = {}
+    for stage in STAGES:
+        stages[stage] = percentiles_ms(timer.turns[stage])
+        stages[stage]['fraction'] = timer.totals[stage] / elapsed
+    return {
+        'games': num_games,
+        'turns': len(turn_times),
+        'messages': timer.messages,
+        'seconds': elapsed,
+        'battles_per_sec': num_games / elapsed,
+        'turns_per_sec': len(turn_times) / elapsed,
+        'messages_per_sec': timer.messages / elapsed,
+        'turn_latency_ms': percentiles_ms(turn_times),
+        'stages': stages
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Measure throughput and latency of the simulation loop')
+    parser.add_argument('-n', '--games', type=int, default=20,
+        help='Number of games to play')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+        help='Seed for the simulator and agents')
+    parser.add_argument('-o', '--output', help='File to write the report to')
+    args = parser.parse_args()
+    report = run(args.games, args.seed)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
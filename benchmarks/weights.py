@@ -0,0 +1,52 @@
+import sys
+import argparse
+import json
+import pickle
+import time
+import torch
+from agents.dqn_agent import Network, SharedWeights
+
+def per_call(f, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        f()
+    return (time.perf_counter() - start) / repeat
+
+def run(num_actors, repeat):
+    """Returns the cost in ms of getting new weights to num_actors actors
+    by pickling the state dict, as a multiprocessing.Queue would, and with
+    SharedWeights"""
+    torch.set_num_threads(1)
+    learner = Network()
+    actor = Network()
+    weights = SharedWeights(learner)
+    bound = Network()
+    weights.bind(bound)
+    data = pickle.dumps(learner.state_dict())
+    report = {
+        'weights_bytes': len(data),
+        #Each put on an actor's queue pickles the state dict again
+        'pickle_publish_ms': per_call(lambda: [pickle.dumps(
+            learner.state_dict()) for i in range(num_actors)], repeat) * 1000,
+        'pickle_load_ms': per_call(lambda: actor.load_state_dict(
+            pickle.loads(data)), repeat) * 1000,
+        'shared_publish_ms': per_call(lambda: weights.publish(learner),
+            repeat) * 1000,
+        'shared_load_ms': per_call(lambda: weights.load(actor),
+            repeat) * 1000,
+        'version_check_us': per_call(weights.version, repeat * 100) * 1e6
+    }
+    del bound
+    weights.close()
+    weights.unlink()
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare publishing weights by pickling and with '
+        'SharedWeights')
+    parser.add_argument('-a', '--actors', type=int, default=16)
+    parser.add_argument('-r', '--repeat', type=int, default=100)
+    args = parser.parse_args()
+    json.dump(run(args.actors, args.repeat), sys.stdout, indent=2)
+    print()
@@ -1,5 +1,23 @@
 import json
 import re
+import os
+import hashlib
+import pickle
+import tempfile
+import time
+from types import MappingProxyType
+import numpy as np
+
+SOURCES = ['pokedex.json', 'movedex.json', 'itemdex.json']
+CACHE_DIR = 'dex_cache'
+CACHE_NAME = 'dex.pickle'
+#Increase when the tables built from the sources change
+CACHE_VERSION = 3
+STATIC_TABLES = ['species_static', 'move_static']
+#Some target types are only different in doubles mode
+TARGET_NORMAL = frozenset(['any', 'allAdjacentFoes', 'scripted', 'normal',
+    'allAdjacent', 'adjacentFoe','randomNormal'])
+TARGET_SELF = frozenset(['adjacentAllyOrSelf', 'self'])
 
 def clean_name(s):
     """Removes non-alphanumeric characters and turns to lowercase"""
@@ -14,64 +32,239 @@ def list_attrs(dex):
 def find(dex, attr):
     return [x for x in dex if attr in dex[x]]
 
-#Open pokedex file
-with open('pokedex.json') as f:
-    pokedex = json.load(f)
-
-#Remove nonstandard pokemon
-remove = find(pokedex, 'isNonstandard')
-for r in remove:
-    pokedex.pop(r)
-
-#Only keep attributes that affect battling
-attrs = ['abilities','baseStats','types']
-for p in pokedex:
-    #Make abilities a list, remove unreleased hidden abilities, clean names
-    if 'unreleasedHidden' in pokedex[p]:
-        pokedex[p]['abilities'].pop('H')
-    a = list(map(clean_name, pokedex[p]['abilities'].values()))
-    pokedex[p]['abilities'] = a
-    #Clean type names
-    pokedex[p]['types'] = list(map(clean_name, pokedex[p]['types']))
-    pokedex[p] = {x:pokedex[p][x] for x in attrs}
-
-#Open movedex file
-with open('movedex.json') as f:
-    movedex = json.load(f)
-
-#Remove nonstandard and unreleased moves
-remove = find(movedex, 'isNonstandard') + find(movedex, 'isUnreleased')
-for r in remove:
-    movedex.pop(r)
-
-#Add 'recharge' as a move that does nothing
-movedex['recharge'] = {'accuracy':True, 'basePower':0, 'category':'Status',
-    'id':'recharge', 'name':'Recharge', 'pp':30, 'priority':0, 'target':'self',
-    'type':'Normal'}
-
-#Open itemdex file
-with open('itemdex.json') as f:
-    itemdex = json.load(f)
-
-#Remove nonstandard and unreleased items
-remove = find(itemdex, 'isNonstandard') + find(itemdex, 'isUnreleased')
-for r in remove:
-    itemdex.pop(r)
-
-#Create unique indices for pokemon, moves, items and abilities
-poke_to_ix = {poke:i for i, poke in enumerate(pokedex)}
-move_to_ix = {move:i for i, move in enumerate(movedex)}
-#Assign index 0 to having no item
-item_to_ix = {item:i+1 for i, item in enumerate(itemdex)}
-item_to_ix[''] = 0
-#Get all abilities
-abilities = set()
-for p in pokedex:
-    for a in pokedex[p]['abilities']:
-        abilities.add(clean_name(a))
-#Assign index 0 to having no ability
-ability_to_ix = {a:i+1 for i, a in enumerate(abilities)}
-ability_to_ix[''] = 0
+def move_data(data):
+    """Returns the type, category, power, accuracy, priority and target of a
+    movedex entry, as they are used in battle"""
+    accuracy = data['accuracy']
+    if isinstance(accuracy, bool):
+        accuracy = 100
+    target = data['target']
+    if target in TARGET_NORMAL:
+        target = 'normal'
+    elif target in TARGET_SELF:
+        target = 'self'
+    return (clean_name(data['type']), clean_name(data['category']),
+        data['basePower'], accuracy, data['priority'], target)
+
+def source_hash():
+    """Returns a hash of the dex source files"""
+    h = hashlib.sha1()
+    for source in SOURCES:
+        with open(source, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def build():
+    """Builds the dex tables from the source files"""
+    #Open pokedex file
+    with open('pokedex.json') as f:
+        pokedex = json.load(f)
+
+    #Remove nonstandard pokemon
+    remove = find(pokedex, 'isNonstandard')
+    for r in remove:
+        pokedex.pop(r)
+
+    #Only keep attributes that affect battling
+    attrs = ['abilities','baseStats','types']
+    for p in pokedex:
+        #Make abilities a list, remove unreleased hidden abilities, clean names
+        if 'unreleasedHidden' in pokedex[p]:
+            pokedex[p]['abilities'].pop('H')
+        a = list(map(clean_name, pokedex[p]['abilities'].values()))
+        pokedex[p]['abilities'] = a
+        #Clean type names
+        pokedex[p]['types'] = list(map(clean_name, pokedex[p]['types']))
+        pokedex[p] = {x:pokedex[p][x] for x in attrs}
+
+    #Open movedex file
+    with open('movedex.json') as f:
+        movedex = json.load(f)
+
+    #Remove nonstandard and unreleased moves
+    remove = find(movedex, 'isNonstandard') + find(movedex, 'isUnreleased')
+    for r in remove:
+        movedex.pop(r)
+
+    #Add 'recharge' as a move that does nothing
+    movedex['recharge'] = {'accuracy':True, 'basePower':0, 'category':'Status',
+        'id':'recharge', 'name':'Recharge', 'pp':30, 'priority':0, 'target':'self',
+        'type':'Normal'}
+
+    #Open itemdex file
+    with open('itemdex.json') as f:
+        itemdex = json.load(f)
+
+    #Remove nonstandard and unreleased items
+    remove = find(itemdex, 'isNonstandard') + find(itemdex, 'isUnreleased')
+    for r in remove:
+        itemdex.pop(r)
+
+    #Create unique indices for pokemon, moves, items and abilities
+    poke_to_ix = {poke:i for i, poke in enumerate(pokedex)}
+    move_to_ix = {move:i for i, move in enumerate(movedex)}
+    #Assign index 0 to having no item
+    item_to_ix = {item:i+1 for i, item in enumerate(itemdex)}
+    item_to_ix[''] = 0
+    #Get all abilities, sorted so indices are the same in every process
+    abilities = set()
+    for p in pokedex:
+        for a in pokedex[p]['abilities']:
+            abilities.add(clean_name(a))
+    #Assign index 0 to having no ability
+    ability_to_ix = {a:i+1 for i, a in enumerate(sorted(abilities))}
+    ability_to_ix[''] = 0
+    return {'pokedex':pokedex, 'movedex':movedex, 'itemdex':itemdex,
+        'poke_to_ix':poke_to_ix, 'move_to_ix':move_to_ix,
+        'item_to_ix':item_to_ix, 'ability_to_ix':ability_to_ix}
+
+def build_static(tables):
+    """Builds the parts of Agent.poke_to_features and Agent.move_to_features
+    that only depend on the pokedex and movedex entry, one row per index.
+    Entries that change during a battle are left as 0."""
+    pokedex = tables['pokedex']
+    species_static = np.zeros((len(pokedex), 45), dtype=np.float32)
+    for poke, i in tables['poke_to_ix'].items():
+        row = species_static[i]
+        row[0] = i
+        for j, stat in enumerate(['hp', 'atk', 'def', 'spa', 'spd', 'spe']):
+            row[3 + j] = pokedex[poke]['baseStats'][stat]
+        for t in pokedex[poke]['types']:
+            if t:
+                row[9 + type_to_ix[t]] = 1
+    movedex = tables['movedex']
+    move_static = np.zeros((len(movedex), 34), dtype=np.float32)
+    for move, i in tables['move_to_ix'].items():
+        move_type, category, power, accuracy, priority, target = move_data(
+            movedex[move])
+        row = move_static[i]
+        row[0] = i
+        row[1 + type_to_ix[move_type]] = 1
+        row[19 + category_to_ix[category]] = 1
+        row[22] = power
+        row[23] = accuracy
+        row[24] = priority
+        row[26 + target_to_ix[target]] = 1
+    return {'species_static':species_static, 'move_static':move_static}
+
+def static_path(name, key, cache_dir=CACHE_DIR):
+    return os.path.join(cache_dir, '{}-{}-{}.npy'.format(name, CACHE_VERSION,
+        key))
+
+def load_static(key, cache_dir=CACHE_DIR):
+    """Returns the cached static tables, memory-mapped so processes share
+    one copy, or None if they aren't cached"""
+    try:
+        return {name:np.load(static_path(name, key, cache_dir), mmap_mode='r')
+            for name in STATIC_TABLES}
+    except (OSError, ValueError):
+        return None
+
+def load_cache(key, cache_dir=CACHE_DIR):
+    """Returns the cached tables if they were built from sources with the
+    given hash by this version of the code, otherwise None"""
+    try:
+        with open(os.path.join(cache_dir, CACHE_NAME), 'rb') as f:
+            version, cache_key, tables = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+        return None
+    if version != CACHE_VERSION or cache_key != key:
+        return None
+    return tables
+
+def save_cache(key, tables, static, cache_dir=CACHE_DIR):
+    os.makedirs(cache_dir, exist_ok=True)
+    #Write to temporary files first, so other processes never see a
+    #partially written cache. The static tables are written first, since a
+    #valid dex.pickle means they are there.
+    paths = set()
+    for name in STATIC_TABLES:
+        fd, tmp = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, static[name])
+        path = static_path(name, key, cache_dir)
+        os.replace(tmp, path)
+        paths.add(os.path.basename(path))
+    fd, tmp = tempfile.mkstemp(dir=cache_dir)
+    with os.fdopen(fd, 'wb') as f:
+        pickle.dump((CACHE_VERSION, key, tables), f,
+            protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, os.path.join(cache_dir, CACHE_NAME))
+    #Remove static tables of other versions or sources. Processes that have
+    #them memory-mapped keep their copy.
+    for name in os.listdir(cache_dir):
+        if name.endswith('.npy') and name not in paths:
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except OSError:
+                pass
+
+def load(cache_dir=CACHE_DIR):
+    """Returns the dex tables, the static feature tables and whether they
+    came from the cache"""
+    key = source_hash()
+    tables = load_cache(key, cache_dir)
+    if tables != None:
+        static = load_static(key, cache_dir)
+        if static != None:
+            return tables, static, True
+    tables = build()
+    static = build_static(tables)
+    try:
+        save_cache(key, tables, static, cache_dir)
+        static = load_static(key, cache_dir) or static
+    except OSError:
+        pass
+    return tables, static, False
+
+def measure_load_times():
+    """Returns the time in seconds to build the tables from the sources
+    (cold) and to load them from the cache (warm)"""
+    start = time.perf_counter()
+    key = source_hash()
+    tables = build()
+    static = build_static(tables)
+    cold = time.perf_counter() - start
+    save_cache(key, tables, static)
+    start = time.perf_counter()
+    key = source_hash()
+    load_cache(key)
+    load_static(key)
+    warm = time.perf_counter() - start
+    return {'cold':cold, 'warm':warm}
+
+type_to_ix = MappingProxyType({'bug': 0, 'dark': 1, 'dragon': 2,
+    'electric': 3, 'fairy': 4, 'fighting': 5, 'fire': 6, 'flying': 7,
+    'ghost': 8, 'grass': 9, 'ground': 10, 'ice': 11, 'normal': 12,
+    'poison': 13, 'psychic': 14, 'rock': 15, 'steel': 16, 'water': 17})
+category_to_ix = MappingProxyType({'physical': 0, 'special': 1, 'status': 2})
+target_to_ix = MappingProxyType({'normal': 0, 'self': 1, 'all': 2,
+    'foeSide': 3, 'adjacentAlly': 4, 'allySide': 5, 'allyTeam': 6})
+status_to_ix = MappingProxyType({'brn': 0, 'frz': 1, 'par': 2, 'psn': 3,
+    'tox': 4, 'slp': 5, 'fnt': 6})
+
+_start = time.perf_counter()
+_tables, _static, loaded_from_cache = load()
+load_time = time.perf_counter() - _start
+pokedex = _tables['pokedex']
+movedex = _tables['movedex']
+itemdex = _tables['itemdex']
+#Index maps are shared by every agent, and by worker processes forked after
+#import, so they are read-only
+poke_to_ix = MappingProxyType(_tables['poke_to_ix'])
+move_to_ix = MappingProxyType(_tables['move_to_ix'])
+item_to_ix = MappingProxyType(_tables['item_to_ix'])
+ability_to_ix = MappingProxyType(_tables['ability_to_ix'])
+#Static feature rows indexed by poke_to_ix and move_to_ix, read-only
+species_static = _static['species_static']
+move_static = _static['move_static']
+species_static.flags.writeable = False
+move_static.flags.writeable = False
 
 __all__ = ['pokedex', 'movedex', 'itemdex', 'poke_to_ix', 'move_to_ix',
-    'item_to_ix', 'ability_to_ix', 'clean_name']
+    'item_to_ix', 'ability_to_ix', 'type_to_ix', 'category_to_ix',
+    'target_to_ix', 'status_to_ix', 'species_static', 'move_static',
+    'clean_name', 'move_data']
+
+if __name__ == '__main__':
+    print(json.dumps(measure_load_times()))
@@ -0,0 +1,115 @@
+import numpy as np
+from agents.base_agent import Agent, NUM_ACTIONS
+from sim import SimRunner
+from features import BatchFeaturizer, NUM_FEATURES
+
+class EnvAgent(Agent):
+    """Agent whose actions are set from outside, by VecEnv"""
+    def set_action(self, action):
+        self.action = action
+
+    def choose_action(self):
+        if self.choose_start:
+            choice = 'team 1'
+        else:
+            choice = self.action_to_choice(self.action)
+        self.wait_game = True
+        self.force_switch = False
+        self.choose_start = False
+        return choice
+
+    def needs_action(self):
+        """Returns whether the agent is waiting for an action from outside"""
+        return not self.wait_game and not self.choose_start
+
+class VecEnv:
+    """Steps a batch of battles together.
+
+    Observations, rewards, done flags and legal action masks are returned as
+    arrays with one row per battle. A battle that ends is restarted right
+    away, and the observation returned for it is the first one of the new
+    game.
+    """
+    def __init__(self, num_envs, opponent_class=Agent, game_format='random',
+            pool=None):
+        self.num_envs = num_envs
+        self.game_format = game_format
+        self.agents = [EnvAgent('agent') for i in range(num_envs)]
+        self.opponents = [opponent_class('opponent') for i in range(num_envs)]
+        self.runners = [SimRunner(a, o, pool=pool)
+            for a, o in zip(self.agents, self.opponents)]
+        self.featurizer = BatchFeaturizer()
+        self.masks = None
+
+    def _start(self, i):
+        self.agents[i].init_battle()
+        self.opponents[i].init_battle()
+        self.runners[i].reset_game()
+        self.runners[i].start(game_format=self.game_format)
+
+    def _advance(self, i):
+        """Runs battle i until the agent needs an action or the game ends"""
+        runner = self.runners[i]
+        while True:
+            runner.run_until_request()
+            if runner.game_end or self.agents[i].needs_action():
+                return
+            #Only the opponent or team preview needs a choice
+            runner.run_actions()
+
+    def _reward(self, i):
+        winner = self.runners[i].winner
+        if winner == self.agents[i].player_name:
+            return 1
+        if winner:
+            return -1
+        return 0
+
+    def _observe(self):
+        obs = self.featurizer.featurize([a.game_data for a in self.agents])
+        masks = np.zeros((self.num_envs, NUM_ACTIONS), dtype=bool)
+        for i, agent in enumerate(self.agents):
+            masks[i] = agent.legal_actions()
+        self.masks = masks
+        return obs, masks
+
+    def reset(self):
+        """Starts a new game in every battle, returns observations and masks"""
+        for i in range(self.num_envs):
+            self._start(i)
+        for i in range(self.num_envs):
+            self._advance(i)
+        return self._observe()
+
+    def step(self, actions):
+        """Takes one action in every battle, returns observations, rewards,
+        done flags and masks. Raises ValueError if an action isn't legal in
+        the last masks returned. A battle whose choice the simulator rejects
+        returns the same observation, to choose again."""
+        if self.masks is None:
+            raise ValueError('reset must be called before step')
+        for i, action in enumerate(actions):
+            #With no legal actions only struggle is left, as the first move
+            if self.masks[i].any() and not (0 <= action < NUM_ACTIONS and
+                    self.masks[i][action]):
+                raise ValueError('Action {} is not legal in battle {}'.format(
+                    action, i))
+        rewards = np.zeros(self.num_envs, dtype=np.float32)
+        dones = np.zeros(self.num_envs, dtype=bool)
+        #Send all choices before reading, so the simulators work in parallel
+        for i, action in enumerate(actions):
+            self.agents[i].set_action(int(action))
+            self.runners[i].run_actions()
+        for i in range(self.num_envs):
+            self._advance(i)
+            if self.runners[i].game_end:
+                rewards[i] = self._reward(i)
+                dones[i] = True
+                self._start(i)
+                self._advance(i)
+        obs, masks = self._observe()
+        return obs, rewards, dones, masks
+
+    def close(self):
+        for runner in self.runners:
+            runner.clean_up()
@@ -0,0 +1,73 @@
+import logging
+import argparse
+import json
+import random
+import time
+import multiprocessing
+from agents.base_agent import Agent
+from sim import SimRunner
+
+def run_worker(worker_id, num_games, agent_class=Agent, p1name='p1',
+        p2name='p2', game_format='random'):
+    """Plays num_games games on a private simulator, returns their results"""
+    #Workers are forked with the same random state, so reseed each one
+    random.seed()
+    agent1 = agent_class(p1name)
+    agent2 = agent_class(p2name)
+    sim_runner = SimRunner(agent1, agent2)
+    results = []
+    try:
+        for game in range(num_games):
+            agent1.init_battle()
+            agent2.init_battle()
+            start = time.time()
+            sim_runner.run_game(game_format=game_format)
+            results.append({
+                'worker': worker_id,
+                'game': game,
+                'winner': sim_runner.winner,
+                'turns': sim_runner.turns,
+                'time': time.time() - start
+            })
+    finally:
+        sim_runner.clean_up()
+    return results
+
+def run_farm(num_workers, num_games, agent_class=Agent, p1name='p1',
+        p2name='p2', game_format='random', worker=run_worker):
+    """Splits num_games between num_workers processes, each with its own
+    simulator, and returns the results of every game. worker is called like
+    run_worker in each process."""
+    if num_games <= 0:
+        return []
+    num_workers = max(min(num_workers, num_games), 1)
+    per_worker, extra = divmod(num_games, num_workers)
+    tasks = []
+    for i in range(num_workers):
+        n = per_worker + (1 if i < extra else 0)
+        tasks.append((i, n, agent_class, p1name, p2name, game_format))
+    with multiprocessing.Pool(num_workers) as pool:
+        worker_results = pool.starmap(worker, tasks)
+    return [r for results in worker_results for r in results]
+
+if __name__ == '__main__':
+    logging.basicConfig(filename='showdown.log', level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-w', '--workers', type=int,
+        default=multiprocessing.cpu_count(), help='Number of worker processes')
+    parser.add_argument('-n', '--games', type=int, default=100,
+        help='Total number of games to play')
+    parser.add_argument('-o', '--output', help='File to write game results to')
+    args = parser.parse_args()
+    start = time.time()
+    results = run_farm(args.workers, args.games)
+    elapsed = time.time() - start
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f)
+    wins = {}
+    for r in results:
+        wins[r['winner']] = wins.get(r['winner'], 0) + 1
+    print('Played {} games in {:.2f}s ({:.2f} battles/sec)'.format(
+        len(results), elapsed, len(results) / elapsed))
+    print('Wins: {}'.format(wins))
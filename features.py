@@ -0,0 +1,420 @@
+import numpy as np
+from dex import *
+from pokemon import ArrayGameData
+
+#Layout of the feature vector built by Agent.game_to_features
+POKE_LEN = 45
+MOVE_LEN = 34
+TEAM = 0
+OPP_TEAM = TEAM + 6 * (POKE_LEN + 1)
+MOVES = OPP_TEAM + 6 * (POKE_LEN + 1)
+OPP_MOVES = MOVES + 4 * (MOVE_LEN + 1)
+BOOSTS = OPP_MOVES + 4 * (MOVE_LEN + 1)
+OPP_BOOSTS = BOOSTS + 7
+POKE_EFFECTS = OPP_BOOSTS + 7
+OPP_POKE_EFFECTS = POKE_EFFECTS + 22
+SIDE_EFFECTS = OPP_POKE_EFFECTS + 22
+OPP_SIDE_EFFECTS = SIDE_EFFECTS + 11
+WEATHER = OPP_SIDE_EFFECTS + 11
+TERRAIN = WEATHER + 7
+FIELD_EFFECTS = TERRAIN + 4
+FLAGS = FIELD_EFFECTS + 4
+NUM_FEATURES = FLAGS + 4
+
+STATS = ['hp', 'atk', 'def', 'spa', 'spd', 'spe']
+NO_STATS = {'atk':0, 'def':0, 'spa':0, 'spd':0, 'spe':0}
+
+def array_states(games):
+    """Returns whether all games keep boosts and effects in a state array"""
+    return all(isinstance(g, ArrayGameData) for g in games)
+
+class BatchFeaturizer:
+    """Builds the features of Agent.game_to_features for a batch of games.
+
+    The parts of pokemon and move features that only depend on the species
+    or move are gathered from the dex static tables for the whole batch at
+    once, and the battle state is scattered on top.
+    """
+    def __init__(self):
+        self.species_static = species_static
+        self.move_static = move_static
+
+    def featurize(self, games, out=None):
+        """Returns a (len(games), 931) array of features of GameData objects,
+        written to out if it is given"""
+        B = len(games)
+        if out is None:
+            out = np.zeros((B, NUM_FEATURES), dtype=np.float32)
+        else:
+            out.fill(0)
+        if B == 0:
+            return out
+        self.write_pokemon(out, games)
+        self.write_moves(out, games)
+        self.write_boosts(out, games)
+        self.write_effects(out, games)
+        self.write_field(out, games)
+        return out
+
+    def write_pokemon(self, out, games):
+        #One entry per known pokemon: row, slot, species index, ability index,
+        #item index (-1 if unknown), level, health, max health, status index
+        #(-1 if none), stats known, 5 stats
+        entries = []
+        changed = []
+        for b, g in enumerate(games):
+            for offset, team in ((0, g.team or ()), (6, g.opp_team or ())):
+                for i, p in enumerate(team[:6]):
+                    if p == None:
+                        continue
+                    species = p.species
+                    ability = p.ability
+                    item = p.item
+                    status = p.status
+                    stats = p.stats
+                    if stats == None:
+                        stats = NO_STATS
+                    entries.append((b, offset + i, poke_to_ix[species.name],
+                        -1 if ability == None else ability_to_ix[ability],
+                        -1 if item == None else item_to_ix[item],
+                        p.level, p.health, p.max_health,
+                        status_to_ix[status] if status else -1,
+                        stats is not NO_STATS, stats['atk'], stats['def'],
+                        stats['spa'], stats['spd'], stats['spe']))
+                    #Types or base stats changed by a battle effect
+                    if (p.types is not species.types or
+                            p.base_stats is not species.base_stats):
+                        changed.append((b, offset + i, p))
+        if not entries:
+            return
+        B = len(out)
+        pokes = out[:, TEAM:MOVES].reshape(B, 12, POKE_LEN + 1)
+        e = np.array(entries, dtype=np.float32)
+        rows = e[:, 0].astype(int)
+        slots = e[:, 1].astype(int)
+        pokes[rows, slots, :POKE_LEN] = self.species_static[e[:, 2].astype(int)]
+        pokes[rows, slots, POKE_LEN] = 1
+        known = e[:, 3] >= 0
+        pokes[rows[known], slots[known], 1] = e[known, 3]
+        pokes[rows[known], slots[known], 2] = 1
+        known = e[:, 4] >= 0
+        pokes[rows[known], slots[known], 37] = e[known, 4]
+        pokes[rows[known], slots[known], 38] = 1
+        pokes[rows, slots, 27:30] = e[:, 5:8]
+        status = e[:, 8] >= 0
+        pokes[rows[status], slots[status], 30 + e[status, 8].astype(int)] = 1
+        pokes[rows, slots, 39:44] = e[:, 10:15]
+        pokes[rows, slots, 44] = e[:, 9]
+        for b, slot, p in changed:
+            f = pokes[b, slot]
+            for i, stat in enumerate(STATS):
+                f[3 + i] = p.base_stats[stat]
+            f[9:27] = 0
+            for t in p.types:
+                if t:
+                    f[9 + type_to_ix[t]] = 1
+
+    def write_moves(self, out, games):
+        #One entry per known move: row, slot, move index, pp, disabled
+        entries = []
+        for b, g in enumerate(games):
+            for offset, p in ((0, g.active), (4, g.opp_active)):
+                if p == None:
+                    continue
+                for i, m in enumerate(p.moves[:4]):
+                    if m != None:
+                        entries.append((b, offset + i, move_to_ix[m.spec.name],
+                            m.pp, m.disabled))
+        if not entries:
+            return
+        B = len(out)
+        view = out[:, MOVES:BOOSTS].reshape(B, 8, MOVE_LEN + 1)
+        e = np.array(entries, dtype=np.float32)
+        rows = e[:, 0].astype(int)
+        slots = e[:, 1].astype(int)
+        view[rows, slots, :MOVE_LEN] = self.move_static[e[:, 2].astype(int)]
+        view[rows, slots, 25] = e[:, 3]
+        view[rows, slots, 33] = e[:, 4]
+        view[rows, slots, MOVE_LEN] = 1
+
+    def write_boosts(self, out, games):
+        if array_states(games):
+            out[:, BOOSTS:POKE_EFFECTS] = [g.state[ArrayGameData.BOOSTS]
+                for g in games]
+            return
+        out[:, BOOSTS:OPP_BOOSTS] = [g.boost_list() for g in games]
+        out[:, OPP_BOOSTS:POKE_EFFECTS] = [g.opp_boost_list() for g in games]
+
+    def write_effects(self, out, games):
+        self.write_poke_effects(out, games)
+        self.write_side_effects(out, games)
+
+    def write_poke_effects(self, out, games):
+        if not games:
+            return
+        if array_states(games):
+            out[:, POKE_EFFECTS:SIDE_EFFECTS] = [
+                g.state[ArrayGameData.POKE_EFFECTS] for g in games]
+            return
+        poke_effects = games[0].poke_effects_
+        out[:, POKE_EFFECTS:OPP_POKE_EFFECTS] = [
+            [g.poke_effects[e] for e in poke_effects] for g in games]
+        out[:, OPP_POKE_EFFECTS:SIDE_EFFECTS] = [
+            [g.opp_poke_effects[e] for e in poke_effects] for g in games]
+
+    def write_side_effects(self, out, games):
+        if not games:
+            return
+        if array_states(games):
+            out[:, SIDE_EFFECTS:WEATHER] = [
+                g.state[ArrayGameData.SIDE_EFFECTS] for g in games]
+            return
+        side_effects = games[0].side_effects_
+        out[:, SIDE_EFFECTS:OPP_SIDE_EFFECTS] = [
+            [g.side_effects[e] for e in side_effects] for g in games]
+        out[:, OPP_SIDE_EFFECTS:WEATHER] = [
+            [g.opp_side_effects[e] for e in side_effects] for g in games]
+
+    def write_field(self, out, games):
+        for b, g in enumerate(games):
+            if g.weather:
+                out[b, WEATHER + g.weathers_.index(g.weather)] = 1
+            if g.terrain:
+                out[b, TERRAIN + g.terrains_.index(g.terrain)] = 1
+        if array_states(games):
+            out[:, FIELD_EFFECTS:FLAGS] = [
+                g.state[ArrayGameData.FIELD_EFFECTS] for g in games]
+        elif games:
+            field_effects = games[0].field_effects_
+            out[:, FIELD_EFFECTS:FLAGS] = [
+                [g.field_effects[e] for e in field_effects] for g in games]
+        out[:, FLAGS:NUM_FEATURES] = [
+            (g.mega, g.opp_mega, g.zmove, g.opp_zmove) for g in games]
+
+#Regions of the feature vector, each written by one BatchFeaturizer method
+POKEMON_REGION = 'pokemon'
+MOVES_REGION = 'moves'
+BOOSTS_REGION = 'boosts'
+POKE_EFFECTS_REGION = 'poke_effects'
+SIDE_EFFECTS_REGION = 'side_effects'
+FIELD_REGION = 'field'
+REGIONS = {
+    POKEMON_REGION: slice(TEAM, MOVES),
+    MOVES_REGION: slice(MOVES, BOOSTS),
+    BOOSTS_REGION: slice(BOOSTS, POKE_EFFECTS),
+    POKE_EFFECTS_REGION: slice(POKE_EFFECTS, SIDE_EFFECTS),
+    SIDE_EFFECTS_REGION: slice(SIDE_EFFECTS, WEATHER),
+    FIELD_REGION: slice(WEATHER, NUM_FEATURES)
+}
+ALL_REGIONS = tuple(REGIONS)
+
+#Regions that can change when an agent handles each message type. Handled
+#message types that aren't listed mark every region.
+EVENT_REGIONS = {
+    'player': (),
+    'request': (POKEMON_REGION, MOVES_REGION),
+    'teamsize': (POKEMON_REGION,),
+    'move': (POKEMON_REGION, MOVES_REGION),
+    'switch': (POKEMON_REGION, MOVES_REGION, BOOSTS_REGION,
+        POKE_EFFECTS_REGION),
+    'drag': (POKEMON_REGION, MOVES_REGION, BOOSTS_REGION,
+        POKE_EFFECTS_REGION),
+    'detailschange': (POKEMON_REGION,),
+    '-formechange': (POKEMON_REGION,),
+    'faint': (POKEMON_REGION,),
+    '-damage': (POKEMON_REGION,),
+    '-heal': (POKEMON_REGION,),
+    '-sethp': (POKEMON_REGION,),
+    '-status': (POKEMON_REGION,),
+    '-curestatus': (POKEMON_REGION,),
+    '-boost': (POKEMON_REGION, BOOSTS_REGION),
+    '-unboost': (POKEMON_REGION, BOOSTS_REGION),
+    '-setboost': (POKEMON_REGION, BOOSTS_REGION),
+    '-swapboost': (BOOSTS_REGION,),
+    '-clearpositiveboost': (POKEMON_REGION, BOOSTS_REGION),
+    '-clearnegativeboost': (POKEMON_REGION, BOOSTS_REGION),
+    '-copyboost': (BOOSTS_REGION,),
+    '-clearboost': (POKEMON_REGION, BOOSTS_REGION),
+    '-invertboost': (POKEMON_REGION, BOOSTS_REGION),
+    '-clearallboost': (BOOSTS_REGION,),
+    '-item': (POKEMON_REGION,),
+    '-enditem': (POKEMON_REGION,),
+    '-ability': (POKEMON_REGION,),
+    '-endability': (POKEMON_REGION,),
+    '-transform': (POKEMON_REGION, MOVES_REGION, BOOSTS_REGION),
+    '-zpower': (FIELD_REGION,),
+    '-mega': (POKEMON_REGION, FIELD_REGION),
+    '-start': (POKEMON_REGION, POKE_EFFECTS_REGION),
+    '-end': (POKE_EFFECTS_REGION,),
+    '-activate': (POKEMON_REGION, MOVES_REGION),
+    '-sidestart': (SIDE_EFFECTS_REGION,),
+    '-sideend': (SIDE_EFFECTS_REGION,),
+    '-weather': (POKEMON_REGION, FIELD_REGION),
+    '-fieldstart': (POKEMON_REGION, FIELD_REGION),
+    '-fieldend': (FIELD_REGION,)
+}
+
+#Marks slots of a FeatureBuffer that were never written
+UNWRITTEN = object()
+
+def write_poke(f, p):
+    """Writes the features of pokemon p to f, a slot of the feature vector,
+    like Agent.poke_to_features followed by the known flag"""
+    species = p.species
+    f[:POKE_LEN] = species_static[poke_to_ix[species.name]]
+    if p.ability != None:
+        f[1] = ability_to_ix[p.ability]
+        f[2] = 1
+    if p.base_stats is not species.base_stats:
+        for i, stat in enumerate(STATS):
+            f[3 + i] = p.base_stats[stat]
+    if p.types is not species.types:
+        f[9:27] = 0
+        for t in p.types:
+            if t:
+                f[9 + type_to_ix[t]] = 1
+    f[27] = p.level
+    f[28] = p.health
+    f[29] = p.max_health
+    if p.status:
+        f[30 + status_to_ix[p.status]] = 1
+    if p.item != None:
+        f[37] = item_to_ix[p.item]
+        f[38] = 1
+    if p.stats != None:
+        stats = p.stats
+        f[39:44] = (stats['atk'], stats['def'], stats['spa'], stats['spd'],
+            stats['spe'])
+        f[44] = 1
+    f[POKE_LEN] = 1
+
+def write_move(f, m):
+    """Writes the features of move m to f, a slot of the feature vector"""
+    f[:MOVE_LEN] = move_static[move_to_ix[m.spec.name]]
+    f[25] = m.pp
+    f[33] = m.disabled
+    f[MOVE_LEN] = 1
+
+def poke_state(p):
+    """Returns everything the features of pokemon p depend on"""
+    if p == None:
+        return None
+    return (p.species, p.ability, p.types, p.base_stats, p.level, p.health,
+        p.max_health, p.status, p.item, p.stats)
+
+def move_state(m):
+    if m == None:
+        return None
+    return (m.spec, m.pp, m.disabled)
+
+class FeatureBuffer:
+    """The features of one game, kept between observations.
+
+    Events mark the regions they can change as dirty, and reading the
+    features only rewrites the dirty regions. In the pokemon and moves
+    regions, only the slots whose state changed since they were written are
+    rewritten.
+    """
+    def __init__(self):
+        self.features = np.zeros(NUM_FEATURES, dtype=np.float32)
+        f = self.features
+        self.poke_slots = f[TEAM:MOVES].reshape(12, POKE_LEN + 1)
+        self.move_slots = f[MOVES:BOOSTS].reshape(8, MOVE_LEN + 1)
+        self.writers = {
+            BOOSTS_REGION: self.write_boosts,
+            POKE_EFFECTS_REGION: self.write_poke_effects,
+            SIDE_EFFECTS_REGION: self.write_side_effects,
+            FIELD_REGION: self.write_field
+        }
+        self.mark_all()
+
+    def mark(self, regions):
+        self.dirty.update(regions)
+
+    def mark_all(self):
+        """Marks everything dirty, for a new game or replaced game data"""
+        self.dirty = set(ALL_REGIONS)
+        #State each slot was written from, for own and opponent slots
+        self.team_states = [UNWRITTEN] * 6
+        self.opp_team_states = [UNWRITTEN] * 6
+        self.move_states = [UNWRITTEN] * 4
+        self.opp_move_states = [UNWRITTEN] * 4
+
+    def mark_event(self, message_type):
+        self.dirty.update(EVENT_REGIONS.get(message_type, ALL_REGIONS))
+
+    def write_slots(self, slots, states, items, state_fn, write_fn):
+        for i in range(len(states)):
+            item = items[i] if i < len(items) else None
+            state = state_fn(item)
+            if state != states[i]:
+                states[i] = state
+                slots[i] = 0
+                if item != None:
+                    write_fn(slots[i], item)
+
+    def write_boosts(self, g):
+        f = self.features
+        if isinstance(g, ArrayGameData):
+            f[BOOSTS:POKE_EFFECTS] = g.state[ArrayGameData.BOOSTS]
+            return
+        f[BOOSTS:OPP_BOOSTS] = g.boost_list()
+        f[OPP_BOOSTS:POKE_EFFECTS] = g.opp_boost_list()
+
+    def write_poke_effects(self, g):
+        f = self.features
+        if isinstance(g, ArrayGameData):
+            f[POKE_EFFECTS:SIDE_EFFECTS] = g.state[ArrayGameData.POKE_EFFECTS]
+            return
+        f[POKE_EFFECTS:OPP_POKE_EFFECTS] = list(
+            map(g.poke_effects.__getitem__, g.poke_effects_))
+        f[OPP_POKE_EFFECTS:SIDE_EFFECTS] = list(
+            map(g.opp_poke_effects.__getitem__, g.poke_effects_))
+
+    def write_side_effects(self, g):
+        f = self.features
+        if isinstance(g, ArrayGameData):
+            f[SIDE_EFFECTS:WEATHER] = g.state[ArrayGameData.SIDE_EFFECTS]
+            return
+        f[SIDE_EFFECTS:OPP_SIDE_EFFECTS] = list(
+            map(g.side_effects.__getitem__, g.side_effects_))
+        f[OPP_SIDE_EFFECTS:WEATHER] = list(
+            map(g.opp_side_effects.__getitem__, g.side_effects_))
+
+    def write_field(self, g):
+        f = self.features
+        f[WEATHER:FIELD_EFFECTS] = 0
+        if g.weather:
+            f[WEATHER + g.weathers_.index(g.weather)] = 1
+        if g.terrain:
+            f[TERRAIN + g.terrains_.index(g.terrain)] = 1
+        if isinstance(g, ArrayGameData):
+            f[FIELD_EFFECTS:FLAGS] = g.state[ArrayGameData.FIELD_EFFECTS]
+        else:
+            f[FIELD_EFFECTS:FLAGS] = list(
+                map(g.field_effects.__getitem__, g.field_effects_))
+        f[FLAGS:NUM_FEATURES] = (g.mega, g.opp_mega, g.zmove, g.opp_zmove)
+
+    def read(self, game_data):
+        """Returns the features of game_data. The array is updated in place
+        by later reads."""
+        dirty = self.dirty
+        if not dirty:
+            return self.features
+        if POKEMON_REGION in dirty:
+            self.write_slots(self.poke_slots[:6], self.team_states,
+                game_data.team or (), poke_state, write_poke)
+            self.write_slots(self.poke_slots[6:], self.opp_team_states,
+                game_data.opp_team or (), poke_state, write_poke)
+        if MOVES_REGION in dirty:
+            self.write_slots(self.move_slots[:4], self.move_states,
+                game_data.active.moves if game_data.active else (),
+                move_state, write_move)
+            self.write_slots(self.move_slots[4:], self.opp_move_states,
+                game_data.opp_active.moves if game_data.opp_active else (),
+                move_state, write_move)
+        for region, writer in self.writers.items():
+            if region in dirty:
+                writer(game_data)
+        dirty.clear()
+        return self.features
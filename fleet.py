@@ -0,0 +1,538 @@
+import sys
+import logging
+import argparse
+import io
+import json
+import random
+import selectors
+import socket
+import struct
+import time
+import zipfile
+import zlib
+import multiprocessing
+import numpy as np
+import torch
+from agents.base_agent import NUM_ACTIONS
+from agents.dqn_agent import Network
+from features import NUM_FEATURES
+from sim import SimRunner
+from train import (Learner, actor_epsilon, make_agents, make_memory,
+    play_game)
+
+PORT = 9180
+#Every frame is a type and payload length, followed by the zlib-compressed
+#payload. Control frames hold JSON, transition and weights frames hold the
+#weights' learner run id and version followed by an .npz archive of arrays.
+#A learner picks a new run id each time it starts, so actors can tell
+#its versions from those of a learner that restarted.
+FRAME_HEADER = struct.Struct('!BI')
+WEIGHTS_ID = struct.Struct('!Qq')
+HELLO = 1
+CREDIT = 2
+TRANSITIONS = 3
+WEIGHTS = 4
+BATCH_FIELDS = ('obs', 'actions', 'rewards', 'next_obs', 'dones',
+    'next_masks')
+#Largest frame accepted, before and after decompressing
+MAX_FRAME = 64 << 20
+#Errors a malformed frame can raise while being decoded
+FRAME_ERRORS = (ValueError, KeyError, TypeError, EOFError, struct.error,
+    zlib.error, zipfile.BadZipFile)
+
+def encode_frame(kind, payload, level=1):
+    data = zlib.compress(payload, level)
+    return FRAME_HEADER.pack(kind, len(data)) + data
+
+def encode_json(kind, message):
+    return encode_frame(kind, json.dumps(message).encode())
+
+def encode_arrays(kind, run, version, arrays, level=1):
+    f = io.BytesIO()
+    f.write(WEIGHTS_ID.pack(run, version))
+    np.savez(f, **arrays)
+    return encode_frame(kind, f.getvalue(), level)
+
+def decode_arrays(payload):
+    """Returns the run id, version and dict of arrays of a transitions or
+    weights payload"""
+    run, version = WEIGHTS_ID.unpack_from(payload)
+    data = payload[WEIGHTS_ID.size:]
+    #np.load would return a single array for .npy data
+    if not data.startswith(b'PK'):
+        raise ValueError('Payload is not an .npz archive')
+    with np.load(io.BytesIO(data), allow_pickle=False) as archive:
+        #Members can be compressed, so check their size before reading
+        if sum(info.file_size for info in archive.zip.infolist()) > MAX_FRAME:
+            raise ValueError('Arrays are too large')
+        return run, version, {name:archive[name] for name in archive.files}
+
+def validate_batch(arrays):
+    """Returns the batch of BATCH_FIELDS arrays from decoded transitions,
+    raising ValueError if any is missing or has the wrong shape or dtype"""
+    if set(arrays) != set(BATCH_FIELDS):
+        raise ValueError('Batch has fields {}'.format(sorted(arrays)))
+    n = len(arrays['actions'])
+    shapes = {
+        'obs': ((n, NUM_FEATURES), np.float32),
+        'actions': ((n,), np.int64),
+        'rewards': ((n,), np.float32),
+        'next_obs': ((n, NUM_FEATURES), np.float32),
+        'dones': ((n,), np.bool_),
+        'next_masks': ((n, NUM_ACTIONS), np.bool_)
+    }
+    for name, (shape, dtype) in shapes.items():
+        array = arrays[name]
+        if array.shape != shape or array.dtype != dtype:
+            raise ValueError('{} has shape {} and dtype {}'.format(name,
+                array.shape, array.dtype))
+    actions = arrays['actions']
+    if n and (actions.min() < 0 or actions.max() >= NUM_ACTIONS):
+        raise ValueError('Actions out of range')
+    return [arrays[name] for name in BATCH_FIELDS]
+
+class FrameReader:
+    """Splits a byte stream into (type, payload) frames"""
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Adds received bytes, returns the frames they complete. Raises
+        ValueError on frames of unknown types or over MAX_FRAME bytes."""
+        self.buffer += data
+        frames = []
+        while len(self.buffer) >= FRAME_HEADER.size:
+            kind, length = FRAME_HEADER.unpack_from(self.buffer)
+            if kind not in (HELLO, CREDIT, TRANSITIONS, WEIGHTS):
+                raise ValueError('Unknown frame type {}'.format(kind))
+            if length > MAX_FRAME:
+                raise ValueError('Frame of {} bytes'.format(length))
+            end = FRAME_HEADER.size + length
+            if len(self.buffer) < end:
+                break
+            decompressor = zlib.decompressobj()
+            payload = decompressor.decompress(
+                self.buffer[FRAME_HEADER.size:end], MAX_FRAME)
+            if decompressor.unconsumed_tail or not decompressor.eof:
+                raise ValueError('Frame payload is too large or truncated')
+            frames.append((kind, payload))
+            del self.buffer[:end]
+        return frames
+
+class ActorConnection:
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = FrameReader()
+        self.out = bytearray()
+        self.actor_id = None
+        self.run = None
+        self.version = -1
+
+class FleetServer:
+    """Learner side of the fleet, receiving transitions from actors on other
+    hosts over TCP.
+
+    Actors may only send a batch when they hold a credit. Each actor gets
+    window credits when it connects, and one more every time poll hands
+    one of its batches to the learner, so a learner that falls behind
+    stops the actors instead of queueing without limit. Whenever an actor
+    that has older weights, or weights from an earlier run of the learner,
+    sends a batch or connects, it is sent the newest weights given to
+    publish. Sockets are non-blocking, so a slow
+    actor never holds up the others.
+    """
+    def __init__(self, host='', port=PORT, window=4):
+        self.window = window
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen()
+        self.listener.setblocking(False)
+        self.port = self.listener.getsockname()[1]
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self.connections = {}
+        self.run = random.getrandbits(63)
+        self.version = -1
+        self.weights_frame = None
+        self.batches = 0
+        self.transitions = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.connects = 0
+        self.bad_frames = 0
+
+    def publish(self, version, state_dict):
+        """Makes weights the newest, to be sent to actors that are behind"""
+        self.version = version
+        self.weights_frame = encode_arrays(WEIGHTS, self.run, version,
+            {key:t.numpy() for key, t in state_dict.items()})
+        #Actors that are waiting for credit would never send a batch
+        for conn in list(self.connections.values()):
+            self.send_weights(conn)
+
+    def send(self, conn, frame):
+        if conn.sock not in self.connections:
+            return
+        conn.out += frame
+        self.bytes_out += len(frame)
+        self.write(conn)
+
+    def send_weights(self, conn):
+        if self.weights_frame == None:
+            return
+        if conn.run != self.run or conn.version < self.version:
+            conn.run = self.run
+            conn.version = self.version
+            self.send(conn, self.weights_frame)
+
+    def write(self, conn):
+        try:
+            sent = conn.sock.send(conn.out)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self.drop(conn)
+            return
+        del conn.out[:sent]
+        events = selectors.EVENT_READ
+        if conn.out:
+            events |= selectors.EVENT_WRITE
+        self.selector.modify(conn.sock, events, conn)
+
+    def drop(self, conn):
+        logging.getLogger(__name__).info('Actor %s disconnected',
+            conn.actor_id)
+        self.selector.unregister(conn.sock)
+        del self.connections[conn.sock]
+        conn.sock.close()
+
+    def poll(self, timeout=0):
+        """Handles network events for up to timeout seconds, returns a list
+        of (actor_id, version, batch) of the batches received"""
+        received = []
+        for key, events in self.selector.select(timeout):
+            if key.fileobj is self.listener:
+                self.accept()
+                continue
+            conn = key.data
+            if events & selectors.EVENT_WRITE:
+                self.write(conn)
+            if events & selectors.EVENT_READ and conn.sock in self.connections:
+                self.read(conn, received)
+        for actor_id, conn, version, batch in received:
+            self.send(conn, encode_json(CREDIT, {'credits':1}))
+        return [(actor_id, version, batch)
+            for actor_id, conn, version, batch in received]
+
+    def accept(self):
+        sock, _ = self.listener.accept()
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = ActorConnection(sock)
+        self.connections[sock] = conn
+        self.selector.register(sock, selectors.EVENT_READ, conn)
+        self.connects += 1
+
+    def read(self, conn, received):
+        try:
+            data = conn.sock.recv(1 << 20)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.drop(conn)
+            return
+        self.bytes_in += len(data)
+        #A peer that sends a bad frame is dropped, the others are unaffected
+        try:
+            for kind, payload in conn.reader.feed(data):
+                self.handle(conn, kind, payload, received)
+        except FRAME_ERRORS as e:
+            logging.getLogger(__name__).warning('Bad frame from actor %s: %s',
+                conn.actor_id, e)
+            self.bad_frames += 1
+            self.drop(conn)
+
+    def handle(self, conn, kind, payload, received):
+        if kind == HELLO:
+            hello = json.loads(payload)
+            if not (isinstance(hello, dict) and
+                    isinstance(hello.get('actor_id'), int) and
+                    isinstance(hello.get('run'), (int, type(None))) and
+                    isinstance(hello.get('version'), int)):
+                raise ValueError('Bad hello {}'.format(hello))
+            conn.actor_id = hello['actor_id']
+            conn.run = hello['run']
+            conn.version = hello['version']
+            self.send(conn, encode_json(CREDIT, {'credits':self.window}))
+            self.send_weights(conn)
+        elif kind == TRANSITIONS:
+            if conn.actor_id == None:
+                raise ValueError('Transitions before hello')
+            run, version, arrays = decode_arrays(payload)
+            batch = validate_batch(arrays)
+            received.append((conn.actor_id, conn, version, batch))
+            self.batches += 1
+            self.transitions += len(batch[0])
+            self.send_weights(conn)
+        else:
+            raise ValueError('Unexpected frame type {}'.format(kind))
+
+    def stats(self):
+        return {
+            'actors': len(self.connections),
+            'connects': self.connects,
+            'bad_frames': self.bad_frames,
+            'batches': self.batches,
+            'transitions': self.transitions,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out
+        }
+
+    def close(self):
+        for conn in list(self.connections.values()):
+            self.drop(conn)
+        self.selector.close()
+        self.listener.close()
+
+class FleetClient:
+    """Actor side of the fleet.
+
+    send blocks until the learner grants a credit, reading the weights it
+    sends meanwhile, and take_weights returns the newest weights once.
+    When the connection is lost, the client reconnects, waiting longer
+    after each failure up to max_retry seconds. Batches the learner hadn't
+    read when the connection was lost are lost, the one being sent is sent
+    again.
+    """
+    def __init__(self, host, port=PORT, actor_id=0, retry=0.5, max_retry=30):
+        self.address = (host, port)
+        self.actor_id = actor_id
+        self.retry = retry
+        self.max_retry = max_retry
+        self.sock = None
+        self.run = None
+        self.version = -1
+        self.weights = None
+        self.reconnects = -1
+        self.raw_bytes = 0
+        self.bytes_sent = 0
+        self.connect()
+
+    def connect(self):
+        if self.sock != None:
+            self.sock.close()
+        delay = self.retry
+        while True:
+            try:
+                self.sock = socket.create_connection(self.address)
+                break
+            except OSError:
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_retry)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = FrameReader()
+        self.credits = 0
+        self.reconnects += 1
+        self.sock.sendall(encode_json(HELLO, {'actor_id':self.actor_id,
+            'run':self.run, 'version':self.version}))
+
+    def poll(self, timeout=0):
+        """Reads frames from the learner for up to timeout seconds, or
+        until one arrives if timeout is None, then any others waiting"""
+        self.sock.settimeout(timeout)
+        try:
+            while True:
+                try:
+                    data = self.sock.recv(1 << 20)
+                except (BlockingIOError, socket.timeout):
+                    return
+                except OSError:
+                    data = b''
+                if not data:
+                    self.connect()
+                    return
+                for kind, payload in self.reader.feed(data):
+                    if kind == CREDIT:
+                        self.credits += json.loads(payload)['credits']
+                    elif kind == WEIGHTS:
+                        self.run, self.version, self.weights = decode_arrays(
+                            payload)
+                self.sock.settimeout(0)
+        finally:
+            self.sock.settimeout(None)
+
+    def take_weights(self):
+        """Returns the version and state dict of weights received since the
+        last call, or None"""
+        if self.weights == None:
+            return None
+        weights = self.weights
+        self.weights = None
+        return self.version, {key:torch.from_numpy(array)
+            for key, array in weights.items()}
+
+    def send(self, version, batch):
+        """Sends a batch of obs, actions, rewards, next_obs, dones and
+        next_masks arrays of transitions collected with the given weights
+        version"""
+        frame = encode_arrays(TRANSITIONS, self.run or 0, version,
+            dict(zip(BATCH_FIELDS, batch)))
+        self.raw_bytes += sum(array.nbytes for array in batch)
+        while True:
+            #Notice a lost connection before sending into it
+            self.poll()
+            while self.credits == 0:
+                self.poll(None)
+            try:
+                self.sock.sendall(frame)
+            except OSError:
+                self.connect()
+                continue
+            self.credits -= 1
+            self.bytes_sent += len(frame)
+            return
+
+    def close(self):
+        self.sock.close()
+
+def run_fleet_actor(host, port, actor_id, num_actors, num_games=None,
+        game_format='random'):
+    """Plays games like train.run_actor, sending the transitions to a
+    FleetServer, and returns the client's transfer statistics"""
+    random.seed()
+    torch.manual_seed(random.getrandbits(32))
+    torch.set_num_threads(1)
+    network = Network()
+    network.eval()
+    sim_runner = SimRunner(*make_agents(network,
+        actor_epsilon(actor_id, num_actors)))
+    client = FleetClient(host, port, actor_id)
+    games = 0
+    try:
+        while num_games == None or games < num_games:
+            client.poll()
+            weights = client.take_weights()
+            if weights != None:
+                network.load_state_dict(weights[1])
+            client.send(client.version, play_game(sim_runner, game_format))
+            games += 1
+    finally:
+        sim_runner.clean_up()
+        client.close()
+    return {
+        'games': games,
+        'reconnects': client.reconnects,
+        'compression': client.raw_bytes / max(client.bytes_sent, 1)
+    }
+
+def run_learner(server, num_steps, memory=None, learn_start=1000,
+        publish_every=100, checkpoint=None, **learner_args):
+    """Serves actors until num_steps learner steps are done. Without a
+    memory, acts as a stand-in learner: batches are thrown away, and a new
+    version of the same weights is published every publish_every batches,
+    which exercises the protocol without training"""
+    network = Network()
+    learner = None
+    if memory != None:
+        learner = Learner(network, memory, **learner_args)
+    version = 0
+    server.publish(version, network.state_dict())
+    steps = 0
+    start = time.perf_counter()
+    while steps < num_steps:
+        waiting = learner == None or len(memory) < learn_start
+        for actor_id, actor_version, batch in server.poll(
+                0.1 if waiting else 0):
+            if learner == None:
+                steps += 1
+            else:
+                learner.push(batch)
+        if learner != None and len(memory) >= learn_start:
+            learner.step()
+            steps = learner.steps
+        if steps // publish_every > version:
+            version = steps // publish_every
+            server.publish(version, network.state_dict())
+    elapsed = time.perf_counter() - start
+    if checkpoint and learner != None:
+        torch.save(network.state_dict(), checkpoint)
+    report = server.stats()
+    report['version'] = version
+    report['transitions_per_sec'] = report['transitions'] / elapsed
+    return report
+
+def run_local(num_actors, num_batches, game_format='random'):
+    """Runs a stand-in learner and num_actors actor processes on localhost,
+    returns the learner's report"""
+    server = FleetServer('localhost', 0)
+    pool = multiprocessing.Pool(num_actors)
+    pool.starmap_async(run_fleet_actor, [('localhost', server.port,
+        i, num_actors, None, game_format) for i in range(num_actors)])
+    try:
+        report = run_learner(server, num_batches, publish_every=10)
+    finally:
+        #Actors reconnect forever, so stop them. Their simulators exit when
+        #their input closes.
+        server.close()
+        pool.terminate()
+    return report
+
+if __name__ == '__main__':
+    logging.basicConfig(filename='showdown.log', level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description='Train with actors on other hosts over TCP')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    learner_parser = subparsers.add_parser('learner',
+        help='Serve actors and train on their transitions')
+    learner_parser.add_argument('-p', '--port', type=int, default=PORT)
+    learner_parser.add_argument('-n', '--steps', type=int, default=100000,
+        help='Number of learner steps, or batches for a stand-in learner')
+    learner_parser.add_argument('-c', '--capacity', type=int, default=50000,
+        help='Replay memory capacity')
+    learner_parser.add_argument('--learn-start', type=int, default=1000,
+        help='Transitions to collect before learning')
+    learner_parser.add_argument('-w', '--window', type=int, default=4,
+        help='Batches each actor can send ahead of the learner')
+    learner_parser.add_argument('--stand-in', action='store_true',
+        help="Don't train, only receive batches and publish weights")
+    learner_parser.add_argument('-o', '--output', default='dqn.pt',
+        help='File to save the network weights to')
+    actor_parser = subparsers.add_parser('actor',
+        help='Play games and send transitions to a learner')
+    actor_parser.add_argument('host', help='Host of the learner')
+    actor_parser.add_argument('-p', '--port', type=int, default=PORT)
+    actor_parser.add_argument('-a', '--actors', type=int,
+        default=multiprocessing.cpu_count(),
+        help='Number of actor processes on this host')
+    actor_parser.add_argument('-i', '--first-id', type=int, default=0,
+        help='Id of the first actor on this host')
+    actor_parser.add_argument('-t', '--total', type=int,
+        help='Number of actors on all hosts, for exploration rates')
+    actor_parser.add_argument('-g', '--games', type=int,
+        help='Games per actor, unlimited by default')
+    local_parser = subparsers.add_parser('local',
+        help='Run a stand-in learner and actors on localhost')
+    local_parser.add_argument('-a', '--actors', type=int, default=2)
+    local_parser.add_argument('-n', '--batches', type=int, default=100)
+    args = parser.parse_args()
+    if args.command == 'learner':
+        server = FleetServer(port=args.port, window=args.window)
+        memory = None if args.stand_in else make_memory(args.capacity)
+        try:
+            report = run_learner(server, args.steps, memory,
+                args.learn_start, checkpoint=args.output)
+        finally:
+            server.close()
+    elif args.command == 'actor':
+        total = args.total or args.first_id + args.actors
+        with multiprocessing.Pool(args.actors) as pool:
+            report = pool.starmap(run_fleet_actor, [(args.host, args.port,
+                args.first_id + i, total, args.games)
+                for i in range(args.actors)])
+    else:
+        report = run_local(args.actors, args.batches)
+    json.dump(report, sys.stdout, indent=2)
+    print()
@@ -0,0 +1,223 @@
+import os
+import sys
+import argparse
+import json
+import math
+import selectors
+import socket
+import threading
+import time
+from collections import Counter, deque
+import numpy as np
+from agents.base_agent import Agent, NUM_ACTIONS
+from features import NUM_FEATURES
+
+SOCKET_PATH = '/tmp/pokemon-rl-inference.sock'
+#A request is the float32 features followed by the uint8 legal action mask,
+#a response is the int32 action
+OBS_BYTES = NUM_FEATURES * 4
+REQUEST_BYTES = OBS_BYTES + NUM_ACTIONS
+RESPONSE_BYTES = 4
+
+def random_policy(obs, masks):
+    """Chooses a random legal action for each observation"""
+    scores = np.random.random(masks.shape)
+    scores[~masks] = -1
+    return scores.argmax(axis=1)
+
+class InferenceServer:
+    """Chooses actions for many clients, batching their requests.
+
+    Clients connect over a Unix socket and send features and legal action
+    masks. Requests are queued until max_batch of them are waiting, every
+    connected client is waiting, or the oldest has waited max_wait seconds,
+    then policy(obs, masks) is called
+    once for the whole batch. policy gets (B, 931) float32 and (B, 10) bool
+    arrays and returns B actions.
+    """
+    def __init__(self, policy, path=SOCKET_PATH, max_batch=64,
+            max_wait=0.002):
+        self.policy = policy
+        self.path = path
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.pending = deque()
+        self.buffers = {}
+        self.batch_sizes = Counter()
+        self.latencies = Counter()
+        self.requests = 0
+        self.closed = False
+        if os.path.exists(path):
+            os.unlink(path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen()
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self.thread = None
+
+    def start(self):
+        """Serves from a background thread"""
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        while not self.closed:
+            #Wake up when the oldest request has waited long enough
+            timeout = 0.1
+            if self.pending:
+                waited = time.perf_counter() - self.pending[0][2]
+                timeout = max(0, self.max_wait - waited)
+            for key, _ in self.selector.select(timeout):
+                if key.fileobj is self.listener:
+                    conn, _ = self.listener.accept()
+                    self.buffers[conn] = bytearray()
+                    self.selector.register(conn, selectors.EVENT_READ)
+                else:
+                    self.read(key.fileobj)
+            #Clients wait for their action, so with every client waiting no
+            #more requests can come
+            full = min(self.max_batch, len(self.buffers))
+            if self.pending and (len(self.pending) >= full or
+                    time.perf_counter() - self.pending[0][2] >= self.max_wait):
+                self.run_batch()
+
+    def read(self, conn):
+        try:
+            data = conn.recv(65536)
+        except OSError:
+            #A client that exits with unread responses resets the connection
+            data = b''
+        if not data:
+            self.drop(conn)
+            return
+        buf = self.buffers[conn]
+        buf += data
+        now = time.perf_counter()
+        while len(buf) >= REQUEST_BYTES:
+            self.pending.append((conn, bytes(buf[:REQUEST_BYTES]), now))
+            del buf[:REQUEST_BYTES]
+
+    def drop(self, conn):
+        """Closes a client's connection and forgets its requests"""
+        self.selector.unregister(conn)
+        del self.buffers[conn]
+        conn.close()
+        self.pending = deque(p for p in self.pending if p[0] is not conn)
+
+    def run_batch(self):
+        n = min(len(self.pending), self.max_batch)
+        batch = [self.pending.popleft() for i in range(n)]
+        data = np.frombuffer(b''.join(request for _, request, _ in batch),
+            dtype=np.uint8).reshape(n, REQUEST_BYTES)
+        obs = data[:, :OBS_BYTES].copy().view(np.float32)
+        masks = data[:, OBS_BYTES:].astype(bool)
+        actions = np.asarray(self.policy(obs, masks), dtype=np.int32)
+        now = time.perf_counter()
+        for (conn, _, arrived), action in zip(batch, actions):
+            try:
+                conn.sendall(action.tobytes())
+            except OSError:
+                #The client left
+                if conn in self.buffers:
+                    self.drop(conn)
+            #Latency from arrival to response, in power of 2 microseconds
+            us = max((now - arrived) * 1e6, 1)
+            self.latencies[2 ** math.ceil(math.log2(us))] += 1
+        self.batch_sizes[n] += 1
+        self.requests += n
+
+    def stats(self):
+        """Returns the number of requests and batches, and histograms of
+        batch sizes and of queue latency in microseconds, where each bucket
+        counts latencies up to its key"""
+        return {
+            'requests': self.requests,
+            'batches': sum(self.batch_sizes.values()),
+            'mean_batch_size': self.requests / max(sum(
+                self.batch_sizes.values()), 1),
+            'batch_sizes': dict(sorted(self.batch_sizes.items())),
+            'latency_us': dict(sorted(self.latencies.items()))
+        }
+
+    def close(self):
+        self.closed = True
+        if self.thread:
+            self.thread.join()
+        for conn in list(self.buffers):
+            conn.close()
+        self.selector.close()
+        self.listener.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+class InferenceClient:
+    """Connection to an InferenceServer"""
+    def __init__(self, path=SOCKET_PATH):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+
+    def act(self, obs, mask):
+        """Returns the action the server's policy chooses"""
+        self.sock.sendall(np.asarray(obs, dtype=np.float32).tobytes() +
+            np.asarray(mask, dtype=np.uint8).tobytes())
+        response = b''
+        while len(response) < RESPONSE_BYTES:
+            data = self.sock.recv(RESPONSE_BYTES - len(response))
+            if not data:
+                raise EOFError('Inference server closed the connection')
+            response += data
+        return int(np.frombuffer(response, dtype=np.int32)[0])
+
+    def close(self):
+        self.sock.close()
+
+class RemoteAgent(Agent):
+    """Agent whose actions are chosen by an InferenceServer"""
+    def __init__(self, player_name, path=SOCKET_PATH):
+        self.client = InferenceClient(path)
+        super().__init__(player_name)
+
+    def choose_action(self):
+        if self.wait_game:
+            return None
+        if self.choose_start:
+            choice = 'team 1'
+        else:
+            action = self.client.act(self.game_to_features(),
+                self.legal_actions())
+            choice = self.action_to_choice(action)
+        self.wait_game = True
+        self.force_switch = False
+        self.choose_start = False
+        return choice
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Serve actions to RemoteAgents over a Unix socket')
+    parser.add_argument('-m', '--model',
+        help='Network weights saved with torch.save(network.state_dict()), '
+        'random actions are served if not given')
+    parser.add_argument('-s', '--socket', default=SOCKET_PATH,
+        help='Path of the Unix socket')
+    parser.add_argument('-b', '--max-batch', type=int, default=64,
+        help='Largest batch to run the policy on')
+    parser.add_argument('-w', '--max-wait', type=float, default=2,
+        help='Longest time in ms a request waits for a batch to fill')
+    args = parser.parse_args()
+    policy = random_policy
+    if args.model:
+        import torch
+        from agents.dqn_agent import Network, QPolicy
+        network = Network()
+        network.load_state_dict(torch.load(args.model))
+        network.eval()
+        policy = QPolicy(network)
+    server = InferenceServer(policy, args.socket, args.max_batch,
+        args.max_wait / 1000)
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        json.dump(server.stats(), sys.stdout, indent=2)
+        print()
+        server.close()
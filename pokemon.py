@@ -1,36 +1,76 @@
 import re
+from collections import namedtuple
+from collections.abc import MutableMapping
+from operator import attrgetter
+from types import MappingProxyType
+import numpy as np
 from dex import *
 
-class Move:
-    def __init__(self, name, pp=None, disabled=False):
-        #For some reason hidden power adds a '60' at the end of the move name
-        #in the console, but not in the movedex
-        m = re.match('(hiddenpower.*)60', name)
+#For some reason hidden power adds a '60' at the end of the move name
+#in the console, but not in the movedex
+HIDDEN_POWER_RE = re.compile('(hiddenpower.*)60')
+
+class MoveSpec(namedtuple('MoveSpec', ['name', 'move_type', 'category',
+        'power', 'accuracy', 'priority', 'maxpp', 'target'])):
+    """Move data that doesn't change during a battle. There is one MoveSpec
+    per move, shared by every Move, and it is found with MoveSpec.get."""
+    __slots__ = ()
+    specs = {}
+
+    @classmethod
+    def get(cls, name):
+        spec = cls.specs.get(name)
+        if spec == None:
+            spec = cls.from_dex(name)
+            cls.specs[name] = spec
+        return spec
+
+    @classmethod
+    def from_dex(cls, name):
+        m = HIDDEN_POWER_RE.match(name)
         if m:
             name = m.group(1)
-        self.name = name
         data = movedex[name]
-        self.move_type = clean_name(data['type'])
-        self.category = clean_name(data['category'])
-        self.power = data['basePower']
-        self.accuracy = data['accuracy']
-        if isinstance(self.accuracy, bool):
-            self.accuracy = 100
-        self.priority = data['priority']
-        self.maxpp = int(data['pp'] * 1.6)
+        move_type, category, power, accuracy, priority, target = move_data(data)
+        return cls(name, move_type, category, power, accuracy, priority,
+            int(data['pp'] * 1.6), target)
+
+    def __reduce__(self):
+        return (MoveSpec.get, (self.name,))
+
+    def __deepcopy__(self, memo):
+        return self
+
+class Move:
+    """A move of a pokemon in battle. Only pp and disabled change, the rest
+    is read from the move's MoveSpec. Once a move is in a pokemon's moves,
+    it is replaced with with_state instead of changed, so snapshots can
+    share it."""
+    __slots__ = ('spec', 'pp', 'maxpp', 'disabled')
+
+    def __init__(self, name, pp=None, disabled=False):
+        self.spec = MoveSpec.get(name)
+        self.maxpp = self.spec.maxpp
         self.pp = pp or self.maxpp
-        #Some target types are only different in doubles mode
-        target_normal = ['any', 'allAdjacentFoes', 'scripted', 'normal',
-            'allAdjacent', 'adjacentFoe','randomNormal']
-        target_self = ['adjacentAllyOrSelf', 'self']
-        target = data['target']
-        if target in target_normal:
-            target = 'normal'
-        elif target in target_self:
-            target = 'self'
-        self.target = target
         self.disabled = disabled
 
+    def with_state(self, pp, disabled):
+        """Returns a copy of this move with pp and disabled changed"""
+        move = Move.__new__(Move)
+        move.spec = self.spec
+        move.maxpp = self.maxpp
+        move.pp = pp
+        move.disabled = disabled
+        return move
+
+    name = property(attrgetter('spec.name'))
+    move_type = property(attrgetter('spec.move_type'))
+    category = property(attrgetter('spec.category'))
+    power = property(attrgetter('spec.power'))
+    accuracy = property(attrgetter('spec.accuracy'))
+    priority = property(attrgetter('spec.priority'))
+    target = property(attrgetter('spec.target'))
+
     @classmethod
     def from_data(cls, data):
         name = data['id']
@@ -41,15 +81,45 @@ class Move:
     def __str__(self):
         return '{} pp={}/{}'.format(self.name, self.pp, self.maxpp)
 
+class Species(namedtuple('Species', ['name', 'abilities', 'base_stats',
+        'types'])):
+    """Pokedex data of a pokemon. There is one Species per pokemon, shared
+    by every Pokemon, and it is found with Species.get. abilities and types
+    are tuples and base_stats is a read-only mapping."""
+    __slots__ = ()
+    species = {}
+
+    @classmethod
+    def get(cls, name):
+        species = cls.species.get(name)
+        if species == None:
+            data = pokedex[name]
+            species = cls(name, tuple(data['abilities']),
+                MappingProxyType(dict(data['baseStats'])), tuple(data['types']))
+            cls.species[name] = species
+        return species
+
+    def __reduce__(self):
+        #Copies and unpickling get the shared Species
+        return (Species.get, (self.name,))
+
+    def __deepcopy__(self, memo):
+        return self
+
 class Pokemon:
+    """A pokemon in battle. Data from the pokedex is shared through its
+    Species, and types and base stats are only copied when a battle effect
+    changes them."""
+    __slots__ = ('species', 'level', 'gender', 'nickname', 'health',
+        'max_health', 'status', 'moves', 'stats', 'base_ability', 'ability',
+        'item', 'transformed', 'moves_backup', '_types', '_base_stats')
+
     def __init__(self, name, level, gender, nickname, health, max_health, status,
             moves, stats=None, base_ability=None, ability=None, item=None):
         #NOTE: For attributes, None means unknown, '' means none
-        self.name = name
-        data = pokedex[name]
-        self.abilities = data['abilities']
-        self.base_stats = data['baseStats']
-        self.types = data['types']
+        self.species = Species.get(name)
+        self._types = None
+        self._base_stats = None
         self.level = level
         self.gender = gender
         self.nickname = nickname
@@ -67,6 +137,30 @@ class Pokemon:
         self.transformed = False
         self.moves_backup = None
 
+    @property
+    def name(self):
+        return self.species.name
+
+    @property
+    def abilities(self):
+        return self.species.abilities
+
+    @property
+    def types(self):
+        if self._types == None:
+            return self.species.types
+        return self._types
+
+    @types.setter
+    def types(self, types):
+        self._types = types
+
+    @property
+    def base_stats(self):
+        if self._base_stats == None:
+            return self.species.base_stats
+        return self._base_stats
+
     @staticmethod
     def get_details(details):
         m = re.match('([^,]*)(?:, L(\d+))?(?:, ([MF]))?', details)
@@ -104,11 +198,9 @@ class Pokemon:
         return cls(name, level, gender, nickname, health, max_health, status, moves)
 
     def change_form(self, name):
-        self.name = name
-        data = pokedex[name]
-        self.abilities = data['abilities']
-        self.base_stats = data['baseStats']
-        self.types = data['types']
+        self.species = Species.get(name)
+        self._types = None
+        self._base_stats = None
         if len(self.abilities) == 1:
             self.base_ability = self.abilities[0]
             self.ability = self.abilities[0]
@@ -116,6 +208,20 @@ class Pokemon:
             self.base_ability = None
             self.ability = None
 
+    def update_moves(self, moves_data):
+        """Updates moves from request data, reusing the Move objects that
+        haven't changed"""
+        moves = self.moves
+        if len(moves) == len(moves_data) and all(m != None and
+                m.spec is MoveSpec.get(d['id']) for m, d in zip(moves, moves_data)):
+            states = [(d.get('pp') or m.maxpp, d.get('disabled', False))
+                for m, d in zip(moves, moves_data)]
+            if states != list(map(move_fields, moves)):
+                self.moves = [m if state == (m.pp, m.disabled)
+                    else m.with_state(*state) for m, state in zip(moves, states)]
+        else:
+            self.moves = list(map(Move.from_data, moves_data))
+
     def set_ability(self, ability):
         #Updates base_ability if it doesn't exist
         if self.base_ability == None:
@@ -131,28 +237,31 @@ class Pokemon:
             self.transformed = False
             self.moves = self.moves_backup
         self.ability = self.base_ability
-        data = pokedex[self.name]
-        self.base_stats = data['baseStats']
-        self.types = data['types']
+        self._types = None
+        self._base_stats = None
 
     def transform(self, pokemon):
         self.transformed = True
         self.ability = pokemon.ability
-        self.types = pokemon.types.copy()
+        self.types = list(pokemon.types)
         self.moves_backup = self.moves
-        self.moves = []
+        moves = []
         for move in pokemon.moves:
             copy = Move(move.name, 5)
             copy.maxpp = 5
-            self.moves.append(copy)
+            moves.append(copy)
+        self.moves = moves
+        #Copy the stats, since the species' stats are shared
+        base_stats = dict(self.base_stats)
         for stat in pokemon.base_stats:
             if stat != 'hp':
-                self.base_stats[stat] = pokemon.base_stats[stat]
+                base_stats[stat] = pokemon.base_stats[stat]
+        self._base_stats = base_stats
 
     def __str__(self):
         d = {}
         d['name'] = self.name
-        d['types'] = self.types
+        d['types'] = list(self.types)
         d['health'] = self.health
         d['max_health'] = self.max_health
         d['status'] = self.status
@@ -162,22 +271,30 @@ class Pokemon:
         d['item'] = self.item
         return str(d)
 
+#Pokemon fields that can change in battle, saved by GameData.snapshot
+POKEMON_FIELDS = ('species', 'health', 'max_health', 'status', 'stats',
+    'base_ability', 'ability', 'item', 'transformed', '_types', '_base_stats',
+    'moves', 'moves_backup')
+pokemon_fields = attrgetter(*POKEMON_FIELDS)
+move_fields = attrgetter('pp', 'disabled')
+
 class GameData:
+    boosts_ = ['atk', 'def', 'spa', 'spd', 'spe', 'accuracy', 'evasion']
+    poke_effects_ = ['confusion', 'curse', 'embargo', 'encore',
+        'healblock', 'foresight', 'miracleeye', 'attract', 'leechseed',
+        'nightmare', 'perish3', 'perish2', 'perish1', 'taunt', 'telekinesis',
+        'torment', 'aquaring', 'ingrain', 'magnetrise', 'powertrick',
+        'focusenergy', 'substitute']
+    side_effects_ = ['stealthrock', 'spikes', 'toxicspikes',
+        'stickyweb', 'tailwind', 'auroraveil', 'reflect', 'lightscreen',
+        'safeguard', 'mist', 'luckychant']
+    weathers_ = ['sunnyday', 'desolateland', 'raindance',
+        'primordialsea', 'sandstorm', 'hail', 'deltastream']
+    terrains_ = ['electricterrain', 'grassyterrain', 'mistyterrain',
+        'psychicterrain']
+    field_effects_ = ['wonderroom', 'magicroom', 'trickroom', 'gravity']
+
     def __init__(self):
-        self.boosts_ = ['atk', 'def', 'spa', 'spd', 'spe', 'accuracy', 'evasion']
-        self.poke_effects_ = ['confusion', 'curse', 'embargo', 'encore',
-            'healblock', 'foresight', 'miracleeye', 'attract', 'leechseed',
-            'nightmare', 'perish3', 'perish2', 'perish1', 'taunt', 'telekinesis',
-            'torment', 'aquaring', 'ingrain', 'magnetrise', 'powertrick',
-            'focusenergy', 'substitute']
-        self.side_effects_ = ['stealthrock', 'spikes', 'toxicspikes',
-            'stickyweb', 'tailwind', 'auroraveil', 'reflect', 'lightscreen',
-            'safeguard', 'mist', 'luckychant']
-        self.weathers_ = ['sunnyday', 'desolateland', 'raindance',
-            'primordialsea', 'sandstorm', 'hail', 'deltastream']
-        self.terrains_ = ['electricterrain', 'grassyterrain', 'mistyterrain',
-            'psychicterrain']
-        self.field_effects_ = ['wonderroom', 'magicroom', 'trickroom', 'gravity']
         self.team = None
         self.active = None
         self.mega = False
@@ -209,6 +326,12 @@ class GameData:
         self.opp_active = None
         self.opp_mega = False
         self.opp_zmove = False
+        self.weather = None
+        self.terrain = None
+        self.reset_effects()
+
+    def reset_effects(self):
+        """Clears all boosts and effects"""
         for stat in self.boosts_:
             self.boosts[stat] = 0
             self.opp_boosts[stat] = 0
@@ -222,13 +345,166 @@ class GameData:
             else:
                 self.side_effects[eff] = False
                 self.opp_side_effects[eff] = False
-        self.weather = None
-        self.terrain = None
         for eff in self.field_effects:
             self.field_effects[eff] = False
-        
+
+    def clear_boosts(self, opp):
+        b = self.opp_boosts if opp else self.boosts
+        for stat in b:
+            b[stat] = 0
+
+    def clear_poke_effects(self, opp):
+        effects = self.opp_poke_effects if opp else self.poke_effects
+        for eff in effects:
+            effects[eff] = False
+
+    def snapshot(self):
+        """Returns the battle state for restore. Pokemon objects are shared
+        with this GameData, and only their fields that change in battle are
+        copied. Objects held by those fields, including the moves lists and
+        the Move objects in them, are replaced instead of changed, so they
+        are shared too."""
+        team = self.team
+        opp_team = self.opp_team
+        pokemon = list(team or ())
+        if opp_team:
+            pokemon.extend(filter(None, opp_team))
+        return (team and tuple(team), self.active, self.mega, self.zmove,
+            opp_team and tuple(opp_team), self.opp_active, self.opp_mega,
+            self.opp_zmove, self.weather, self.terrain, self.save_effects(),
+            pokemon, list(map(pokemon_fields, pokemon)))
+
+    def restore(self, snapshot):
+        (team, self.active, self.mega, self.zmove, opp_team, self.opp_active,
+            self.opp_mega, self.opp_zmove, self.weather, self.terrain, effects,
+            pokemon, fields) = snapshot
+        self.team = team and list(team)
+        self.opp_team = opp_team and list(opp_team)
+        self.restore_effects(effects)
+        #Most pokemon don't change between snapshot and restore, so only
+        #changed ones are written
+        current = list(map(pokemon_fields, pokemon))
+        if current != fields:
+            for p, old, new in zip(pokemon, current, fields):
+                if old != new:
+                    for name, value in zip(POKEMON_FIELDS, new):
+                        setattr(p, name, value)
+
+    def save_effects(self):
+        return (self.boosts.copy(), self.opp_boosts.copy(),
+            self.poke_effects.copy(), self.opp_poke_effects.copy(),
+            self.side_effects.copy(), self.opp_side_effects.copy(),
+            self.field_effects.copy())
+
+    def restore_effects(self, effects):
+        #Copy again, so a snapshot can be restored more than once
+        (self.boosts, self.opp_boosts, self.poke_effects, self.opp_poke_effects,
+            self.side_effects, self.opp_side_effects,
+            self.field_effects) = map(dict, effects)
+
     def boost_list(self):
         return [self.boosts[stat] for stat in self.boosts_]
 
     def opp_boost_list(self):
         return [self.opp_boosts[stat] for stat in self.boosts_]
+
+class StateView(MutableMapping):
+    """Dict-like view of a slice of an ArrayGameData state array, with one
+    key per element. Keys can't be added or removed."""
+    __slots__ = ('array', 'index')
+
+    def __init__(self, array, keys):
+        self.array = array
+        self.index = {key:i for i, key in enumerate(keys)}
+
+    def __getitem__(self, key):
+        return self.array[self.index[key]]
+
+    def __setitem__(self, key, value):
+        self.array[self.index[key]] = value
+
+    def __delitem__(self, key):
+        raise TypeError('StateView keys can\'t be removed')
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def copy(self):
+        return dict(zip(self.index, self.array.tolist()))
+
+    def __repr__(self):
+        return 'StateView({!r})'.format(self.copy())
+
+def state_view(name):
+    """Property for a StateView of ArrayGameData. Assigning a mapping to it
+    copies the values into the state array."""
+    def get(self):
+        return self.views[name]
+    def set(self, values):
+        self.views[name].update(values)
+    return property(get, set)
+
+class ArrayGameData(GameData):
+    """GameData that keeps boosts and effects in one float32 array, state.
+
+    boosts, poke_effects, side_effects, field_effects and their opp_
+    versions are StateViews of it. They are laid out like in the feature
+    vector, so state[BOOSTS] etc. can be copied into the features directly.
+    Resetting is a fill and copying the state is a single array copy.
+    """
+    PARTS = [('boosts', GameData.boosts_), ('opp_boosts', GameData.boosts_),
+        ('poke_effects', GameData.poke_effects_),
+        ('opp_poke_effects', GameData.poke_effects_),
+        ('side_effects', GameData.side_effects_),
+        ('opp_side_effects', GameData.side_effects_),
+        ('field_effects', GameData.field_effects_)]
+    BOOSTS = slice(0, 14)
+    POKE_EFFECTS = slice(14, 58)
+    SIDE_EFFECTS = slice(58, 80)
+    FIELD_EFFECTS = slice(80, 84)
+    STATE_LEN = 84
+
+    boosts = state_view('boosts')
+    opp_boosts = state_view('opp_boosts')
+    poke_effects = state_view('poke_effects')
+    opp_poke_effects = state_view('opp_poke_effects')
+    side_effects = state_view('side_effects')
+    opp_side_effects = state_view('opp_side_effects')
+    field_effects = state_view('field_effects')
+
+    def __init__(self):
+        self.state = np.zeros(self.STATE_LEN, dtype=np.float32)
+        self.views = {}
+        offset = 0
+        for name, keys in self.PARTS:
+            array = self.state[offset:offset + len(keys)]
+            self.views[name] = StateView(array, keys)
+            offset += len(keys)
+        super().__init__()
+
+    def reset_effects(self):
+        self.state.fill(0)
+
+    def save_effects(self):
+        return self.state.copy()
+
+    def restore_effects(self, effects):
+        np.copyto(self.state, effects)
+
+    def clear_boosts(self, opp):
+        self.views['opp_boosts' if opp else 'boosts'].array.fill(0)
+
+    def clear_poke_effects(self, opp):
+        self.views['opp_poke_effects' if opp else 'poke_effects'].array.fill(0)
+
+    def boost_list(self):
+        return self.views['boosts'].array.tolist()
+
+    def opp_boost_list(self):
+        return self.views['opp_boosts'].array.tolist()
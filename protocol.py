@@ -0,0 +1,41 @@
+import re
+
+KWARG_RE = re.compile(r'\[([a-z]*)\] (.*)')
+
+class Event:
+    """A protocol message split into its arguments.
+
+    args is the message split on '|' without the [keyword] arguments, so
+    args[1] is the message type. kwargs maps keywords to their values.
+    Events are shared between agents, so they shouldn't be modified.
+    """
+    __slots__ = ('line', 'type', 'args', 'kwargs')
+
+    def __init__(self, line, args, kwargs):
+        self.line = line
+        self.type = args[1]
+        self.args = args
+        self.kwargs = kwargs
+
+    def __repr__(self):
+        return 'Event({!r})'.format(self.line)
+
+def decode(message):
+    """Returns the Event for a protocol message, or None if the message
+    isn't one"""
+    if not message.startswith('|'):
+        return None
+    args = message.split('|')
+    kwargs = {}
+    #Only look for keyword arguments when there could be some
+    if '|[' in message:
+        positional = []
+        for arg in args:
+            m = KWARG_RE.match(arg)
+            if m:
+                #The first of repeated keywords wins
+                kwargs.setdefault(m.group(1), m.group(2))
+            else:
+                positional.append(arg)
+        args = positional
+    return Event(message, tuple(args), kwargs)
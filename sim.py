@@ -1,149 +1,206 @@
 import sys
 import logging
 import argparse
-import os
-import threading
-import subprocess
-import time
+import json
 from agents.base_agent import Agent
+from sim_io import SimProcess
+from protocol import decode
 
 class SimRunner:
-    def __init__(self, agent1, agent2):
+    def __init__(self, agent1, agent2, sim=None, pool=None):
         self.agent1 = agent1
         self.agent2 = agent2
-
-        if not os.path.exists('sim_in'):
-            os.mkfifo('sim_in')
-        if not os.path.exists('sim_out'):
-            os.mkfifo('sim_out')
-        t1 = threading.Thread(target=self._open_sim_pipes)
-        t2 = threading.Thread(target=self.open_pipes)
-        t1.start()
-        t2.start()
-        t1.join()
-        t2.join()
-        self.sim = subprocess.Popen(
-            ['./Pokemon-Showdown/pokemon-showdown', 'simulate-battle'],
-            stdin=self._sim_in,
-            stdout=self._sim_out
-        )
+        #With a pool, every game gets a fresh simulator from the pool
+        self.pool = pool
+        self.sim_used = False
+        self.sim = sim or self.spawn_sim()
         self.logger = logging.getLogger(__name__)
         if len(self.logger.handlers) == 0:
             self.logger.addHandler(logging.StreamHandler())
+        self.listeners = []
+        #Choices the simulator rejected, as (player, error message)
+        self.errors = []
+        #Request flags of each agent's last choice, to ask again on an error
+        self.choosing = {}
         self.game_end = False
+        self.winner = None
+        self.turns = 0
 
-    def _open_sim_pipes(self):
-        """Opens pipes for internal simulator to use"""
-        self._sim_in = open('sim_in', 'r')
-        self._sim_out = open('sim_out', 'w')
-
-    def open_pipes(self):
-        """Opens pipes to read from and write to simulator"""
-        self.sim_in = open('sim_in', 'w')
-        #Need non-blocking pipe
-        self.sim_out = os.fdopen(os.open('sim_out', os.O_RDONLY | os.O_NONBLOCK))
+    def spawn_sim(self):
+        if self.pool is not None:
+            return self.pool.acquire()
+        return SimProcess()
 
     def write_sim(self, message):
-        self.sim_in.write(message + '\n')
-        self.sim_in.flush()
-
-    def read_sim(self):
-        #If sim_out is empty, message will be the empty string
-        message = self.sim_out.readline()
-        #Wait a little if empty to make sure it really is empty
-        if message == '':
-            time.sleep(.01)
-            message = self.sim_out.readline()
-        return message
-
-    def start(self, game_format='random', p1team=None, p2team=None):
+        self.sim.write(message)
+
+    def read_sim(self, timeout=None):
+        """Returns the next output chunk of the simulator as a list of lines"""
+        return self.sim.read_chunk(timeout)
+
+    def start_messages(self, game_format='random', p1team=None,
+            p2team=None, seed=None):
+        """Returns the messages that start a game, or None if a team is
+        missing. seed is a list of 4 integers for the simulator's PRNG."""
+        options = {'formatid':'gen7randombattle'}
+        if seed != None:
+            options['seed'] = seed
         if game_format == 'random':
-            self.write_sim('>start {"formatid":"gen7randombattle"}')
-            self.write_sim('>player p1 {"name":"%s"}' % self.agent1.player_name)
-            self.write_sim('>player p2 {"name":"%s"}' % self.agent2.player_name)
-        else:
-            if p1team == None or p2team == None:
-                self.logger.error('Missing teams')
-                return
-            self.write_sim('>start {"formatid":"gen7%s"}' % game_format)
-            self.write_sim('>player p1 {"name":"%s", "team":"%s"}'
-                % (self.agent1.player_name, p1team))
-            self.write_sim('>player p2 {"name":"%s", "team":"%s"}'
-                % (self.agent2.player_name, p2team))
+            return ['>start ' + json.dumps(options),
+                '>player p1 {"name":"%s"}' % self.agent1.player_name,
+                '>player p2 {"name":"%s"}' % self.agent2.player_name]
+        if p1team == None or p2team == None:
+            self.logger.error('Missing teams')
+            return None
+        options['formatid'] = 'gen7' + game_format
+        return ['>start ' + json.dumps(options),
+            '>player p1 {"name":"%s", "team":"%s"}'
+                % (self.agent1.player_name, p1team),
+            '>player p2 {"name":"%s", "team":"%s"}'
+                % (self.agent2.player_name, p2team)]
+
+    def start(self, game_format='random', p1team=None, p2team=None,
+            seed=None):
+        if self.pool is not None and self.sim_used:
+            self.pool.release(self.sim)
+            self.sim = self.pool.acquire()
+        self.sim_used = True
+        messages = self.start_messages(game_format, p1team, p2team, seed)
+        for message in messages or []:
+            self.write_sim(message)
 
     def run_until_request(self, silent=True):
-        #Wait until sim_out has a message
-        message = self.read_sim()
-        while message == '':
-            time.sleep(.01)
-            message = self.read_sim()
-        mode = 'both'
-        #Read until sim_out has no more messages
-        while message != '':
-            message = message.strip()
-            if not silent:
+        requested = False
+        while True:
+            chunk = self.read_sim()
+            self.process_chunk(chunk, silent=silent)
+            if self.waiting_for_input(chunk, requested):
+                break
+            requested = requested or chunk[0] == 'sideupdate'
+
+    def waiting_for_input(self, chunk, requested):
+        """Returns whether the simulator is waiting for input after chunk"""
+        #After both players choose, the simulator sends a sideupdate with a
+        #request for each player followed by an update with the battle log.
+        #An error also means it is waiting for input.
+        kind = chunk[0]
+        if kind == 'sideupdate':
+            return any(m.startswith('|error|') for m in chunk)
+        return kind == 'end' or (kind == 'update' and requested)
+
+    def add_listener(self, listener):
+        """Adds a function called as listener(player, event) for every
+        event, where player is '1', '2' or None if both players see it"""
+        self.listeners.append(listener)
+
+    def decode(self, message):
+        return decode(message)
+
+    def send_event(self, player, event):
+        if player != '2':
+            self.agent1.process_event(event)
+        if player != '1':
+            self.agent2.process_event(event)
+        for listener in self.listeners:
+            listener(player, event)
+
+    def process_chunk(self, chunk, silent=True):
+        """Sends the messages of a chunk to the agents, returns the chunk type"""
+        kind = chunk[0]
+        if not silent:
+            for message in chunk:
                 self.logger.info(message)
-            if message == 'end':
-                self.game_end = True
-            if mode == 'both':
-                if message == 'sideupdate':
-                    mode = 'sideupdate'
-                elif message == '|split':
-                    mode = 'splitspectator'
-                else:
-                    self.agent1.process_message(message)
-                    self.agent2.process_message(message)
-            elif mode == 'sideupdate':
-                mode = 'sideupdate' + message
-            elif mode == 'sideupdatep1':
-                self.agent1.process_message(message)
-                mode = 'both'
-            elif mode == 'sideupdatep2':
-                self.agent2.process_message(message)
-                mode = 'both'
-            elif mode == 'splitspectator':
-                mode = 'splitp1'
-            elif mode == 'splitp1':
-                self.agent1.process_message(message)
-                mode = 'splitp2'
-            elif mode == 'splitp2':
-                self.agent2.process_message(message)
-                mode = 'splitomniscient'
-            elif mode == 'splitomniscient':
-                mode = 'both'
-            else:
-                #Unexpected, shouldn't be here
-                mode = 'both'
-            message = self.read_sim()
+        if kind == 'end':
+            self.game_end = True
+        elif kind == 'sideupdate':
+            player = chunk[1][1]
+            for message in chunk[2:]:
+                if message.startswith('|error|'):
+                    self.reject_choice(player, message)
+                    continue
+                event = self.decode(message)
+                if event:
+                    self.send_event(player, event)
+        elif kind == 'update':
+            #Each message is decoded once and the same event is sent to both
+            #agents. After |split come the spectator, p1, p2 and omniscient
+            #versions of a message.
+            mode = 'both'
+            for message in chunk[1:]:
+                if mode == 'both':
+                    if message == '|split':
+                        mode = 'splitspectator'
+                        continue
+                    event = self.decode(message)
+                    if event == None:
+                        continue
+                    if event.type == 'win':
+                        self.winner = event.args[2]
+                    elif event.type == 'turn':
+                        self.turns = int(event.args[2])
+                    self.send_event(None, event)
+                elif mode == 'splitspectator':
+                    mode = 'splitp1'
+                elif mode == 'splitp1':
+                    event = self.decode(message)
+                    if event:
+                        self.send_event('1', event)
+                    mode = 'splitp2'
+                elif mode == 'splitp2':
+                    event = self.decode(message)
+                    if event:
+                        self.send_event('2', event)
+                    mode = 'splitomniscient'
+                elif mode == 'splitomniscient':
+                    mode = 'both'
+        return kind
+
+    def reject_choice(self, player, message):
+        """Records an error for a choice and makes the agent choose again"""
+        self.errors.append((player, message))
+        self.logger.warning('p%s choice rejected: %s', player, message)
+        agent = self.agent1 if player == '1' else self.agent2
+        if agent in self.choosing:
+            agent.force_switch, agent.choose_start = self.choosing.pop(agent)
+        agent.wait_game = False
+
+    def choose_actions(self, silent=True):
+        """Returns the choice messages of the agents that need to act"""
+        messages = []
+        for agent in (self.agent1, self.agent2):
+            if not agent.wait_game:
+                self.choosing[agent] = (agent.force_switch,
+                    agent.choose_start)
+                choice = agent.choose_action()
+                s = '>p{} {}'.format(agent.player_num, choice)
+                messages.append(s)
+                if not silent:
+                    self.logger.info(s)
+        return messages
 
     def run_actions(self, silent=True):
-        if not self.agent1.wait_game:
-            choice1 = self.agent1.choose_action()
-            s = '>p{} {}'.format(self.agent1.player_num, choice1)
-            self.write_sim(s)
-            if not silent:
-                self.logger.info(s)
-        if not self.agent2.wait_game:
-            choice2 = self.agent2.choose_action()
-            s = '>p{} {}'.format(self.agent2.player_num, choice2)
-            self.write_sim(s)
-            if not silent:
-                self.logger.info(s)
-
-    def run_game(self, game_format='random', silent=True):
+        for message in self.choose_actions(silent=silent):
+            self.write_sim(message)
+
+    def reset_game(self):
+        self.errors = []
+        self.choosing = {}
         self.game_end = False
-        self.start(game_format=game_format)
+        self.winner = None
+        self.turns = 0
+
+    def run_game(self, game_format='random', silent=True, seed=None):
+        self.reset_game()
+        self.start(game_format=game_format, seed=seed)
         while not self.game_end:
             self.run_until_request(silent=silent)
             self.run_actions(silent=silent)
 
     def clean_up(self):
-        self.sim.terminate()
-        self.sim.wait()
-        self._sim_in.close()
-        self._sim_out.close()
-        self.sim_in.close()
-        self.sim_out.close()
+        if self.pool is not None:
+            self.pool.release(self.sim)
+        else:
+            self.sim.close()
 
 if __name__ == '__main__':
     logging.basicConfig(filename='showdown.log', level=logging.INFO)
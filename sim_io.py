@@ -0,0 +1,70 @@
+import os
+import time
+import selectors
+import subprocess
+from collections import deque
+
+SIM_COMMAND = ['./Pokemon-Showdown/pokemon-showdown', 'simulate-battle']
+
+class SimProcess:
+    """A simulate-battle process whose output is read one chunk at a time.
+
+    The simulator separates its output into chunks with blank lines. Each
+    chunk starts with its type ('update', 'sideupdate' or 'end').
+    """
+    def __init__(self, command=SIM_COMMAND):
+        self.proc = subprocess.Popen(command, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE)
+        self._fd = self.proc.stdout.fileno()
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._fd, selectors.EVENT_READ)
+        self._buffer = b''
+        self._chunks = deque()
+        #time.monotonic() when the first output arrived
+        self.first_output_time = None
+
+    def fileno(self):
+        return self._fd
+
+    def write(self, message):
+        self.proc.stdin.write(message.encode() + b'\n')
+        self.proc.stdin.flush()
+
+    def has_chunk(self):
+        """Returns whether a complete chunk is buffered"""
+        return len(self._chunks) > 0
+
+    def feed(self, data):
+        """Adds raw simulator output to the buffer, framing complete chunks"""
+        self._buffer += data
+        *chunks, self._buffer = self._buffer.split(b'\n\n')
+        for chunk in chunks:
+            chunk = chunk.strip(b'\n')
+            if chunk:
+                self._chunks.append(chunk.decode().split('\n'))
+
+    def read_chunk(self, timeout=None):
+        """Returns the next chunk as a list of lines, blocking until one is
+        complete. Raises TimeoutError if none arrives within timeout seconds
+        and EOFError if the simulator exits."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._chunks:
+            remaining = None
+            if deadline is not None:
+                remaining = max(deadline - time.monotonic(), 0)
+            if not self._selector.select(remaining):
+                raise TimeoutError('No output from simulator')
+            data = os.read(self._fd, 65536)
+            if not data:
+                raise EOFError('Simulator exited')
+            if self.first_output_time == None:
+                self.first_output_time = time.monotonic()
+            self.feed(data)
+        return self._chunks.popleft()
+
+    def close(self):
+        self._selector.close()
+        self.proc.terminate()
+        self.proc.wait()
+        self.proc.stdin.close()
+        self.proc.stdout.close()
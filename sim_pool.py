@@ -0,0 +1,115 @@
+import threading
+import time
+from collections import deque
+from sim_io import SimProcess, SIM_COMMAND
+
+class SimPool:
+    """Keeps idle simulator processes spawned ahead of time.
+
+    Each process is used for one game. acquire hands out an idle process and
+    a background thread spawns a replacement, so starting a game doesn't
+    wait for Node to start up.
+
+    stats reports the startup latency of the processes handed out, from
+    acquire until their first output chunk was read, separately for hits
+    and misses. A miss includes Node loading the simulator.
+    """
+    def __init__(self, size=2, command=SIM_COMMAND):
+        self.size = size
+        self.command = command
+        self.hits = 0
+        self.misses = 0
+        self.spawned = 0
+        #Total and max startup latency of hits and misses
+        self.startup = {'hit': [0, 0, 0], 'miss': [0, 0, 0]}
+        #Maps processes handed out to when they were acquired and whether
+        #it was a hit
+        self._acquired = {}
+        self._idle = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._refill, daemon=True)
+        self._thread.start()
+
+    def _spawn(self):
+        sim = SimProcess(self.command)
+        with self._cond:
+            self.spawned += 1
+        return sim
+
+    def _refill(self):
+        with self._cond:
+            while not self._closed:
+                if len(self._idle) >= self.size:
+                    self._cond.wait()
+                    continue
+                self._cond.release()
+                try:
+                    sim = self._spawn()
+                finally:
+                    self._cond.acquire()
+                if self._closed:
+                    sim.close()
+                else:
+                    self._idle.append(sim)
+
+    def acquire(self):
+        """Returns a simulator process, spawning one if none are idle"""
+        start = time.monotonic()
+        with self._cond:
+            sim = None
+            while self._idle:
+                sim = self._idle.popleft()
+                #Drop processes that died while idle
+                if sim.proc.poll() is None:
+                    break
+                sim.close()
+                sim = None
+            hit = sim is not None
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self._cond.notify()
+        if not hit:
+            sim = self._spawn()
+        with self._cond:
+            self._acquired[sim] = (start, hit)
+        return sim
+
+    def release(self, sim):
+        """Shuts down a simulator process after its game is over"""
+        with self._cond:
+            start, hit = self._acquired.pop(sim)
+            if sim.first_output_time != None:
+                latency = sim.first_output_time - start
+                startup = self.startup['hit' if hit else 'miss']
+                startup[0] += 1
+                startup[1] += latency
+                startup[2] = max(startup[2], latency)
+        sim.close()
+
+    def stats(self):
+        """Returns hit and miss counts and the startup latency in seconds of
+        the released processes that produced output"""
+        with self._cond:
+            total = self.hits + self.misses
+            report = {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0,
+                'idle': len(self._idle),
+                'spawned': self.spawned
+            }
+            for kind, (n, latency_total, latency_max) in self.startup.items():
+                report[kind + '_startup_mean'] = latency_total / n if n else 0
+                report[kind + '_startup_max'] = latency_max
+            return report
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        while self._idle:
+            self._idle.popleft().close()
@@ -1,8 +1,37 @@
 import unittest
+import os
+import shutil
 import logging
 import time
-from agents.base_agent import Agent
+import random
+import json
+import asyncio
+import pickle
+import threading
+import socket
+import tempfile
+import torch
+import numpy as np
+from agents.base_agent import Agent, NUM_ACTIONS, handles
 from sim import SimRunner
+from sim_pool import SimPool
+from sim_io import SimProcess
+from async_sim import AsyncSimProcess
+from farm import run_farm
+from protocol import decode
+from features import BatchFeaturizer, NUM_FEATURES, MOVES, MOVE_LEN
+from pokemon import Pokemon, Move, Species, GameData, ArrayGameData
+import dex
+from dex import pokedex, movedex
+from agents.incremental_agent import IncrementalAgent
+from agents.dqn_agent import (Network, ReplayMemory, PrioritizedReplayMemory,
+    MmapReplayMemory, SumTree, SharedWeights)
+from train import Learner, make_memory
+from fleet import (FleetServer, FleetClient, FRAME_HEADER, HELLO,
+    TRANSITIONS, MAX_FRAME, BATCH_FIELDS, encode_frame, encode_json,
+    encode_arrays)
+from benchmarks.featurize import random_game
+from inference import InferenceServer, InferenceClient, random_policy
 
 class TestAgent(Agent):
     def set_actions(self, actions):
@@ -17,16 +46,841 @@ class TestAgent(Agent):
         self.choose_start = False
         return action
 
+class TestDex(unittest.TestCase):
+    def test_cache(self):
+        cwd = os.getcwd()
+        version = dex.CACHE_VERSION
+        with tempfile.TemporaryDirectory() as path:
+            for source in dex.SOURCES:
+                shutil.copy(source, path)
+            os.chdir(path)
+            cache_dir = 'cache'
+            cache_file = os.path.join(cache_dir, dex.CACHE_NAME)
+            def static_files():
+                return [n for n in os.listdir(cache_dir) if n.endswith('.npy')]
+            try:
+                tables, static, cached = dex.load(cache_dir)
+                self.assertFalse(cached)
+                cached_tables, cached_static, cached = dex.load(cache_dir)
+                self.assertTrue(cached)
+                self.assertEqual(cached_tables, tables)
+                for name in dex.STATIC_TABLES:
+                    np.testing.assert_array_equal(cached_static[name],
+                        static[name])
+                #A changed source invalidates the cache
+                with open('movedex.json', 'a') as f:
+                    f.write('\n')
+                self.assertFalse(dex.load(cache_dir)[2])
+                self.assertTrue(dex.load(cache_dir)[2])
+                self.assertEqual(len(static_files()), len(dex.STATIC_TABLES))
+                #So does a new cache version
+                dex.CACHE_VERSION += 1
+                self.assertFalse(dex.load(cache_dir)[2])
+                self.assertTrue(dex.load(cache_dir)[2])
+                self.assertEqual(len(static_files()), len(dex.STATIC_TABLES))
+                #An interrupted write leaves a temporary file, which isn't read
+                os.remove(cache_file)
+                fd, tmp = tempfile.mkstemp(dir=cache_dir)
+                with os.fdopen(fd, 'wb') as f:
+                    pickle.dump((dex.CACHE_VERSION, dex.source_hash(), {}), f)
+                tables, _, cached = dex.load(cache_dir)
+                self.assertFalse(cached)
+                self.assertEqual(tables, cached_tables)
+                #A truncated cache file is rebuilt
+                with open(cache_file, 'r+b') as f:
+                    f.truncate(10)
+                self.assertFalse(dex.load(cache_dir)[2])
+                self.assertTrue(dex.load(cache_dir)[2])
+            finally:
+                dex.CACHE_VERSION = version
+                os.chdir(cwd)
+
+class TestProtocol(unittest.TestCase):
+    def test_decode(self):
+        e = decode('|-damage|p2a: Mew|50/100|[from] item: Life Orb|[of] p1a: Mew')
+        self.assertEqual(e.type, '-damage')
+        self.assertEqual(e.args, ('', '-damage', 'p2a: Mew', '50/100'))
+        self.assertEqual(e.kwargs, {'from': 'item: Life Orb', 'of': 'p1a: Mew'})
+        e = decode('|-sethp|p1a: A|10/100|[from] x|[from] y')
+        self.assertEqual(e.kwargs, {'from': 'x'})
+        self.assertEqual(decode('|').type, '')
+        self.assertIsNone(decode(''))
+        self.assertIsNone(decode('sideupdate'))
+
+class TestDispatch(unittest.TestCase):
+    def test_override(self):
+        class BoostAgent(Agent):
+            def handle_boost(self, args, kwargs):
+                self.boosted = args[3]
+
+        self.assertIs(BoostAgent.dispatch['-boost'], BoostAgent.handle_boost)
+        self.assertIs(Agent.dispatch['-boost'], Agent.handle_boost)
+        agent = BoostAgent('p1')
+        agent.process_message('|-boost|p2a: Mew|atk|1')
+        self.assertEqual(agent.boosted, 'atk')
+        self.assertEqual(agent.game_data.opp_boosts['atk'], 0)
+
+    def test_register_handler(self):
+        def handle_custom(agent, args, kwargs):
+            agent.custom = args[2]
+
+        class Base(Agent):
+            pass
+
+        Base.register_handler('custom', handle_custom)
+        Base.register_handler('-boost', handle_custom)
+
+        class Sub(Base):
+            pass
+
+        self.assertIs(Sub.dispatch['custom'], handle_custom)
+        self.assertIs(Sub.dispatch['-boost'], handle_custom)
+        self.assertNotIn('custom', Agent.dispatch)
+        agent = Sub('p1')
+        agent.process_message('|custom|x')
+        self.assertEqual(agent.custom, 'x')
+
+    def test_no_leak(self):
+        class Sub(Agent):
+            @handles('custom')
+            def handle_custom(self, args, kwargs):
+                pass
+
+            @handles('-boost')
+            def handle_new_boost(self, args, kwargs):
+                pass
+
+        Sub.register_handler('other', lambda agent, args, kwargs: None)
+        self.assertIn('custom', Sub.dispatch)
+        self.assertIs(Sub.dispatch['-boost'], Sub.handle_new_boost)
+        for message_type in ['custom', 'other']:
+            self.assertNotIn(message_type, Agent.dispatch)
+        self.assertIs(Agent.dispatch['-boost'], Agent.handle_boost)
+
+    def test_replace(self):
+        agent = Agent('p1')
+        for message in ['|player|p1|p1|1', '|teamsize|p2|2',
+                '|switch|p2a: Mew|Mew, L80|100/100',
+                '|-boost|p2a: Mew|atk|1',
+                '|replace|p2a: Ditto|Ditto, L80|90/100']:
+            agent.process_message(message)
+        g = agent.game_data
+        self.assertEqual(g.opp_active.name, 'ditto')
+        self.assertEqual(g.opp_team[1], g.opp_active)
+        #Replace is not a switch
+        self.assertEqual(g.opp_boosts['atk'], 1)
+
+class TestSimRunner(unittest.TestCase):
+    def test_rejected_choice(self):
+        agent1 = Agent('p1')
+        agent2 = Agent('p2')
+        #No simulator is needed to handle chunks
+        runner = SimRunner(agent1, agent2, sim=object())
+        agent1.player_num = '1'
+        agent1.wait_game = False
+        agent1.choose_start = True
+        self.assertEqual(runner.choose_actions(), ['>p1 team 1'])
+        self.assertTrue(agent1.wait_game)
+        error = '|error|[Invalid choice] Can\'t do that'
+        runner.process_chunk(['sideupdate', 'p1', error])
+        self.assertEqual(runner.errors, [('1', error)])
+        self.assertFalse(agent1.wait_game)
+        self.assertTrue(agent1.choose_start)
+        self.assertEqual(runner.choose_actions(), ['>p1 team 1'])
+
+class TestSimProcess(unittest.TestCase):
+    def setUp(self):
+        #cat echoes what is written, standing in for the simulator
+        self.sim = SimProcess(['cat'])
+
+    def tearDown(self):
+        self.sim.close()
+
+    def test_feed(self):
+        self.sim.feed(b'update\n|turn|1\n')
+        self.assertFalse(self.sim.has_chunk())
+        #The separator is split across reads
+        self.sim.feed(b'\nsideupdate\np1\n')
+        self.assertEqual(list(self.sim._chunks), [['update', '|turn|1']])
+        self.sim.feed(b'\n\n\nend\n{}\n\nupdate\n|')
+        self.assertEqual(list(self.sim._chunks), [['update', '|turn|1'],
+            ['sideupdate', 'p1'], ['end', '{}']])
+        self.assertEqual(self.sim._buffer, b'update\n|')
+
+    def test_read_chunk(self):
+        self.sim.write('update\n|turn|1\n\nsideupdate\np1\n')
+        self.assertEqual(self.sim.read_chunk(timeout=5), ['update', '|turn|1'])
+        self.assertTrue(self.sim.has_chunk())
+        self.assertEqual(self.sim.read_chunk(timeout=5), ['sideupdate', 'p1'])
+        self.sim.write('end\n{}')
+        with self.assertRaises(TimeoutError):
+            self.sim.read_chunk(timeout=0.1)
+        self.sim.write('')
+        self.assertEqual(self.sim.read_chunk(timeout=5), ['end', '{}'])
+        #cat exits once its input is closed
+        self.sim.proc.stdin.close()
+        with self.assertRaises(EOFError):
+            self.sim.read_chunk(timeout=5)
+
+def side_request(team, active_moves=None, **extra):
+    """Returns a |request| message for p1 with a team of (name, moves)"""
+    pokemon = []
+    for i, (name, moves) in enumerate(team):
+        ability = pokedex[name.lower()]['abilities'][0]
+        pokemon.append({'ident': 'p1: ' + name, 'details': name + ', L80',
+            'condition': '100/100', 'active': i == 0, 'stats': {'atk': 100,
+            'def': 100, 'spa': 100, 'spd': 100, 'spe': 100}, 'moves': moves,
+            'baseAbility': ability, 'ability': ability, 'item': 'leftovers'})
+    data = dict(extra, side={'name': 'p1', 'id': 'p1', 'pokemon': pokemon})
+    if active_moves:
+        data['active'] = [{'moves': [{'id': m, 'pp': 8, 'maxpp': 16}
+            for m in active_moves]}]
+    return '|request|' + json.dumps(data)
+
+class TestIncrementalAgent(unittest.TestCase):
+    def test_replay(self):
+        team = [('Mew', ['rest', 'toxic', 'psychic']),
+            ('Zygarde', ['tackle'])]
+        moves = ['rest', 'toxic', 'psychic']
+        messages = [
+            '|player|p1|p1|1',
+            '|player|p2|p2|2',
+            '|teamsize|p1|2',
+            '|teamsize|p2|2',
+            side_request(team, teamPreview=True),
+            '|start',
+            '|switch|p1a: Mew|Mew, L80|100/100',
+            '|switch|p2a: Toxapex|Toxapex, L80|100/100',
+            '|turn|1',
+            side_request(team, moves),
+            '|move|p2a: Toxapex|Toxic|p1a: Mew',
+            '|-status|p1a: Mew|tox',
+            '|move|p1a: Mew|Psychic|p2a: Toxapex',
+            '|-unboost|p2a: Toxapex|evasion|1',
+            '|-status|p2a: Toxapex|brn',
+            '|-damage|p2a: Toxapex|82/100 brn|[from] brn',
+            '|-heal|p2a: Toxapex|88/100 brn|[from] item: Leftovers',
+            '|-sidestart|p1: p1|move: Toxic Spikes',
+            '|-weather|RainDance',
+            '|-boost|p1a: Mew|spa|2',
+            '|turn|2',
+            side_request(team, moves),
+            '|switch|p2a: Clefable|Clefable, L80|100/100',
+            '|-start|p1a: Mew|confusion',
+            '|move|p2a: Clefable|Wish|p2a: Clefable',
+            '|-heal|p2a: Clefable|100/100',
+            '|-fieldstart|move: Electric Terrain',
+            '|-weather|none',
+            '|turn|3',
+            side_request(list(reversed(team)), ['tackle']),
+            '|switch|p1a: Zygarde|Zygarde, L80|100/100',
+            '|switch|p2a: Toxapex|Toxapex, L80|88/100 brn',
+            '|-damage|p2a: Toxapex|0 fnt',
+            '|faint|p2a: Toxapex',
+            '|turn|4'
+        ]
+        agent = IncrementalAgent('p1', check=True)
+        featurizer = BatchFeaturizer()
+        for i, message in enumerate(messages):
+            agent.process_message(message)
+            #Features need both active pokemon
+            if agent.game_data.opp_active != None:
+                #Raises RuntimeError if the buffer is out of date
+                features = agent.game_to_features()
+                np.testing.assert_array_equal(features,
+                    featurizer.featurize([agent.game_data])[0], str(i))
+        self.assertEqual(agent.game_data.active.name, 'zygarde')
+        self.assertEqual(agent.game_data.opp_active.status, 'fnt')
+
+class TestSimPool(unittest.TestCase):
+    def wait_idle(self, pool, idle):
+        deadline = time.monotonic() + 5
+        while pool.stats()['idle'] < idle and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_hits(self):
+        #cat stands in for the simulator, answering once written to
+        pool = SimPool(size=1, command=['cat'])
+        try:
+            self.wait_idle(pool, 1)
+            sim = pool.acquire()
+            self.assertEqual((pool.hits, pool.misses), (1, 0))
+            sim.write('update\n')
+            self.assertEqual(sim.read_chunk(timeout=5), ['update'])
+            pool.release(sim)
+            #Released without output, so not counted in the latency
+            pool.release(pool.acquire())
+            stats = pool.stats()
+            self.assertEqual(stats['hits'] + stats['misses'], 2)
+            self.assertGreater(stats['hit_startup_max'], 0)
+            self.assertEqual(stats['miss_startup_max'], 0)
+        finally:
+            pool.close()
+
+    def test_misses(self):
+        #With no idle processes every acquire spawns one
+        pool = SimPool(size=0, command=['cat'])
+        try:
+            sim = pool.acquire()
+            sim.write('update\n')
+            sim.read_chunk(timeout=5)
+            pool.release(sim)
+            stats = pool.stats()
+            self.assertEqual((stats['hits'], stats['misses']), (0, 1))
+            self.assertGreater(stats['miss_startup_mean'], 0)
+        finally:
+            pool.close()
+        #Processes that died while idle are dropped
+        pool = SimPool(size=1, command=['true'])
+        try:
+            self.wait_idle(pool, 1)
+            time.sleep(0.2)
+            pool.release(pool.acquire())
+            self.assertEqual(pool.misses, 1)
+        finally:
+            pool.close()
+
+class TestAsyncSimProcess(unittest.TestCase):
+    def run_sim(self, command, test):
+        """Runs test(sim) on an AsyncSimProcess of command"""
+        async def run():
+            sim = await AsyncSimProcess.spawn(command)
+            try:
+                await test(sim)
+            finally:
+                await sim.close()
+        asyncio.run(run())
+
+    def test_read_chunk(self):
+        #The separator is split across writes, then several chunks and a
+        #partial one come at once
+        script = ('printf "update\\n|turn|1\\n"; sleep 0.1; '
+            'printf "\\n\\n\\nsideupdate\\np1\\n\\nend\\n{}\\n\\nupd"')
+        async def test(sim):
+            self.assertEqual(await sim.read_chunk(timeout=5),
+                ['update', '|turn|1'])
+            self.assertEqual(await sim.read_chunk(timeout=5),
+                ['sideupdate', 'p1'])
+            self.assertEqual(await sim.read_chunk(timeout=5), ['end', '{}'])
+            #The shell exits in the middle of a chunk
+            with self.assertRaises(EOFError):
+                await sim.read_chunk(timeout=5)
+        self.run_sim(['sh', '-c', script], test)
+
+    def test_timeout(self):
+        #cat echoes what is written, standing in for the simulator
+        async def test(sim):
+            sim.write('update\n|turn|1')
+            await sim.drain()
+            with self.assertRaises(TimeoutError):
+                await sim.read_chunk(timeout=0.1)
+            #The partial chunk is kept
+            sim.write('')
+            await sim.drain()
+            self.assertEqual(await sim.read_chunk(timeout=5),
+                ['update', '|turn|1'])
+            sim.proc.stdin.close()
+            with self.assertRaises(EOFError):
+                await sim.read_chunk(timeout=5)
+        self.run_sim(['cat'], test)
+
+def stub_worker(worker_id, num_games, agent_class, p1name, p2name,
+        game_format):
+    """Stands in for farm.run_worker without a simulator"""
+    return [{'worker': worker_id, 'game': game, 'winner': p1name}
+        for game in range(num_games)]
+
+class TestFarm(unittest.TestCase):
+    def test_results(self):
+        results = run_farm(3, 10, worker=stub_worker)
+        self.assertEqual(len(results), 10)
+        games = sorted((r['worker'], r['game']) for r in results)
+        self.assertEqual(games, [(0, 0), (0, 1), (0, 2), (0, 3), (1, 0),
+            (1, 1), (1, 2), (2, 0), (2, 1), (2, 2)])
+        #Workers beyond the number of games aren't started
+        self.assertEqual({r['worker'] for r in run_farm(4, 2,
+            worker=stub_worker)}, {0, 1})
+        self.assertEqual(run_farm(4, 0, worker=stub_worker), [])
+        self.assertEqual(len(run_farm(0, 2, worker=stub_worker)), 2)
+
+class TestGameData(unittest.TestCase):
+    def test_array_game_data(self):
+        g = ArrayGameData()
+        g.boosts['atk'] += 2
+        g.opp_side_effects['spikes'] += 1
+        g.opp_poke_effects['substitute'] = True
+        self.assertEqual(g.boost_list(), [2,0,0,0,0,0,0])
+        self.assertEqual(g.state[g.SIDE_EFFECTS][11 + 1], 1)
+        self.assertTrue(g.opp_poke_effects['substitute'])
+        #Assigning copies values into the state array
+        g.opp_boosts = g.boosts.copy()
+        g.boosts['atk'] = 0
+        self.assertEqual(g.opp_boost_list(), [2,0,0,0,0,0,0])
+        g.clear_boosts(True)
+        self.assertEqual(g.opp_boost_list(), [0,0,0,0,0,0,0])
+        with self.assertRaises(KeyError):
+            g.poke_effects['unknown'] = True
+        g.reset()
+        self.assertFalse(g.state.any())
+
+    def test_snapshot(self):
+        for game_data_class in (GameData, ArrayGameData):
+            g = game_data_class()
+            names = list(pokedex)[:2]
+            moves = list(movedex)[:4]
+            g.team = [Pokemon.from_details(n, n, '100/100') for n in names]
+            for p in g.team:
+                p.moves = list(map(Move, moves))
+            g.active = g.team[0]
+            g.opp_team = [Pokemon.from_details(names[1], 'x', '100/100'), None]
+            g.opp_active = g.opp_team[0]
+            g.boosts['atk'] = 1
+            snapshot = g.snapshot()
+            before = (str(g.team), str(g.opp_team), g.boost_list())
+            g.active.health = 50
+            #Moves are replaced instead of changed, like the handlers do
+            m = g.active.moves[0]
+            g.active.moves = [m.with_state(m.pp - 1, True)] + g.active.moves[1:]
+            g.opp_active.moves = [Move(moves[0])] + g.opp_active.moves[1:]
+            g.opp_active.transform(g.active)
+            g.team[0], g.team[1] = g.team[1], g.team[0]
+            g.boosts['atk'] = 3
+            g.restore(snapshot)
+            self.assertEqual((str(g.team), str(g.opp_team), g.boost_list()),
+                before)
+            self.assertFalse(g.opp_active.transformed)
+            self.assertFalse(g.active.moves[0].disabled)
+
+    def test_transform(self):
+        #Transform must not change the shared pokedex data of either species
+        names = ['mew', 'toxapex']
+        expected = [(Species.get(n).types, dict(Species.get(n).base_stats))
+            for n in names]
+        p = Pokemon.from_details('Mew, L80', 'Mew', '100/100')
+        target = Pokemon.from_details('Toxapex, L80', 'Toxapex', '100/100')
+        target.moves = [Move(list(movedex)[0])]
+        p.transform(target)
+        self.assertEqual(tuple(p.types), expected[1][0])
+        self.assertEqual(p.base_stats['hp'], expected[0][1]['hp'])
+        self.assertEqual(p.base_stats['atk'], expected[1][1]['atk'])
+        p.types.append('ghost')
+        p.base_stats['def'] = 999
+        for n, (types, base_stats) in zip(names, expected):
+            self.assertEqual(Species.get(n).types, types)
+            self.assertEqual(dict(Species.get(n).base_stats), base_stats)
+        self.assertEqual(tuple(target.types), expected[1][0])
+        p.switch_out()
+        self.assertIs(p.types, Species.get('mew').types)
+        self.assertIs(p.base_stats, Species.get('mew').base_stats)
+
+    def test_snapshot_handlers(self):
+        agent = Agent('p1')
+        for message in ['|player|p1|p1|1', '|teamsize|p2|2',
+                '|switch|p2a: Mew|Mew, L80|100/100',
+                '|move|p2a: Mew|Toxic|p1a: Mew']:
+            agent.process_message(message)
+        snapshot = agent.snapshot()
+        opp = agent.game_data.opp_active
+        before = str(opp)
+        for message in ['|move|p2a: Mew|Toxic|p1a: Mew',
+                '|move|p2a: Mew|Rest|p2a: Mew', '|-damage|p2a: Mew|50/100']:
+            agent.process_message(message)
+        self.assertNotEqual(str(opp), before)
+        for _ in range(2):
+            agent.restore(snapshot)
+            self.assertEqual(str(opp), before)
+            agent.process_message('|move|p2a: Mew|Toxic|p1a: Mew')
+
+class TestInference(unittest.TestCase):
+    def test_batching(self):
+        path = '/tmp/pokemon-rl-test.sock'
+        server = InferenceServer(random_policy, path, max_batch=4,
+            max_wait=0.05)
+        server.start()
+        clients = [InferenceClient(path) for _ in range(3)]
+        obs = np.zeros(NUM_FEATURES, dtype=np.float32)
+        try:
+            for legal in range(NUM_ACTIONS):
+                mask = np.zeros(NUM_ACTIONS, dtype=bool)
+                mask[legal] = True
+                for c in clients:
+                    self.assertEqual(c.act(obs, mask), legal)
+        finally:
+            for c in clients:
+                c.close()
+            server.close()
+        stats = server.stats()
+        self.assertEqual(stats['requests'], 3 * NUM_ACTIONS)
+        self.assertEqual(sum(stats['latency_us'].values()), 3 * NUM_ACTIONS)
+
+    def test_client_exit(self):
+        path = '/tmp/pokemon-rl-test.sock'
+        server = InferenceServer(random_policy, path, max_batch=4,
+            max_wait=0.05)
+        server.start()
+        client = InferenceClient(path)
+        #Fail instead of waiting forever if the server thread died
+        client.sock.settimeout(5)
+        obs = np.zeros(NUM_FEATURES, dtype=np.float32)
+        mask = np.ones(NUM_ACTIONS, dtype=np.uint8)
+        request = obs.tobytes() + mask.tobytes()
+        try:
+            #The client leaves its response unread and exits in the middle
+            #of a request, which resets the connection
+            dead = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            dead.connect(path)
+            dead.sendall(request)
+            time.sleep(0.2)
+            dead.sendall(request + request[:100])
+            dead.close()
+            for legal in range(NUM_ACTIONS):
+                mask = np.zeros(NUM_ACTIONS, dtype=bool)
+                mask[legal] = True
+                self.assertEqual(client.act(obs, mask), legal)
+            self.assertTrue(server.thread.is_alive())
+            self.assertEqual(len(server.buffers), 1)
+            self.assertEqual(len(server.pending), 0)
+        finally:
+            client.close()
+            server.close()
+
+class TestNetwork(unittest.TestCase):
+    def test_batch(self):
+        #Each observation's Q values don't depend on the rest of the batch
+        rng = random.Random(0)
+        games = [random_game(rng) for _ in range(8)]
+        inputs = torch.from_numpy(BatchFeaturizer().featurize(games))
+        network = Network()
+        with torch.no_grad():
+            q = network(inputs)
+            self.assertEqual(q.shape, (8, NUM_ACTIONS))
+            for i in range(8):
+                self.assertTrue(torch.allclose(q[i:i + 1],
+                    network(inputs[i:i + 1]), atol=1e-6))
+        #Features of moves that aren't known don't affect Q values
+        fi = MOVES + 3 * (MOVE_LEN + 1)
+        inputs[:, fi + MOVE_LEN] = 0
+        with torch.no_grad():
+            q = network(inputs)
+            inputs[:, fi:fi + MOVE_LEN] = 1
+            self.assertTrue(torch.equal(q, network(inputs)))
+
+    def test_learner(self):
+        rng = random.Random(0)
+        obs = BatchFeaturizer().featurize([random_game(rng) for _ in range(16)])
+        memory = PrioritizedReplayMemory(32, seed=0)
+        learner = Learner(Network(), memory, batch_size=8, target_update=2)
+        learner.push((obs[:-1], np.arange(15) % NUM_ACTIONS,
+            np.zeros(15, dtype=np.float32), obs[1:], np.arange(15) == 14,
+            np.ones((15, NUM_ACTIONS), dtype=bool)))
+        self.assertEqual(len(memory), 15)
+        for _ in range(2):
+            self.assertTrue(np.isfinite(learner.step()))
+        #Priorities were updated from the TD errors
+        self.assertTrue((memory.tree.get(np.arange(15)) != 1).any())
+        for p, t in zip(learner.network.parameters(),
+                learner.target.parameters()):
+            self.assertTrue(torch.equal(p, t))
+        #Targets only bootstrap from legal actions in the next state
+        next_obs = torch.from_numpy(obs[:2])
+        with torch.no_grad():
+            next_q = learner.target(next_obs)
+        masks = torch.zeros((2, NUM_ACTIONS), dtype=torch.bool)
+        masks[:, 7] = True
+        targets = learner.targets(torch.ones(2), next_obs,
+            torch.tensor([False, True]), masks)
+        self.assertAlmostEqual(targets[0].item(),
+            1 + learner.gamma * next_q[0, 7].item(), places=5)
+        self.assertEqual(targets[1].item(), 1)
+        #Terminal transitions have no legal actions, which doesn't give nan
+        targets = learner.targets(torch.ones(2), next_obs,
+            torch.tensor([True, True]), torch.zeros_like(masks))
+        self.assertTrue(torch.equal(targets, torch.ones(2)))
+
+    def test_shared_weights(self):
+        learner = Network()
+        weights = SharedWeights(learner)
+        bound = Network()
+        weights.bind(bound)
+        #A pickled copy attaches to the same memory, like in another process
+        copy = pickle.loads(pickle.dumps(weights))
+        actor = Network()
+        try:
+            with torch.no_grad():
+                for p in learner.parameters():
+                    p.add_(1)
+            self.assertEqual(weights.publish(learner), 1)
+            self.assertEqual(copy.version(), 1)
+            self.assertEqual(copy.load(actor), 1)
+            for network in (bound, actor):
+                for key, tensor in learner.state_dict().items():
+                    self.assertTrue(torch.equal(tensor,
+                        network.state_dict()[key]))
+        finally:
+            del bound
+            copy.close()
+            weights.close()
+            weights.unlink()
+
+def push_numbered(memory, n, start=0):
+    """Pushes n transitions whose fields all hold their number"""
+    for i in range(start, start + n):
+        memory.push(np.full(memory.obs_size, i, dtype=np.float32),
+            i % NUM_ACTIONS, i, np.full(memory.obs_size, i + 1,
+            dtype=np.float32), i % 2 == 0, np.arange(NUM_ACTIONS) == i % 10)
+
+class TestReplayMemory(unittest.TestCase):
+    def test_wraparound(self):
+        memory = ReplayMemory(8, obs_size=4)
+        push_numbered(memory, 5)
+        self.assertEqual((memory.position, len(memory)), (5, 5))
+        push_numbered(memory, 8 + 3 - 5, 5)
+        self.assertEqual((memory.position, len(memory)), (3, 8))
+        #The oldest 3 were overwritten by the last 3
+        self.assertEqual(memory.rewards.tolist(),
+            [8, 9, 10, 3, 4, 5, 6, 7])
+        obs, actions, rewards, next_obs, dones, next_masks = memory.get(
+            np.arange(8))
+        self.assertTrue(np.array_equal(obs[:, 0], rewards))
+        self.assertTrue(np.array_equal(next_obs[:, 0], rewards + 1))
+        self.assertEqual(actions.tolist(), (rewards % NUM_ACTIONS).tolist())
+        self.assertEqual(dones.tolist(), (rewards % 2 == 0).tolist())
+        self.assertEqual(next_masks.argmax(1).tolist(), actions.tolist())
+
+    def test_sample(self):
+        samples = []
+        for _ in range(2):
+            memory = ReplayMemory(16, obs_size=4, seed=1)
+            push_numbered(memory, 10)
+            samples.append(memory.sample(32))
+        for a, b in zip(*samples):
+            self.assertTrue(np.array_equal(a, b))
+        obs, actions, rewards, next_obs, dones, next_masks = samples[0]
+        self.assertEqual((obs.shape, obs.dtype), ((32, 4), np.float32))
+        self.assertEqual((actions.shape, actions.dtype), ((32,), np.int64))
+        self.assertEqual((rewards.shape, rewards.dtype), ((32,), np.float32))
+        self.assertEqual((next_obs.shape, next_obs.dtype),
+            ((32, 4), np.float32))
+        self.assertEqual((dones.shape, dones.dtype), ((32,), np.bool_))
+        self.assertEqual((next_masks.shape, next_masks.dtype),
+            ((32, NUM_ACTIONS), np.bool_))
+        #Only pushed transitions are sampled, and samples are copies
+        self.assertTrue(rewards.max() < 10)
+        obs = samples[1][0]
+        self.assertTrue(obs.flags['C_CONTIGUOUS'])
+        obs[:] = -1
+        self.assertTrue((memory.obs >= 0).all())
+
+    def test_mmap_resume(self):
+        with tempfile.TemporaryDirectory() as path:
+            memory = MmapReplayMemory(path, 8, obs_size=4)
+            self.assertFalse(memory.resumed)
+            push_numbered(memory, 11)
+            before = memory.get(np.arange(8))
+            memory.flush()
+            del memory
+            memory = MmapReplayMemory(path, 8, obs_size=4)
+            self.assertTrue(memory.resumed)
+            self.assertEqual((memory.position, len(memory)), (3, 8))
+            for a, b in zip(before, memory.get(np.arange(8))):
+                self.assertTrue(np.array_equal(a, b))
+            #Pushing continues where it left off
+            push_numbered(memory, 1, 11)
+            self.assertEqual(memory.rewards[3], 11)
+            del memory
+            with self.assertRaises(ValueError):
+                MmapReplayMemory(path, 16, obs_size=4)
+            with self.assertRaises(ValueError):
+                MmapReplayMemory(path, 8, obs_size=5)
+
+    def test_make_memory(self):
+        with tempfile.TemporaryDirectory() as path:
+            self.assertIsInstance(make_memory(8, mmap_path=path),
+                MmapReplayMemory)
+            with self.assertRaises(ValueError):
+                make_memory(8, True, path)
+
+class TestSumTree(unittest.TestCase):
+    def test_find(self):
+        tree = SumTree(5)
+        tree.update(np.arange(5), [1, 2, 3, 4, 0])
+        self.assertEqual(tree.total(), 10)
+        #Item i covers [sum of earlier priorities, that plus its own)
+        values = [0, 0.999, 1, 2.999, 3, 5.999, 6, 9.999]
+        self.assertEqual(tree.find(values).tolist(),
+            [0, 0, 1, 1, 2, 2, 3, 3])
+        tree.set(1, 0)
+        self.assertEqual(tree.find([0.5, 1, 4.5]).tolist(), [0, 2, 3])
+
+    def test_update(self):
+        rng = np.random.default_rng(0)
+        tree = SumTree(100)
+        for _ in range(20):
+            #Repeated indices get the last priority given
+            indices = rng.integers(0, 100, 32)
+            tree.update(indices, rng.random(32))
+            leaves = tree.get(np.arange(100))
+            self.assertAlmostEqual(tree.total(), leaves.sum())
+            nodes = np.arange(1, tree.size)
+            self.assertTrue(np.allclose(tree.tree[nodes],
+                tree.tree[2 * nodes] + tree.tree[2 * nodes + 1]))
+
+    def test_sampling(self):
+        memory = PrioritizedReplayMemory(8, obs_size=4, seed=0, alpha=1,
+            eps=0)
+        push_numbered(memory, 4)
+        memory.update_priorities(np.arange(4), np.array([1., -2, 3, 4]))
+        counts = np.zeros(4)
+        for _ in range(50):
+            sample = memory.sample(100, beta=1)
+            counts += np.bincount(sample[7], minlength=4)
+            #Weights are 1 / (N * P(i)), scaled so the largest is 1
+            probs = np.array([1, 2, 3, 4])[sample[7]] / 10
+            weights = 1 / (4 * probs)
+            self.assertTrue(np.allclose(sample[6], weights / weights.max()))
+        self.assertTrue(np.allclose(counts / counts.sum(), [.1, .2, .3, .4],
+            atol=0.02))
+
+class TestFleet(unittest.TestCase):
+    def serve(self, server, received, stop):
+        while not stop.is_set():
+            received.extend(server.poll(0.01))
+
+    def start(self, network, version, port=0):
+        #FleetServer isn't thread safe, so publish before serving from a
+        #thread
+        server = FleetServer('localhost', port, window=2)
+        server.publish(version, network.state_dict())
+        received = []
+        stop = threading.Event()
+        thread = threading.Thread(target=self.serve,
+            args=(server, received, stop))
+        thread.start()
+        return server, received, stop, thread
+
+    def test_fleet(self):
+        network = Network()
+        server, received, stop, thread = self.start(network, 1)
+        port = server.port
+        client = FleetClient('localhost', port, actor_id=3, retry=0.01)
+        rng = np.random.default_rng(0)
+        batch = [rng.random((5, NUM_FEATURES), dtype=np.float32),
+            np.arange(5), np.ones(5, dtype=np.float32),
+            rng.random((5, NUM_FEATURES), dtype=np.float32),
+            np.arange(5) == 4, np.ones((5, NUM_ACTIONS), dtype=bool)]
+        try:
+            for _ in range(5):
+                client.send(client.version, batch)
+            #The credits were all used, and one more comes back per batch
+            while len(received) < 5:
+                time.sleep(0.01)
+            actor_id, version, received_batch = received[-1]
+            self.assertEqual((actor_id, version), (3, 1))
+            for a, b in zip(batch, received_batch):
+                self.assertTrue(np.array_equal(a, b))
+            version, state_dict = client.take_weights()
+            self.assertEqual(version, 1)
+            for key, tensor in network.state_dict().items():
+                self.assertTrue(torch.equal(tensor, state_dict[key]))
+            self.assertEqual(client.take_weights(), None)
+            #Restart the learner, the client reconnects, sends again and
+            #gets the new learner's weights though their version is lower
+            stop.set()
+            thread.join()
+            server.close()
+            restarted = Network()
+            server, received, stop, thread = self.start(restarted, 0, port)
+            client.send(client.version, batch)
+            while len(received) < 1:
+                time.sleep(0.01)
+            self.assertEqual(client.reconnects, 1)
+            for _ in range(500):
+                weights = client.take_weights()
+                if weights != None:
+                    break
+                client.poll(0.01)
+            self.assertIsNotNone(weights)
+            version, state_dict = weights
+            self.assertEqual(version, 0)
+            for key, tensor in restarted.state_dict().items():
+                self.assertTrue(torch.equal(tensor, state_dict[key]))
+        finally:
+            stop.set()
+            thread.join()
+            client.close()
+            server.close()
+
+    def test_bad_frames(self):
+        network = Network()
+        server, received, stop, thread = self.start(network, 0)
+        batch = [np.zeros((2, NUM_FEATURES), dtype=np.float32),
+            np.zeros(2, dtype=np.int64), np.zeros(2, dtype=np.float32),
+            np.zeros((2, NUM_FEATURES), dtype=np.float32),
+            np.zeros(2, dtype=bool), np.ones((2, NUM_ACTIONS), dtype=bool)]
+        hello = encode_json(HELLO, {'actor_id':0, 'run':None, 'version':-1})
+        bad_batch = dict(zip(BATCH_FIELDS, batch))
+        bad_batch['actions'] = np.full(2, NUM_ACTIONS)
+        frames = [b'GET / HTTP/1.1\r\n\r\n',
+            FRAME_HEADER.pack(HELLO, 1 << 31),
+            FRAME_HEADER.pack(HELLO, 4) + b'junk',
+            encode_frame(HELLO, b'[1, 2]'),
+            encode_frame(HELLO, b'\0' * (MAX_FRAME + 1)),
+            encode_arrays(TRANSITIONS, 0, 0, dict(zip(BATCH_FIELDS, batch))),
+            hello + encode_arrays(TRANSITIONS, 0, 0, bad_batch),
+            hello + encode_frame(TRANSITIONS, b'\0' * 16 + b'PK')]
+        client = None
+        try:
+            for frame in frames:
+                with socket.create_connection(('localhost',
+                        server.port)) as sock:
+                    sock.sendall(frame)
+                    #The server closes the connection
+                    sock.settimeout(5)
+                    try:
+                        while sock.recv(1 << 20):
+                            pass
+                    except ConnectionResetError:
+                        pass
+            #Other actors are still served
+            client = FleetClient('localhost', server.port)
+            client.send(client.version, batch)
+            while len(received) < 1:
+                time.sleep(0.01)
+            self.assertEqual(server.bad_frames, len(frames))
+        finally:
+            stop.set()
+            thread.join()
+            if client != None:
+                client.close()
+            server.close()
+
 class Test(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        #Share pre-spawned simulators between tests
+        cls.pool = SimPool(size=2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.close()
+
     def setUp(self):
         self.agent1 = TestAgent('a')
         self.agent2 = TestAgent('b')
-        self.sim_runner = SimRunner(self.agent1, self.agent2)
+        self.sim_runner = SimRunner(self.agent1, self.agent2, pool=self.pool)
 
     def tearDown(self):
         self.sim_runner.clean_up()
         print('Done')
 
+    def check_features(self):
+        games = [self.agent1.game_data, self.agent2.game_data]
+        batch = BatchFeaturizer().featurize(games)
+        np.testing.assert_array_equal(batch[0],
+            self.agent1.game_to_features())
+        np.testing.assert_array_equal(batch[1],
+            self.agent2.game_to_features())
+
     def test_switches(self):
         print('Testing switches...')
         silent = True
@@ -469,6 +1323,7 @@ class Test(unittest.TestCase):
         self.assertEqual(g2.opp_active.ability, 'analytic')
         self.assertEqual(g2.opp_active.moves[0].name, 'agility')
         self.assertEqual(g2.opp_active.moves[1].name, 'conversion')
+        self.check_features()
         #p1 ditto, p2 conversion
         self.sim_runner.run_actions(silent=silent)
         self.sim_runner.run_until_request(silent=silent)
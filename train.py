@@ -0,0 +1,249 @@
+import sys
+import logging
+import argparse
+import copy
+import json
+import queue
+import random
+import time
+import multiprocessing
+import numpy as np
+import torch
+import torch.nn.functional as F
+from agents.dqn_agent import (DQNAgent, Network, SharedWeights,
+    ReplayMemory, MmapReplayMemory, PrioritizedReplayMemory)
+from sim import SimRunner
+
+def actor_epsilon(actor_id, num_actors, base=0.4, alpha=7):
+    """Returns the exploration rate of an actor. Actors explore at rates
+    from base down to base ** (1 + alpha), so some of them play close to
+    the greedy policy."""
+    if num_actors == 1:
+        return base
+    return base ** (1 + alpha * actor_id / (num_actors - 1))
+
+def battle_reward(winner, player_name):
+    if winner == player_name:
+        return 1
+    if winner:
+        return -1
+    return 0
+
+def make_agents(network, epsilon):
+    return [DQNAgent('p1', network, epsilon), DQNAgent('p2', network, epsilon)]
+
+def play_game(sim_runner, game_format='random'):
+    """Plays a game between the DQNAgents of sim_runner, returns obs,
+    actions, rewards, next_obs, dones and next_masks arrays of both
+    players' transitions"""
+    agents = (sim_runner.agent1, sim_runner.agent2)
+    for agent in agents:
+        agent.init_battle()
+    sim_runner.run_game(game_format=game_format)
+    for agent in agents:
+        agent.end_battle(battle_reward(sim_runner.winner, agent.player_name))
+    return [np.concatenate(arrays) for arrays in
+        zip(*[agent.take_transitions() for agent in agents])]
+
+def run_actor(actor_id, num_actors, transitions, weights, stop,
+        game_format='random'):
+    """Plays DQNAgents against each other until stop is set, putting the
+    transitions of each game on the transitions queue. The network is bound
+    to the SharedWeights weights, so it always has the newest ones."""
+    #Workers are forked with the same random state, so reseed each one
+    random.seed()
+    torch.manual_seed(random.getrandbits(32))
+    torch.set_num_threads(1)
+    network = Network()
+    network.eval()
+    weights.bind(network)
+    sim_runner = SimRunner(*make_agents(network,
+        actor_epsilon(actor_id, num_actors)))
+    try:
+        while not stop.is_set():
+            version = weights.version()
+            batch = play_game(sim_runner, game_format)
+            #Wait while the learner is behind, but don't block shutdown
+            while not stop.is_set():
+                try:
+                    transitions.put((actor_id, version, batch), timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+    finally:
+        sim_runner.clean_up()
+
+class Learner:
+    """Trains a Network with double DQN on transitions from a replay
+    memory, using a target network updated every target_update steps"""
+    def __init__(self, network, memory, batch_size=64, gamma=0.99, lr=1e-4,
+            target_update=1000):
+        self.network = network
+        self.target = copy.deepcopy(network)
+        self.memory = memory
+        self.batch_size = batch_size
+        self.gamma = gamma
+        self.target_update = target_update
+        self.optimizer = torch.optim.Adam(network.parameters(), lr=lr)
+        self.prioritized = isinstance(memory, PrioritizedReplayMemory)
+        self.steps = 0
+
+    def push(self, batch):
+        for transition in zip(*batch):
+            self.memory.push(*transition)
+
+    def targets(self, rewards, next_obs, dones, next_masks):
+        """Returns double DQN targets, bootstrapping only from legal
+        actions"""
+        with torch.no_grad():
+            #With no legal actions, as at the end of a battle or when only
+            #struggle is left, the first move stands in, so the max is never
+            #-inf
+            next_masks = next_masks.clone()
+            next_masks[:, 0] |= ~next_masks.any(1)
+            next_q = self.network(next_obs)
+            next_q[~next_masks] = -float('inf')
+            next_actions = next_q.argmax(1, keepdim=True)
+            next_q = self.target(next_obs).gather(1, next_actions).squeeze(1)
+            return rewards + self.gamma * next_q * (~dones)
+
+    def step(self):
+        """Trains on one batch, returns the loss"""
+        sample = self.memory.sample(self.batch_size)
+        obs, actions, rewards, next_obs, dones, next_masks = map(
+            torch.from_numpy, sample[:6])
+        q = self.network(obs).gather(1, actions.unsqueeze(1)).squeeze(1)
+        targets = self.targets(rewards, next_obs, dones, next_masks)
+        losses = F.smooth_l1_loss(q, targets, reduction='none')
+        if self.prioritized:
+            losses = losses * torch.from_numpy(sample[6])
+            self.memory.update_priorities(sample[7],
+                (targets - q).detach().numpy())
+        loss = losses.mean()
+        self.optimizer.zero_grad()
+        loss.backward()
+        self.optimizer.step()
+        self.steps += 1
+        if self.steps % self.target_update == 0:
+            self.target.load_state_dict(self.network.state_dict())
+        return loss.item()
+
+def make_memory(capacity, prioritized=False, mmap_path=None):
+    if prioritized and mmap_path:
+        #The sum tree isn't saved, so a resumed memory couldn't sample
+        raise ValueError('Prioritized replay memory can\'t be memory-mapped')
+    if prioritized:
+        return PrioritizedReplayMemory(capacity)
+    if mmap_path:
+        return MmapReplayMemory(mmap_path, capacity)
+    return ReplayMemory(capacity)
+
+def train(num_actors, num_steps, memory, learn_start=1000,
+        publish_every=100, checkpoint=None, checkpoint_every=1000,
+        game_format='random', **learner_args):
+    """Trains a Network for num_steps learner steps on games played by
+    num_actor processes, returns a report of the run"""
+    network = Network()
+    learner = Learner(network, memory, **learner_args)
+    #A few games per actor can wait, after that actors block
+    transitions = multiprocessing.Queue(4 * num_actors)
+    weights = SharedWeights(network)
+    stop = multiprocessing.Event()
+    actors = [multiprocessing.Process(target=run_actor, args=(i, num_actors,
+        transitions, weights, stop, game_format))
+        for i in range(num_actors)]
+    version = 0
+
+    def save():
+        if checkpoint:
+            torch.save(network.state_dict(), checkpoint)
+
+    games = 0
+    pushed = 0
+    staleness = 0
+    losses = []
+    for actor in actors:
+        actor.start()
+    start = time.perf_counter()
+    try:
+        while learner.steps < num_steps:
+            #Take everything waiting, and wait for games before learning
+            block = len(memory) < learn_start
+            while True:
+                try:
+                    actor_id, actor_version, batch = transitions.get(
+                        timeout=0.1) if block else transitions.get_nowait()
+                except queue.Empty:
+                    break
+                block = False
+                learner.push(batch)
+                games += 1
+                pushed += len(batch[0])
+                staleness += version - actor_version
+            if any(actor.exitcode for actor in actors):
+                raise RuntimeError('An actor failed')
+            if len(memory) < learn_start:
+                continue
+            losses.append(learner.step())
+            if learner.steps % publish_every == 0:
+                version = weights.publish(network)
+            if learner.steps % checkpoint_every == 0:
+                save()
+    finally:
+        stop.set()
+        #Actors can't exit while their puts are unread
+        while any(actor.is_alive() for actor in actors):
+            try:
+                transitions.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        for actor in actors:
+            actor.join()
+        weights.close()
+        weights.unlink()
+    elapsed = time.perf_counter() - start
+    save()
+    return {
+        'actors': num_actors,
+        'games': games,
+        'transitions': pushed,
+        'learner_steps': learner.steps,
+        'games_per_sec': games / elapsed,
+        'transitions_per_sec': pushed / elapsed,
+        'steps_per_sec': learner.steps / elapsed,
+        'mean_staleness': staleness / max(games, 1),
+        'final_loss': float(np.mean(losses[-100:])) if losses else None
+    }
+
+if __name__ == '__main__':
+    logging.basicConfig(filename='showdown.log', level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description='Train a DQN agent on games played by actor processes')
+    parser.add_argument('-a', '--actors', type=int,
+        default=max(multiprocessing.cpu_count() - 1, 1),
+        help='Number of actor processes')
+    parser.add_argument('-n', '--steps', type=int, default=100000,
+        help='Number of learner steps')
+    parser.add_argument('-c', '--capacity', type=int, default=50000,
+        help='Replay memory capacity')
+    memory_type = parser.add_mutually_exclusive_group()
+    memory_type.add_argument('-m', '--mmap',
+        help='Folder to keep a memory-mapped replay memory in')
+    memory_type.add_argument('-p', '--prioritized', action='store_true',
+        help='Use prioritized replay, kept in memory')
+    parser.add_argument('-b', '--batch-size', type=int, default=64)
+    parser.add_argument('--lr', type=float, default=1e-4)
+    parser.add_argument('--gamma', type=float, default=0.99)
+    parser.add_argument('--learn-start', type=int, default=1000,
+        help='Transitions to collect before learning')
+    parser.add_argument('--publish-every', type=int, default=100,
+        help='Learner steps between publishing weights to actors')
+    parser.add_argument('-o', '--output', default='dqn.pt',
+        help='File to save the network weights to')
+    args = parser.parse_args()
+    memory = make_memory(args.capacity, args.prioritized, args.mmap)
+    report = train(args.actors, args.steps, memory, args.learn_start,
+        args.publish_every, args.output, batch_size=args.batch_size,
+        gamma=args.gamma, lr=args.lr)
+    json.dump(report, sys.stdout, indent=2)
+    print()